@@ -0,0 +1,359 @@
+#!/usr/bin/env python3
+"""
+Query replay and load generator for the nameserver
+
+@author:
+@version:
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import random
+import socket
+from collections import Counter, deque
+from select import select
+from time import perf_counter
+
+SRVR_ADDR = "localhost"
+SRVR_PORT = 43053
+ZONE_FILE = "data/projects/nameserver/zoo.zone"
+
+QUERY_TYPES = {"A": 1, "NS": 2, "CNAME": 5, "PTR": 12, "MX": 15, "AAAA": 28}
+RCODES = {0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 5: "REFUSED"}
+FLAGS_QUERY = 0x0100  # Standard query, recursion desired
+FLAG_RESPONSE = 0x80  # In the first flags byte
+FLAG_TRUNCATED = 0x02  # In the first flags byte
+MAX_DATAGRAM = 4096
+MAX_WINDOW = 0xFFFF  # Every query in flight needs its own transaction ID
+TIMEOUT_CHECK_INTERVAL = 0.05
+
+
+def encode_query(trans_id: int, name: str, qry_type: int) -> bytes:
+    """A standard query for the name and type, in the wire format"""
+    question = bytearray()
+    for label in name.rstrip(".").split("."):
+        data = label.encode("ascii")
+        if not 0 < len(data) < 64:
+            raise ValueError(f"Invalid name: {name!r}")
+        question += bytes((len(data),)) + data
+    return b"".join(
+        (
+            trans_id.to_bytes(2, "big"),
+            FLAGS_QUERY.to_bytes(2, "big"),
+            b"\x00\x01\x00\x00\x00\x00\x00\x00",
+            question,
+            b"\x00",
+            qry_type.to_bytes(2, "big"),
+            b"\x00\x01",
+        )
+    )
+
+
+def read_queries(filename: str) -> list[tuple[str, int]]:
+    """
+    Read a query list with a `name type` pair per line, as used by dnsperf
+    Return a list of (name, type)
+    """
+    queries = []
+    with open(filename, encoding="utf-8") as query_file:
+        for line in query_file:
+            fields = line.split("#", 1)[0].split(";", 1)[0].split()
+            if not fields:
+                continue
+            if len(fields) != 2 or fields[1].upper() not in QUERY_TYPES:
+                raise ValueError(f"Invalid query in {filename}: {line!r}")
+            queries.append((fields[0].rstrip("."), QUERY_TYPES[fields[1].upper()]))
+    return queries
+
+
+def zone_queries(filename: str) -> list[tuple[str, int]]:
+    """
+    The questions the zone file answers: a (name, type) for every type of
+    record each name has, in the order of the file
+    """
+    queries: dict[tuple[str, int], None] = {}
+    origin = None
+    owner = None
+    with open(filename, encoding="utf-8") as zone_file:
+        for line in zone_file:
+            fields = line.split(";", 1)[0].split()
+            if not fields:
+                continue
+            if fields[0].upper() == "$ORIGIN":
+                origin = fields[1].rstrip(".")
+                continue
+            if fields[0].startswith("$"):
+                continue
+            if not line[0].isspace():
+                owner = fields[0]
+            rr_type = next((field for field in fields if field in QUERY_TYPES), None)
+            if owner is None or origin is None or rr_type is None:
+                continue
+            name = origin if owner == "@" else f"{owner}.{origin}"
+            if owner.endswith("."):
+                name = owner[:-1]
+            queries[(name, QUERY_TYPES[rr_type])] = None
+    if not queries:
+        raise ValueError(f"No records in {filename}")
+    return list(queries)
+
+
+def zipf_weights(n: int, exponent: float = 1.0) -> list[float]:
+    """Cumulative Zipf weights of `n` ranks, the k-th one being 1 / k**exponent"""
+    return list(itertools.accumulate(1 / rank**exponent for rank in range(1, n + 1)))
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not ordered:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(ordered) + 0.5 - 1e-9))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def run_load(
+    addr: tuple[str, int],
+    queries: list[tuple[str, int]],
+    window: int = 100,
+    duration: float = 10.0,
+    total: int = 0,
+    rate: float = 0.0,
+    timeout: float = 2.0,
+    exponent: float | None = None,
+    seed: int | None = None,
+) -> dict:
+    """
+    Send queries over UDP and return the report
+    Queries are replayed in order, or drawn by Zipf rank after shuffling if an
+    `exponent` is given; at most `window` of them are in flight
+    With `rate` 0 a query is sent whenever one is answered or lost; otherwise
+    queries are due at a fixed rate and latency is measured from when a query
+    was due, so waiting for the window is included
+    Queries not answered within `timeout` seconds are lost
+    """
+    if not queries:
+        raise ValueError("No queries to send")
+    if not 0 < window <= MAX_WINDOW:
+        raise ValueError(f"The window must be between 1 and {MAX_WINDOW}")
+    rng = random.Random(seed)
+    bodies = [encode_query(0, name, qry_type)[2:] for name, qry_type in queries]
+    if exponent is None:
+        picks = itertools.cycle(bodies)
+    else:
+        rng.shuffle(bodies)
+        cum_weights = zipf_weights(len(bodies), exponent)
+        picks = iter(lambda: rng.choices(bodies, cum_weights=cum_weights)[0], None)
+    trans_ids = itertools.cycle(range(0x10000))
+    in_flight: dict[int, tuple[float, bytes]] = {}  # ID -> (started, question)
+    expiry: deque[tuple[float, int]] = deque()  # In the order queries were sent
+    latencies: list[float] = []
+    rcodes: Counter[str] = Counter()
+    errors: Counter[str] = Counter()
+    sent = truncated = lost = 0
+    buffer = bytearray(MAX_DATAGRAM)
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    start = perf_counter()
+    stop_sending = start + duration if duration else float("inf")
+    next_due = start
+
+    def may_send(now: float) -> bool:
+        return (not total or sent < total) and now < stop_sending
+
+    try:
+        sock.connect(addr)
+        sock.setblocking(False)
+        while True:
+            now = perf_counter()
+            while len(in_flight) < window and may_send(next_due if rate else now):
+                if rate and next_due > now:
+                    break
+                trans_id = next(trans_ids)
+                while trans_id in in_flight:
+                    trans_id = next(trans_ids)
+                body = next(picks)
+                try:
+                    sock.send(trans_id.to_bytes(2, "big") + body)
+                except BlockingIOError:
+                    break
+                except OSError as os_err:
+                    errors[type(os_err).__name__] += 1  # Not waited for, so not lost
+                else:
+                    started = next_due if rate else now
+                    in_flight[trans_id] = (started, body[10:])
+                    expiry.append((started, trans_id))
+                sent += 1
+                next_due += 1 / rate if rate else 0
+            while expiry and now - expiry[0][0] > timeout:
+                started, trans_id = expiry.popleft()
+                if trans_id in in_flight and in_flight[trans_id][0] == started:
+                    del in_flight[trans_id]
+                    lost += 1
+            if not in_flight and not may_send(next_due if rate else now):
+                break
+            wait = TIMEOUT_CHECK_INTERVAL
+            if rate and len(in_flight) < window and may_send(next_due):
+                wait = min(wait, max(0.0, next_due - now))
+            if not select([sock], [], [], wait)[0]:
+                continue
+            while True:
+                try:
+                    n_bytes = sock.recv_into(buffer)
+                except BlockingIOError:
+                    break
+                except OSError as os_err:
+                    errors[type(os_err).__name__] += 1
+                    break
+                received = perf_counter()
+                msg = buffer[:n_bytes]
+                query = in_flight.get(int.from_bytes(msg[:2], "big"))
+                if query is None:
+                    errors["UnexpectedResponse"] += 1
+                    continue
+                started, question = query
+                if (
+                    n_bytes < 12 + len(question)
+                    or not msg[2] & FLAG_RESPONSE
+                    or msg[12 : 12 + len(question)] != question
+                ):
+                    errors["MalformedResponse"] += 1
+                    continue
+                del in_flight[int.from_bytes(msg[:2], "big")]
+                latencies.append(received - started)
+                rcode = msg[3] & 0x0F
+                rcodes[RCODES.get(rcode, str(rcode))] += 1
+                if msg[2] & FLAG_TRUNCATED:
+                    truncated += 1
+    finally:
+        sock.close()
+
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {
+        "mode": "open" if rate else "closed",
+        "window": window,
+        "rate": rate,
+        "sent": sent,
+        "answered": len(latencies),
+        "lost": lost,
+        "loss_pct": round(100 * lost / sent, 3) if sent else 0.0,
+        "rcodes": dict(sorted(rcodes.items())),
+        "truncated": truncated,
+        "errors": dict(errors),
+        "duration": round(elapsed, 3),
+        "qps": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            name: round(value * 1000, 3)
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p90", percentile(latencies, 90)),
+                ("p99", percentile(latencies, 99)),
+                ("p99.9", percentile(latencies, 99.9)),
+                ("max", latencies[-1] if latencies else 0.0),
+            )
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    """Print the report in a human-readable form"""
+    print(f"{'Mode:':14s}{report['mode']} loop, window of {report['window']}")
+    print(
+        f"{'Queries:':14s}{report['sent']} sent, {report['answered']} answered "
+        f"in {report['duration']} s"
+    )
+    print(f"{'Throughput:':14s}{report['qps']} qps")
+    print(f"{'Lost:':14s}{report['lost']} ({report['loss_pct']}%)")
+    print(f"{'Responses:':14s}{report['rcodes']}, {report['truncated']} truncated")
+    print(f"{'Errors:':14s}{report['errors']}")
+    latency = report["latency_ms"]
+    print(
+        f"{'Latency (ms):':14s}p50 {latency['p50']}  p90 {latency['p90']}  "
+        f"p99 {latency['p99']}  p99.9 {latency['p99.9']}  max {latency['max']}"
+    )
+
+
+def main():
+    """Set up arguments and run the load"""
+    arg_parser = argparse.ArgumentParser(description="Load the nameserver")
+    arg_parser.add_argument(
+        "--host", type=str, default=SRVR_ADDR, help="Server address"
+    )
+    arg_parser.add_argument("--port", type=int, default=SRVR_PORT, help="Server port")
+    source = arg_parser.add_mutually_exclusive_group()
+    source.add_argument(
+        "-z",
+        "--zone",
+        type=str,
+        default=ZONE_FILE,
+        help="Draw queries for the names in a zone file",
+    )
+    source.add_argument(
+        "-q", "--queries", type=str, help="Replay a `name type` query list"
+    )
+    arg_parser.add_argument(
+        "-s",
+        "--exponent",
+        type=float,
+        default=1.0,
+        help="Zipf exponent of the names drawn from the zone",
+    )
+    arg_parser.add_argument(
+        "-w", "--window", type=int, default=100, help="Most queries in flight"
+    )
+    arg_parser.add_argument(
+        "-t", "--duration", type=float, default=10.0, help="Seconds to run"
+    )
+    arg_parser.add_argument(
+        "-n", "--total", type=int, default=0, help="Stop after this many queries"
+    )
+    arg_parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=0.0,
+        help="Queries per second (open loop); 0 sends as fast as the window allows",
+    )
+    arg_parser.add_argument(
+        "--timeout", type=float, default=2.0, help="Seconds before a query is lost"
+    )
+    arg_parser.add_argument("--seed", type=int, help="Seed of the query mix")
+    arg_parser.add_argument("-j", "--json", type=str, help="Write the report to a file")
+    arg_parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable logging.DEBUG mode"
+    )
+    args = arg_parser.parse_args()
+
+    logger = logging.getLogger("root")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.WARNING)
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logger.level)
+
+    if args.queries:
+        queries, exponent = read_queries(args.queries), None
+    else:
+        queries, exponent = zone_queries(args.zone), args.exponent
+    logging.debug(f"{len(queries)} distinct queries")
+    report = run_load(
+        (args.host, args.port),
+        queries,
+        window=args.window,
+        duration=args.duration,
+        total=args.total,
+        rate=args.rate,
+        timeout=args.timeout,
+        exponent=exponent,
+        seed=args.seed,
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,13 +7,86 @@
 """
 
 import argparse
+import heapq
+import json
 import logging
-from socket import AF_INET, SOCK_DGRAM, socket
+import multiprocessing
+import os
+import selectors
+import struct
+import sys
+import threading
+from collections import Counter, OrderedDict
+from multiprocessing.connection import Connection, wait
+from signal import (
+    SIG_BLOCK,
+    SIG_DFL,
+    SIG_IGN,
+    SIG_UNBLOCK,
+    SIGHUP,
+    SIGINT,
+    SIGTERM,
+    pthread_sigmask,
+    signal,
+)
+from socket import (
+    AF_INET,
+    AF_INET6,
+    SO_REUSEADDR,
+    SO_REUSEPORT,
+    SOCK_DGRAM,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    inet_pton,
+    socket,
+)
+from time import monotonic, perf_counter_ns, sleep
+from typing import Iterator
 
 HOST = "localhost"
 PORT = 43053
 
 DNS_TYPES = {1: "A", 2: "NS", 5: "CNAME", 12: "PTR", 15: "MX", 16: "TXT", 28: "AAAA"}
+DNS_CODES = {name: code for code, name in DNS_TYPES.items()}
+DNS_CLASSES = {"IN": 1}
+RCODES = {0: "NOERROR", 1: "FORMERR", 2: "SERVFAIL", 3: "NXDOMAIN", 5: "REFUSED"}
+QUERY_TYPES = (1, 2, 5, 12, 15, 28)  # A, NS, CNAME, PTR, MX and AAAA are answered
+
+FLAGS_ANSWER = 0x8100  # Response, recursion desired
+FLAGS_NXDOMAIN = 0x8103  # Response, recursion desired, name error
+FLAG_TRUNCATED = 0x0200  # Set when the answers did not fit in the datagram
+CLASS_CHAOS = 3  # Only used by the `stats.bind.` TXT query
+STATS_QUESTION = b"\x05stats\x04bind\x00\x00\x10\x00\x03"  # stats.bind. TXT CH
+MAX_POINTER = 0x3FFF  # Names written further into a message cannot be pointed to
+MAX_CNAME_CHAIN = 8  # Aliases followed within the zone when answering
+CACHE_MAX_ENTRIES = 10_000  # Distinct questions kept by the answer cache
+MAX_DATAGRAM = 4096  # Longer requests are truncated and fail to parse
+MAX_UDP_RESPONSE = 512  # Longer responses are truncated, for the client to use TCP
+MAX_TCP_RESPONSE = 65535  # Longest message the 2-byte TCP length prefix can carry
+TCP_RECV_SIZE = 16384
+TCP_MAX_PENDING = 65536  # Unsent bytes after which a connection is no longer read
+TCP_MAX_CONNECTIONS = 256  # Open TCP connections per server; more are refused
+TCP_IDLE_TIMEOUT = 10.0  # Seconds a TCP connection may stay without a query
+TCP_BACKLOG = 128
+RECV_BATCH = 32  # Most datagrams drained from the socket per wakeup
+STATS_INTERVAL = 1.0  # Seconds between stats reports of a worker
+RELOAD_INTERVAL = 1.0  # Seconds between checks of the zone file for changes
+RESTART_DELAY = 1.0  # Pause before restarting a worker that died right after starting
+SHUTDOWN_TIMEOUT = 5.0
+STOP_SIGNALS = {SIGINT, SIGTERM}
+TOP_CAPACITY = 1000  # Questions tracked by the heavy-hitter sketch (0 disables stats)
+STATS_TOP = 10  # Questions listed in the answer to `stats.bind.`
+LATENCY_BUCKETS = 24  # Power-of-two microsecond buckets, the last one open-ended
+STATS_DUMP_INTERVAL = 10.0  # Seconds between writes of the query stats file
+RRL_RATE = 0.0  # UDP responses per second to a client prefix (0 disables the limit)
+RRL_SLIP = 2  # Every n-th limited response is sent truncated, the rest dropped
+RRL_MAX_ENTRIES = 10_000  # Client prefixes tracked by the rate limiter
+RRL_IPV4_PREFIX = 3  # Leading address bytes shared by the clients of a bucket (/24)
+RRL_IPV6_PREFIX = 7  # /56
+
+RR_FIELDS = struct.Struct("!HHIH")  # Type, class, TTL and data length of a record
+RecordValue = bytes | str | tuple[int, str]  # Packed address, name or MX
+Record = tuple[int, int, RecordValue]  # TTL, type and value
 
 TTL_SEC = {
     "1s": 1,
@@ -30,14 +103,15 @@ def val_to_n_bytes(value: int, n_bytes: int) -> tuple[int, ...]:
     Split a value into n bytes
     Return the result as a tuple of n integers
     """
-    # TODO: Implement this function
-    ...
+    return tuple((value >> (8 * shift)) & 0xFF for shift in reversed(range(n_bytes)))
 
 
 def bytes_to_val(bytes_lst: list) -> int:
     """Merge n bytes into a value"""
-    # TODO: Implement this function
-    ...
+    value = 0
+    for byte in bytes_lst:
+        value = (value << 8) | byte
+    return value
 
 
 def get_left_n_bits(bytes_lst: list, n_bits: int) -> int:
@@ -45,8 +119,7 @@ def get_left_n_bits(bytes_lst: list, n_bits: int) -> int:
     Extract first (leftmost) n bits of a two-byte sequence
     Return the result as a decimal value
     """
-    # TODO: Implement this function
-    ...
+    return bytes_to_val(bytes_lst) >> (16 - n_bits)
 
 
 def get_right_n_bits(bytes_lst: list, n_bits: int) -> int:
@@ -54,25 +127,444 @@ def get_right_n_bits(bytes_lst: list, n_bits: int) -> int:
     Extract last (rightmost) n bits of a two-byte sequence
     Return the result as a decimal value
     """
-    # TODO: Implement this function
-    ...
+    return bytes_to_val(bytes_lst) & ((1 << n_bits) - 1)
 
 
 def get_origin(filename: str) -> str:
     """
     Read the origin from the zone file
     """
-    # TODO: Implement this function
-    ...
+    with open(filename, encoding="utf-8") as zone_file:
+        for line in zone_file:
+            fields = line.split(";", 1)[0].split()
+            if len(fields) == 2 and fields[0].upper() == "$ORIGIN":
+                return fields[1].rstrip(".")
+    raise ValueError(f"No $ORIGIN in {filename}")
+
+
+def parse_ttl(value: str) -> int:
+    """
+    TTL in seconds written as a number, optionally followed by one of the units
+    of `TTL_SEC` (s, m, h, d, w or y)
+    Raise `ValueError` for anything else
+    """
+    number, unit = value, "1s"
+    if value[-1:].isalpha():
+        number, unit = value[:-1], f"1{value[-1].lower()}"
+    if not (number.isascii() and number.isdigit()) or unit not in TTL_SEC:
+        raise ValueError(f"Invalid TTL: {value!r}")
+    return int(number) * TTL_SEC[unit]
+
+
+def relative_name(name: str, origin: str) -> str | None:
+    """
+    The lowercase name relative to the origin of a name without the trailing
+    dot, "" for the origin itself; None if the name is outside the zone
+    """
+    name, origin = name.lower(), origin.lower()
+    if name == origin:
+        return ""
+    if name.endswith("." + origin):
+        return name[: -len(origin) - 1]
+    return None
+
+
+def absolute_name(name: str, origin: str) -> str:
+    """The domain name, without the trailing dot, of a name in the zone file"""
+    if name == "@":
+        return origin
+    if name.endswith("."):
+        return name[:-1]
+    return f"{name}.{origin}"
+
+
+class NameTable:
+    """
+    Suffixes of the names already written to a message and their offsets
+    Repeated suffixes are written as compression pointers (RFC 1035, 4.1.4)
+    """
+
+    __slots__ = ("offsets", "frozen")
+
+    def __init__(self, offsets: dict[str, int] | None = None, frozen: bool = False):
+        self.offsets: dict[str, int] = offsets or {}
+        self.frozen = frozen
+
+    def encode(self, name: str, offset: int) -> bytes:
+        """
+        Encode a name that is written at `offset` of the message, pointing to
+        the longest suffix written before, and remember its new suffixes
+        A frozen table only points to the offsets it was created with, for
+        records whose position in the message is not known in advance
+        """
+        labels = name.split(".") if name else []
+        lowered = name.lower()
+        encoded = bytearray()
+        start = 0
+        for label in labels:
+            suffix = lowered[start:]
+            start += len(label) + 1
+            pointer = self.offsets.get(suffix)
+            if pointer is not None:
+                return bytes(encoded) + (0xC000 | pointer).to_bytes(2, "big")
+            if not self.frozen and offset + len(encoded) <= MAX_POINTER:
+                self.offsets[suffix] = offset + len(encoded)
+            data = label.encode("ascii")
+            encoded += bytes((len(data),)) + data
+        return bytes(encoded) + b"\x00"
+
+
+def encode_rdata(
+    rr_type: int, value: RecordValue, table: NameTable, offset: int
+) -> bytes:
+    """Wire format of the record data that starts at `offset` of the message"""
+    if rr_type in (1, 28):
+        return value
+    if rr_type == 15:
+        preference, exchange = value
+        return preference.to_bytes(2, "big") + table.encode(exchange, offset + 2)
+    return table.encode(value, offset)
+
+
+def encode_rr(table: NameTable, owner: str, record: Record, offset: int) -> bytes:
+    """Wire format of a resource record that starts at `offset` of the message"""
+    ttl, rr_type, value = record
+    name = table.encode(owner, offset)
+    rdata = encode_rdata(rr_type, value, table, offset + len(name) + 10)
+    return b"".join(
+        (
+            name,
+            RR_FIELDS.pack(rr_type, DNS_CLASSES["IN"], ttl, len(rdata)),
+            rdata,
+        )
+    )
+
+
+def encode_header(flags: int, an_count: int) -> bytes:
+    """The header of a response after the transaction ID, with one question"""
+    return bytes(
+        (*val_to_n_bytes(flags, 2), 0, 1, *val_to_n_bytes(an_count, 2), 0, 0, 0, 0)
+    )
+
+
+NXDOMAIN_HEADER = encode_header(FLAGS_NXDOMAIN, 0)
+NO_DATA = (encode_header(FLAGS_ANSWER, 0), b"")
+NXDOMAIN = (NXDOMAIN_HEADER, b"")
+SLIP_HEADER = encode_header(FLAGS_ANSWER | FLAG_TRUNCATED, 0)
+
+
+def compile_answers(
+    origin: str,
+    records: dict[str, list[Record]],
+    domain: str,
+    qry_type: int,
+    headers: dict[int, bytes] | None = None,
+) -> tuple[bytes, bytes]:
+    """
+    Encode the answer to a query for `domain` and `qry_type`, preceded by the
+    matching response header
+    An alias is answered with its CNAME record followed by the answer for the
+    target if that is in the zone too
+    Names are compressed against the question and the records before them,
+    except for a wildcard, whose answers follow questions of any length: they
+    only point to the question as their owner and write other names in full
+    Headers are shared through `headers`, keyed by the number of answers
+    """
+    question = f"{domain}.{origin}" if domain else origin
+    if domain.split(".", 1)[0] == "*":
+        table = NameTable({question.lower(): 12}, frozen=True)
+        offset = 0
+    else:
+        table = NameTable()
+        offset = 12 + len(table.encode(question, 12)) + 4
+    answers = bytearray()
+    an_count = 0
+    for _ in range(MAX_CNAME_CHAIN):
+        rrset = records.get(domain, [])
+        selected = [record for record in rrset if record[1] == qry_type]
+        alias = None
+        if not selected:
+            alias = next((record for record in rrset if record[1] == 5), None)
+            selected = [alias] if alias else []
+        owner = f"{domain}.{origin}" if domain else origin
+        for record in selected:
+            answers += encode_rr(table, owner, record, offset + len(answers))
+            an_count += 1
+        if alias is None:
+            break
+        domain = relative_name(alias[2], origin)
+        if domain is None:
+            break
+    if headers is None:
+        return encode_header(FLAGS_ANSWER, an_count), bytes(answers)
+    header = headers.get(an_count)
+    if header is None:
+        header = headers[an_count] = encode_header(FLAGS_ANSWER, an_count)
+    return header, bytes(answers)
+
+
+class ZoneNode:
+    """
+    A name in the zone trie with its compiled answers by query type
+    `answers` is None for an empty non-terminal, a name that only exists
+    because names below it do
+    """
+
+    __slots__ = ("children", "answers")
+
+    def __init__(self):
+        self.children: dict[str, ZoneNode] = {}
+        self.answers: dict[int, tuple[bytes, bytes]] | None = None
+
+
+class Zone:
+    """
+    The compiled zone as a trie over reversed labels, rooted at the origin
+    A lookup takes one step per label of the name: it tells names with
+    records, empty non-terminals and missing names apart, and falls back to
+    the `*` child of the closest existing name (RFC 4592)
+    Labels are stored in lowercase; a query label is only folded if it is not
+    found as sent
+    Also reads as a mapping from the names with records to their answers
+    """
+
+    __slots__ = ("root", "size")
+
+    def __init__(self):
+        self.root = ZoneNode()
+        self.size = 0
+
+    def add(self, name: str, answers: dict[int, tuple[bytes, bytes]]) -> None:
+        """Store the answers of a lowercase name relative to the origin"""
+        node = self.root
+        for label in reversed(name.split(".")) if name else ():
+            child = node.children.get(label)
+            if child is None:
+                child = node.children[label] = ZoneNode()
+            node = child
+        if node.answers is None:
+            self.size += 1
+        node.answers = answers
+
+    def find(self, name: str) -> ZoneNode | None:
+        """The node of a name relative to the origin, without wildcards"""
+        node = self.root
+        for label in reversed(name.split(".")) if name else ():
+            child = node.children.get(label)
+            if child is None:
+                child = node.children.get(label.lower())
+                if child is None:
+                    return None
+            node = child
+        return node
+
+    def lookup(self, name: str, qry_type: int) -> tuple[bytes, bytes]:
+        """
+        The (header, answers) to a query for a name relative to the origin:
+        NXDOMAIN for a name that does not exist, an empty answer for a name
+        without records of the type
+        """
+        node = self.root
+        for label in reversed(name.split(".")) if name else ():
+            child = node.children.get(label)
+            if child is None:
+                child = node.children.get(label.lower())
+                if child is None:
+                    child = node.children.get("*")
+                    if child is None:
+                        return NXDOMAIN
+                    node = child
+                    break
+            node = child
+        if node.answers is None:
+            return NO_DATA
+        return node.answers.get(qry_type, NO_DATA)
+
+    def __getitem__(self, name: str) -> dict[int, tuple[bytes, bytes]]:
+        node = self.find(name)
+        if node is None or node.answers is None:
+            raise KeyError(name)
+        return node.answers
+
+    def get(self, name: str, default=None):
+        """The answers of a name, or `default` if it has no records"""
+        node = self.find(name)
+        return default if node is None or node.answers is None else node.answers
+
+    def __contains__(self, name: str) -> bool:
+        return self.get(name) is not None
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __iter__(self) -> Iterator[str]:
+        stack = [("", self.root)]
+        while stack:
+            name, node = stack.pop()
+            if node.answers is not None:
+                yield name
+            for label, child in reversed(node.children.items()):
+                stack.append((f"{label}.{name}" if name else label, child))
+
+
+class ZoneParser:
+    """
+    Streaming parser of zone file lines into compact records
+    Keeps the $ORIGIN, the $TTL default and the owner of the previous record
+    between lines, so records without a name belong to the previous one
+    Names are stored relative to the first $ORIGIN, the origin of the zone; a
+    later $ORIGIN only changes how the relative names that follow it are read
+    A record spread over lines with parentheses, such as an SOA, is joined
+    before it is parsed; the TTL and the class of a record are both optional
+    A record is a (ttl, type, value) tuple: addresses are packed into their wire
+    bytes, names are interned and equal TTLs share one int
+    """
+
+    __slots__ = (
+        "source",
+        "zone_origin",
+        "origin",
+        "default_ttl",
+        "domain",
+        "ttls",
+        "continued",
+    )
+
+    def __init__(self, source: str = "zone file"):
+        self.source = source
+        self.zone_origin: str | None = None
+        self.origin: str | None = None
+        self.default_ttl = TTL_SEC["1w"]
+        self.domain: str | None = None
+        self.ttls: dict[int, int] = {}
+        self.continued: str | None = None  # Lines of an unclosed parenthesis
+
+    def parse(self, line: str) -> tuple[str, Record | None] | None:
+        """
+        The owner and the record of a line
+        Return None for directives, comments, blank lines and the lines of a
+        record that continues on the next one, and no record for a type that
+        is not served
+        Raise `ValueError` if the line is not a valid record
+        """
+        text = line.split(";", 1)[0]
+        if self.continued is not None:
+            text = f"{self.continued} {text}"
+            self.continued = None
+        if text.count("(") > text.count(")"):
+            self.continued = text.rstrip("\r\n")
+            return None
+        fields = text.replace("(", " ").replace(")", " ").split()
+        if not fields:
+            return None
+        if fields[0].startswith("$"):
+            directive = fields[0].upper()
+            try:
+                if directive == "$ORIGIN":
+                    if self.origin is None:
+                        self.origin = self.zone_origin = fields[1].rstrip(".")
+                    else:
+                        self.origin = absolute_name(fields[1], self.origin)
+                elif directive == "$TTL":
+                    self.default_ttl = parse_ttl(fields[1])
+            except (IndexError, ValueError) as err:
+                raise ValueError(
+                    f"Malformed directive in {self.source}: {text!r}"
+                ) from err
+            return None
+        if self.origin is None:
+            raise ValueError(f"Record before $ORIGIN in {self.source}: {text!r}")
+        if not text[0].isspace():
+            owner = fields.pop(0)
+            domain = relative_name(absolute_name(owner, self.origin), self.zone_origin)
+            if domain is None:
+                raise ValueError(f"Record outside the zone in {self.source}: {text!r}")
+            self.domain = sys.intern(domain)
+        domain, origin = self.domain, self.origin
+        if domain is None:
+            raise ValueError(f"Record without a name in {self.source}: {text!r}")
+        ttl = self.default_ttl
+        for _ in range(2):  # [TTL] [class] in either order
+            if fields and fields[0][0].isdigit():
+                try:
+                    ttl = parse_ttl(fields.pop(0))
+                except ValueError as v_err:
+                    raise ValueError(
+                        f"Malformed record in {self.source}: {text!r}"
+                    ) from v_err
+            elif fields and fields[0].upper() in DNS_CLASSES:
+                fields.pop(0)
+            elif fields and fields[0].upper() in ("CH", "CS", "HS"):
+                raise ValueError(f"Record not in class IN in {self.source}: {text!r}")
+        if len(fields) < 2:
+            raise ValueError(f"Malformed record in {self.source}: {text!r}")
+        rr_type = DNS_CODES.get(fields[0].upper())
+        if rr_type not in QUERY_TYPES:
+            logging.debug(f"Skipping a {fields[0]} record of {domain}")
+            return domain, None
+        try:
+            if rr_type == 1:
+                value = inet_pton(AF_INET, fields[1])
+            elif rr_type == 28:
+                value = inet_pton(AF_INET6, fields[1])
+            elif rr_type == 15:
+                value = (
+                    int(fields[1]),
+                    sys.intern(absolute_name(fields[2], origin)),
+                )
+            else:
+                value = sys.intern(absolute_name(fields[1], origin))
+        except (OSError, IndexError, ValueError) as err:
+            raise ValueError(f"Malformed record in {self.source}: {text!r}") from err
+        return domain, (self.ttls.setdefault(ttl, ttl), rr_type, value)
+
+
+def load_zone(filename: str) -> tuple[str, Zone]:
+    """
+    Read the zone file in one pass and compile it
+    Return the origin and the zone, with the compiled answers of every name:
+    {type: (response header after the ID, answers)}
+    Only the types a name answers are stored; the rest get `NO_DATA`
+    """
+    parser = ZoneParser(filename)
+    records: dict[str, list[Record]] = {}
+    with open(filename, encoding="utf-8") as zone_file:
+        for line in zone_file:
+            parsed = parser.parse(line)
+            if parsed is None:
+                continue
+            domain, record = parsed
+            rrset = records.setdefault(domain, [])
+            if record is not None:
+                rrset.append(record)
+    if parser.continued is not None:
+        raise ValueError(f"Unclosed parenthesis in {filename}")
+    origin = parser.zone_origin
+    if origin is None:
+        raise ValueError(f"No $ORIGIN in {filename}")
+    headers: dict[int, bytes] = {}
+    zone = Zone()
+    for domain, rrset in records.items():
+        types = {record[1] for record in rrset}
+        if 5 in types:
+            types = QUERY_TYPES  # Every type is answered with the alias
+        zone.add(
+            domain,
+            {
+                qry_type: compile_answers(origin, records, domain, qry_type, headers)
+                for qry_type in types
+            },
+        )
+    return origin, zone
 
 
-def read_zone_file(filename: str) -> dict[str, list]:
+def read_zone_file(filename: str) -> Zone:
     """
-    Read the zone file and build a dictionary
-    Use domain names as keys and list(s) of records as values
+    Read the zone file and build the zone
+    Use domain names relative to the origin as keys and the compiled answers for
+    every supported query type as values: {type: (header after the ID, answers)}
     """
-    # TODO: Implement this function
-    ...
+    return load_zone(filename)[1]
 
 
 def parse_request(origin: str, msg_req: bytes) -> tuple:
@@ -80,44 +572,1049 @@ def parse_request(origin: str, msg_req: bytes) -> tuple:
     Parse the request
     Return query parameters as a tuple
     """
-    # TODO: Implement this function
-    ...
+    labels = []
+    pos = 12
+    try:
+        while (length := msg_req[pos]) != 0:
+            if length & 0xC0:
+                raise ValueError("Compressed question names are not supported")
+            labels.append(msg_req[pos + 1 : pos + 1 + length].decode("ascii"))
+            pos += 1 + length
+        end = pos + 5
+        if end > len(msg_req) or not labels:
+            raise IndexError
+    except (IndexError, UnicodeDecodeError) as err:
+        raise ValueError("Malformed request") from err
+    qry_type = bytes_to_val(msg_req[pos + 1 : pos + 3])
+    if qry_type not in QUERY_TYPES:
+        raise ValueError("Unknown query type")
+    if bytes_to_val(msg_req[pos + 3 : end]) != DNS_CLASSES["IN"]:
+        raise ValueError("Unknown class")
+    n_origin = origin.count(".") + 1
+    if len(labels) < n_origin or ".".join(labels[-n_origin:]).lower() != origin.lower():
+        raise ValueError("Unknown origin")
+    trans_id = bytes_to_val(msg_req[:2])
+    return trans_id, ".".join(labels[:-n_origin]), qry_type, msg_req[12:end]
 
 
 def format_response(
-    zone: dict, trans_id: int, qry_name: str, qry_type: int, qry: bytearray
+    zone: Zone, trans_id: int, qry_name: str, qry_type: int, qry: bytearray
 ) -> bytearray:
-    """Format the response"""
-    # TODO: Implement this function
-    ...
+    """Format the response to a query for a name relative to the origin"""
+    header, section = zone.lookup(qry_name, qry_type)
+    return b"".join((trans_id.to_bytes(2, "big"), header, qry, section))
 
 
-def run(filename: str) -> None:
-    """Main server loop"""
-    origin = get_origin(filename)
-    zone = read_zone_file(filename)
-    with socket(AF_INET, SOCK_DGRAM) as server_sckt:
-        server_sckt.bind((HOST, PORT))
-        print("Listening on %s:%d" % (HOST, PORT))
+class AnswerCache:
+    """
+    LRU cache of responses keyed by the case-folded question
+    A value is the response header after the transaction ID and the answer
+    section; the question itself is echoed from the request, preserving its case
+    Must be cleared whenever the zone changes
+    """
+
+    def __init__(self, max_entries: int = CACHE_MAX_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: OrderedDict[bytes, tuple[bytes, bytes]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: bytes) -> tuple[bytes, bytes] | None:
+        """The cached (header, answers) for the question, if any"""
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(key)
+        return value
+
+    def put(self, key: bytes, header: bytes, answers: bytes) -> None:
+        """Store a response, evicting the least recently used one if full"""
+        self.entries[key] = (header, answers)
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def clear(self) -> None:
+        """Drop every response"""
+        self.entries.clear()
+
+
+def split_question(msg_req: bytes) -> tuple[bytes, bytes] | None:
+    """
+    Find the question of a standard query without decoding it
+    Return the question bytes and the cache key with the name case-folded,
+    or None if the message is not a single-question query
+    """
+    if len(msg_req) < 17 or msg_req[2] & 0xF8 or msg_req[4:6] != b"\x00\x01":
+        return None
+    end = msg_req.find(b"\x00", 12) + 5
+    if end < 17 or end > len(msg_req):
+        return None
+    question = msg_req[12:end]
+    return question, question[:-4].lower() + question[-4:]
+
+
+def describe_question(question: bytes) -> str:
+    """A question in the wire format as `name TYPE`"""
+    labels, pos = [], 0
+    while pos < len(question) - 5:
+        length = question[pos]
+        labels.append(question[pos + 1 : pos + 1 + length].decode("ascii", "replace"))
+        pos += 1 + length
+    qry_type = bytes_to_val(question[-4:-2])
+    return f"{'.'.join(labels)}. {DNS_TYPES.get(qry_type, qry_type)}"
 
+
+class SpaceSaving:
+    """
+    Heavy-hitter counter that tracks at most `capacity` keys
+    A new key replaces the least counted one and inherits its count as the
+    possible overestimate, so every key seen more than N/capacity times is kept
+    """
+
+    __slots__ = ("capacity", "counts", "heap")
+
+    def __init__(self, capacity: int = TOP_CAPACITY):
+        self.capacity = capacity
+        self.counts: dict[bytes, list[int]] = {}  # key -> [count, error]
+        self.heap: list[tuple[int, bytes]] = []  # One entry per key, possibly stale
+
+    def add(self, key: bytes) -> None:
+        """Count an occurrence of the key"""
+        counter = self.counts.get(key)
+        if counter is not None:
+            counter[0] += 1
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self.evict()
+        self.counts[key] = [error + 1, error]
+        heapq.heappush(self.heap, (error + 1, key))
+
+    def evict(self) -> int:
+        """Drop the least counted key and return its count"""
         while True:
-            try:
-                (request_msg, client_addr) = server_sckt.recvfrom(2048)
-            except KeyboardInterrupt:
-                print("Quitting")
+            count, key = heapq.heappop(self.heap)
+            current = self.counts[key][0]
+            if current == count:
+                del self.counts[key]
+                return count
+            heapq.heappush(self.heap, (current, key))
+
+    def top(self, n: int) -> list[tuple[bytes, int, int]]:
+        """The `n` most frequent keys as (key, count, maximum overestimate)"""
+        ranked = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in ranked]
+
+
+class LatencyHistogram:
+    """
+    Counts of durations in power-of-two microsecond buckets
+    Bucket i holds durations below 2**i microseconds and at least half that
+    """
+
+    __slots__ = ("counts",)
+
+    def __init__(self):
+        self.counts = [0] * LATENCY_BUCKETS
+
+    def add(self, nanoseconds: int) -> None:
+        """Count a duration"""
+        self.counts[min((nanoseconds // 1000).bit_length(), LATENCY_BUCKETS - 1)] += 1
+
+    def percentile(self, pct: float) -> int:
+        """Upper bound in microseconds of the bucket holding the percentile"""
+        total = sum(self.counts)
+        rank = max(1, round(pct / 100 * total + 0.5 - 1e-9))
+        for i, count in enumerate(self.counts):
+            rank -= count
+            if rank <= 0:
+                return 1 << i
+        return 0
+
+
+class QueryStats:
+    """
+    Which questions dominate the load, how they were answered, and how long
+    parsing the requests and looking up the answers took
+    Memory is fixed: questions are counted by a Space-Saving sketch and times
+    by histograms
+    """
+
+    __slots__ = ("questions", "rcodes", "ignored", "parse_time", "lookup_time")
+
+    def __init__(self, capacity: int = TOP_CAPACITY):
+        self.questions = SpaceSaving(capacity)
+        self.rcodes: Counter[int] = Counter()
+        self.ignored = 0
+        self.parse_time = LatencyHistogram()
+        self.lookup_time = LatencyHistogram()
+
+    def add(self, key: bytes, rcode: int, parse_ns: int, lookup_ns: int) -> None:
+        """Record a question answered with `rcode`"""
+        self.questions.add(key)
+        self.rcodes[rcode] += 1
+        self.parse_time.add(parse_ns)
+        self.lookup_time.add(lookup_ns)
+
+    def report(self, n: int = STATS_TOP) -> dict:
+        """The stats as a dictionary"""
+        return {
+            "queries": sum(self.rcodes.values()) + self.ignored,
+            "rcodes": {
+                RCODES.get(rcode, str(rcode)): count
+                for rcode, count in sorted(self.rcodes.items())
+            },
+            "ignored": self.ignored,
+            **{
+                f"{stage}_us": {
+                    f"p{pct}": histogram.percentile(pct) for pct in (50, 90, 99)
+                }
+                for stage, histogram in (
+                    ("parse", self.parse_time),
+                    ("lookup", self.lookup_time),
+                )
+            },
+            "parse_histogram": list(self.parse_time.counts),
+            "lookup_histogram": list(self.lookup_time.counts),
+            "top": [
+                (describe_question(key), count, error)
+                for key, count, error in self.questions.top(n)
+            ],
+        }
+
+    def lines(self, n: int = STATS_TOP) -> list[str]:
+        """The stats as short lines of text"""
+        report = self.report(n)
+        rcodes = " ".join(f"{name}={count}" for name, count in report["rcodes"].items())
+        lines = [f"queries={report['queries']} {rcodes} ignored={report['ignored']}"]
+        for stage in ("parse_us", "lookup_us"):
+            times = " ".join(f"{pct}={value}" for pct, value in report[stage].items())
+            lines.append(f"{stage} {times}")
+        for description, count, error in report["top"]:
+            lines.append(
+                f"top {description} {count}" + (f" +-{error}" if error else "")
+            )
+        return lines
+
+    def dump(self, filename: str) -> None:
+        """Replace the file with the current stats as JSON"""
+        partial = f"{filename}.tmp"
+        with open(partial, "w", encoding="utf-8") as stats_file:
+            json.dump(self.report(), stats_file, indent=2)
+        os.replace(partial, filename)
+
+
+def stats_response(msg_req: bytes, query_stats: QueryStats) -> bytes | None:
+    """
+    The answer to a `stats.bind.` TXT query in the CHAOS class: a TXT record
+    with each line of the stats
+    Return None if the request is not that query
+    """
+    found = split_question(msg_req)
+    if found is None or found[1] != STATS_QUESTION:
+        return None
+    answers = []
+    for line in query_stats.lines():
+        text = line.encode("ascii", "replace")[:255]
+        rdata = bytes((len(text),)) + text
+        answers.append(
+            b"\xc0\x0c" + RR_FIELDS.pack(16, CLASS_CHAOS, 0, len(rdata)) + rdata
+        )
+    return b"".join(
+        (
+            msg_req[:2],
+            encode_header(FLAGS_ANSWER, len(answers)),
+            found[0],
+            *answers,
+        )
+    )
+
+
+def answer_query(
+    origin: str,
+    zone: Zone,
+    cache: AnswerCache | None,
+    msg_req: bytes,
+    query_stats: QueryStats | None = None,
+) -> bytes:
+    """
+    Respond to a request, from the cache if the question was answered before
+    Raise `ValueError` if the request cannot be processed
+    With `query_stats`, record the question, the response code and the time
+    spent parsing the request and looking up the answer
+    """
+    if query_stats is not None:
+        return answer_timed(origin, zone, cache, msg_req, query_stats)
+    found = split_question(msg_req) if cache is not None else None
+    if found is not None:
+        question, key = found
+        cached = cache.get(key)
+        if cached is not None:
+            return b"".join((msg_req[:2], cached[0], question, cached[1]))
+    trans_id, domain, qry_type, qry = parse_request(origin, msg_req)
+    msg_resp = format_response(zone, trans_id, domain, qry_type, qry)
+    if found is not None and found[0] == qry:
+        cache.put(found[1], msg_resp[2:12], msg_resp[12 + len(qry) :])
+    return msg_resp
+
+
+def answer_timed(
+    origin: str,
+    zone: Zone,
+    cache: AnswerCache | None,
+    msg_req: bytes,
+    query_stats: QueryStats,
+) -> bytes:
+    """
+    `answer_query` that times finding the question and parsing the request
+    apart from the cache and zone lookups
+    """
+    started = perf_counter_ns()
+    found = split_question(msg_req)
+    split = looked_up = perf_counter_ns()
+    if found is not None and cache is not None:
+        question, key = found
+        cached = cache.get(key)
+        looked_up = perf_counter_ns()
+        if cached is not None:
+            query_stats.add(
+                key, cached[0][1] & 0x0F, split - started, looked_up - split
+            )
+            return b"".join((msg_req[:2], cached[0], question, cached[1]))
+    trans_id, domain, qry_type, qry = parse_request(origin, msg_req)
+    parsed = perf_counter_ns()
+    msg_resp = format_response(zone, trans_id, domain, qry_type, qry)
+    if cache is not None and found is not None and found[0] == qry:
+        cache.put(found[1], msg_resp[2:12], msg_resp[12 + len(qry) :])
+    answered = perf_counter_ns()
+    key = found[1] if found is not None else qry[:-4].lower() + qry[-4:]
+    query_stats.add(
+        key,
+        msg_resp[3] & 0x0F,
+        (split - started) + (parsed - looked_up),
+        (looked_up - split) + (answered - parsed),
+    )
+    return msg_resp
+
+
+def truncate(msg_resp: bytes, max_size: int = MAX_UDP_RESPONSE) -> bytes:
+    """
+    Fit a response into a datagram
+    A response over `max_size` bytes is cut down to its header and question with
+    the TC flag set and no answers, telling the client to retry over TCP
+    """
+    if len(msg_resp) <= max_size:
+        return msg_resp
+    end = msg_resp.find(b"\x00", 12) + 5
+    flags = bytes_to_val(msg_resp[2:4]) | FLAG_TRUNCATED
+    return b"".join(
+        (
+            msg_resp[:2],
+            flags.to_bytes(2, "big"),
+            b"\x00\x01\x00\x00\x00\x00\x00\x00",
+            msg_resp[12:end],
+        )
+    )
+
+
+class RateLimiter:
+    """
+    Token buckets limiting the UDP responses to each client prefix
+    A bucket holds one second of responses (at least one) and refills at `rate`
+    per second; a client with an empty bucket gets every `slip`-th response
+    truncated, so a real resolver can retry over TCP, and the rest dropped
+    (all of them if `slip` is 0)
+    The least recently seen prefix makes room for a new one once `max_entries`
+    are tracked, and buckets that have refilled are forgotten by `expire`
+    """
+
+    __slots__ = ("rate", "burst", "slip", "max_entries", "buckets")
+
+    def __init__(
+        self,
+        rate: float,
+        slip: int = RRL_SLIP,
+        max_entries: int = RRL_MAX_ENTRIES,
+    ):
+        if rate <= 0 or slip < 0 or max_entries < 1:
+            raise ValueError("Invalid rate limit")
+        self.rate = rate
+        self.burst = max(rate, 1.0)
+        self.slip = slip
+        self.max_entries = max_entries
+        # prefix -> [tokens, time of the last update, responses limited]
+        self.buckets: OrderedDict[bytes, list] = OrderedDict()
+
+    @staticmethod
+    def prefix(client_addr: tuple) -> bytes:
+        """The network of a client as the leading bytes of its address"""
+        host = client_addr[0]
+        if ":" in host:
+            return inet_pton(AF_INET6, host)[:RRL_IPV6_PREFIX]
+        return inet_pton(AF_INET, host)[:RRL_IPV4_PREFIX]
+
+    def check(self, client_addr: tuple, now: float) -> str:
+        """Whether to "answer", "slip" or "drop" the response to a client"""
+        key = self.prefix(client_addr)
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            if len(self.buckets) >= self.max_entries:
+                self.buckets.popitem(last=False)
+            self.buckets[key] = [self.burst - 1, now, 0]
+            return "answer"
+        self.buckets.move_to_end(key)
+        tokens = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return "answer"
+        bucket[0] = tokens
+        bucket[2] += 1
+        if self.slip and bucket[2] % self.slip == 0:
+            return "slip"
+        return "drop"
+
+    def expire(self, now: float) -> None:
+        """Forget the prefixes whose buckets have refilled"""
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if (now - bucket[1]) * self.rate < self.burst:
                 break
+            del self.buckets[key]
+
+
+def slip_response(msg_req: bytes) -> bytes | None:
+    """
+    The empty truncated response sent instead of a limited one
+    None if the request is not a single-question query
+    """
+    split = split_question(msg_req)
+    if split is None:
+        return None
+    return b"".join((msg_req[:2], SLIP_HEADER, split[0]))
+
+
+class ZoneLoader:
+    """
+    Keeps the zone file under watch and parses new versions in the background
+    The file is checked every `interval` seconds (never if 0) and whenever a
+    reload is requested; a new zone waits in `pending` until the serving loop
+    takes it, so the swap happens between queries
+    A file that fails to parse is reported and the current zone stays in service
+    """
+
+    def __init__(self, filename: str, interval: float = RELOAD_INTERVAL):
+        self.filename = filename
+        self.interval = interval
+        self.version = self.stat()
+        self.origin, self.zone = load_zone(filename)
+        self.pending: tuple[str, Zone] | None = None
+        self.lock = threading.Lock()
+        self.reloads = 0
+        self.failures = 0
+        self.requested = threading.Event()
+        self.stopped = False
+        self.thread = threading.Thread(
+            target=self.watch, name="zone-loader", daemon=True
+        )
+
+    def stat(self) -> tuple[int, int, int] | None:
+        """What identifies a version of the file"""
+        try:
+            stat = os.stat(self.filename)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def start(self) -> "ZoneLoader":
+        """Start watching the file"""
+        self.thread.start()
+        return self
+
+    def stop(self) -> None:
+        """Stop watching the file"""
+        self.stopped = True
+        self.requested.set()
+
+    def request_reload(self, *_) -> None:
+        """Read the file again even if it looks unchanged; usable as a signal handler"""
+        self.requested.set()
+
+    def watch(self) -> None:
+        """Check the file until stopped"""
+        while not self.stopped:
+            forced = self.requested.wait(self.interval or None)
+            self.requested.clear()
+            if not self.stopped:
+                self.check(forced)
+
+    def check(self, forced: bool = False) -> bool:
+        """
+        Parse the file if it has changed
+        Return True if a new zone is waiting to be taken
+        """
+        version = self.stat()
+        if version is None or (version == self.version and not forced):
+            return False
+        try:
+            origin, zone = load_zone(self.filename)
+        except Exception as err:
+            self.failures += 1
+            self.version = version
+            logging.warning(
+                f"Keeping the current zone, {self.filename} is invalid: {err}"
+            )
+            return False
+        if self.stat() != version:
+            return False  # Still being written, parse the final version next time
+        self.version = version
+        with self.lock:
+            self.pending = (origin, zone)
+        return True
+
+    def take(self) -> tuple[str, Zone] | None:
+        """The (origin, zone) parsed since the last call, if any"""
+        with self.lock:
+            pending, self.pending = self.pending, None
+        if pending is not None:
+            self.origin, self.zone = pending
+            self.reloads += 1
+        return pending
+
+
+class StreamConnection:
+    """
+    A DNS-over-TCP client connection, with messages prefixed by their length
+    Any number of queries may be pipelined; each is answered as soon as it is
+    complete, and the responses wait in `outgoing` until the socket takes them
+    """
+
+    __slots__ = ("sock", "incoming", "outgoing", "deadline")
+
+    def __init__(self, sock: socket, deadline: float):
+        self.sock = sock
+        self.incoming = bytearray()
+        self.outgoing = bytearray()
+        self.deadline = deadline
+
+    def receive(self) -> list[bytes] | None:
+        """
+        Read what has arrived and return the complete queries
+        Return None once the client has closed the connection
+        """
+        try:
+            data = self.sock.recv(TCP_RECV_SIZE)
+        except BlockingIOError:
+            return []
+        except OSError as os_err:
+            logging.debug(f"Receive failed: {os_err}")
+            return None
+        if not data:
+            return None
+        self.incoming += data
+        messages, pos = [], 0
+        while len(self.incoming) - pos >= 2:
+            size = bytes_to_val(self.incoming[pos : pos + 2])
+            if len(self.incoming) - pos - 2 < size:
+                break
+            messages.append(bytes(self.incoming[pos + 2 : pos + 2 + size]))
+            pos += 2 + size
+        del self.incoming[:pos]
+        return messages
+
+    def queue(self, msg_resp: bytes) -> None:
+        """
+        Add a response to the output
+        Raise OverflowError for a response too long for the length prefix
+        """
+        self.outgoing += len(msg_resp).to_bytes(2, "big")
+        self.outgoing += msg_resp
+
+    def flush(self) -> bool:
+        """
+        Send as much of the output as the socket accepts
+        Return True once all of it has been sent
+        """
+        if self.outgoing:
             try:
-                trans_id, domain, qry_type, qry = parse_request(origin, request_msg)
-                msg_resp = format_response(zone, trans_id, domain, qry_type, qry)
-                server_sckt.sendto(msg_resp, client_addr)
-            except ValueError as v_err:
-                print(f"Ignoring the request: {v_err}")
+                sent = self.sock.send(self.outgoing)
+            except BlockingIOError:
+                return False
+            del self.outgoing[:sent]
+        return not self.outgoing
+
+    @property
+    def events(self) -> int:
+        """The readiness to wait for: no more reading while the output is backed up"""
+        if not self.outgoing:
+            return selectors.EVENT_READ
+        if len(self.outgoing) >= TCP_MAX_PENDING:
+            return selectors.EVENT_WRITE
+        return selectors.EVENT_READ | selectors.EVENT_WRITE
+
+
+def serve(
+    sock: socket,
+    origin: str,
+    zone: Zone,
+    cache: AnswerCache | None,
+    stats: Counter,
+    report=None,
+    loader: ZoneLoader | None = None,
+    listener: socket | None = None,
+    idle_timeout: float = TCP_IDLE_TIMEOUT,
+    query_stats: QueryStats | None = None,
+    stats_file: str | None = None,
+    limiter: RateLimiter | None = None,
+) -> None:
+    """
+    Answer queries until interrupted
+    Every wakeup drains up to `RECV_BATCH` datagrams from the non-blocking socket
+    into preallocated buffers before answering them; responses too long for a
+    datagram are truncated
+    With a `listener`, queries are also accepted over TCP, where responses are
+    sent whole up to `MAX_TCP_RESPONSE` bytes and truncated beyond; connections without a query for `idle_timeout` seconds are closed
+    `report` is called with a snapshot of the stats every `STATS_INTERVAL` seconds
+    A zone reloaded by the `loader` replaces the current one between batches,
+    together with flushing the cache
+    With `query_stats`, every question is recorded; the stats are the answer to
+    a `stats.bind.` CHAOS TXT query and are written to `stats_file` every
+    `STATS_DUMP_INTERVAL` seconds; a failed write is logged and counted
+    With a `limiter`, a UDP client prefix over its rate gets its queries dropped
+    unanswered or slipped a truncated response; TCP clients are not limited
+    """
+
+    def respond(request_msg: bytes) -> bytes | None:
+        stats["queries"] += 1
+        try:
+            return answer_query(origin, zone, cache, request_msg, query_stats)
+        except ValueError as v_err:
+            if query_stats is not None:
+                msg_resp = stats_response(request_msg, query_stats)
+                if msg_resp is not None:
+                    stats["stats_queries"] += 1
+                    return msg_resp
+                query_stats.ignored += 1
+            stats["ignored"] += 1
+            logging.debug(f"Ignoring the request: {v_err}")
+            return None
+
+    def dump() -> None:
+        try:
+            query_stats.dump(stats_file)
+        except OSError as os_err:
+            stats["stats_dump_errors"] += 1
+            logging.warning(f"Cannot write the query stats to {stats_file}: {os_err}")
+
+    def close(conn: StreamConnection) -> None:
+        selector.unregister(conn.sock)
+        conn.sock.close()
+        connections.discard(conn)
+
+    def accept() -> None:
+        try:
+            client_sock, _ = listener.accept()
+        except OSError as os_err:
+            logging.debug(f"Accept failed: {os_err}")
+            return
+        if len(connections) >= TCP_MAX_CONNECTIONS:
+            stats["tcp_refused"] += 1
+            client_sock.close()
+            return
+        client_sock.setblocking(False)
+        conn = StreamConnection(client_sock, monotonic() + idle_timeout)
+        connections.add(conn)
+        selector.register(client_sock, selectors.EVENT_READ, conn)
+        stats["tcp_connections"] += 1
+
+    def exchange(conn: StreamConnection, mask: int) -> None:
+        if mask & selectors.EVENT_READ:
+            messages = conn.receive()
+            if messages is None:
+                close(conn)
+                return
+            if messages:
+                conn.deadline = monotonic() + idle_timeout
+            for request_msg in messages:
+                msg_resp = respond(request_msg)
+                if msg_resp is None:
+                    continue
+                if len(msg_resp) > MAX_TCP_RESPONSE:
+                    msg_resp = truncate(msg_resp, MAX_TCP_RESPONSE)
+                    stats["truncated"] += 1
+                try:
+                    conn.queue(msg_resp)
+                except OverflowError as o_err:
+                    stats["send_errors"] += 1
+                    logging.warning(f"Cannot send the response: {o_err}")
+                    close(conn)
+                    return
+                stats["answered"] += 1
+                stats["tcp_answered"] += 1
+        try:
+            conn.flush()
+        except OSError as os_err:
+            stats["send_errors"] += 1
+            logging.debug(f"Send failed: {os_err}")
+            close(conn)
+            return
+        selector.modify(conn.sock, conn.events, conn)
+
+    sock.setblocking(False)
+    selector = selectors.DefaultSelector()
+    selector.register(sock, selectors.EVENT_READ)
+    if listener is not None:
+        listener.setblocking(False)
+        selector.register(listener, selectors.EVENT_READ)
+    connections: set[StreamConnection] = set()
+    buffers = [memoryview(bytearray(MAX_DATAGRAM)) for _ in range(RECV_BATCH)]
+    next_report = monotonic() + STATS_INTERVAL
+    next_dump = monotonic() + STATS_DUMP_INTERVAL
+    try:
+        while True:
+            batch, ready = [], []
+            for key, mask in selector.select(STATS_INTERVAL):
+                if key.fileobj is sock:
+                    for buffer in buffers:
+                        try:
+                            n_bytes, client_addr = sock.recvfrom_into(buffer)
+                        except BlockingIOError:
+                            break
+                        except OSError as os_err:
+                            logging.debug(f"Receive failed: {os_err}")
+                            continue
+                        batch.append((buffer[:n_bytes], client_addr))
+                    stats["wakeups"] += 1
+                else:
+                    ready.append((key, mask))
+            if loader is not None and (update := loader.take()) is not None:
+                origin, zone = update
+                if cache is not None:
+                    cache.clear()
+                stats["reloads"] += 1
+                logging.info(f"Reloaded the zone of {origin}")
+            now = monotonic()
+            for request_msg, client_addr in batch:
+                verdict = (
+                    "answer" if limiter is None else limiter.check(client_addr, now)
+                )
+                if verdict == "answer":
+                    msg_resp = respond(bytes(request_msg))
+                else:
+                    stats["queries"] += 1
+                    msg_resp = None
+                    if verdict == "slip":
+                        msg_resp = slip_response(bytes(request_msg))
+                    stats["rrl_dropped" if msg_resp is None else "rrl_slipped"] += 1
+                if msg_resp is None:
+                    continue
+                if len(msg_resp) > MAX_UDP_RESPONSE:
+                    msg_resp = truncate(msg_resp)
+                    stats["truncated"] += 1
+                try:
+                    sock.sendto(msg_resp, client_addr)
+                    stats["answered"] += 1
+                except OSError as os_err:
+                    stats["send_errors"] += 1
+                    logging.debug(f"Send failed: {os_err}")
+            for key, mask in ready:
+                if key.fileobj is listener:
+                    accept()
+                else:
+                    exchange(key.data, mask)
+            if monotonic() >= next_report:
+                now = monotonic()
+                for conn in [conn for conn in connections if conn.deadline <= now]:
+                    stats["tcp_timeouts"] += 1
+                    close(conn)
+                if limiter is not None:
+                    limiter.expire(now)
+                if report is not None:
+                    report(snapshot(stats, cache))
+                if stats_file and query_stats is not None and now >= next_dump:
+                    dump()
+                    next_dump = now + STATS_DUMP_INTERVAL
+                next_report = now + STATS_INTERVAL
+    finally:
+        for conn in list(connections):
+            close(conn)
+        selector.close()
+        if stats_file and query_stats is not None:
+            dump()
+
+
+def snapshot(stats: Counter, cache: AnswerCache | None) -> dict:
+    """The counters of a server, including those of its cache"""
+    if cache is None:
+        return dict(stats)
+    return {**stats, "cache_hits": cache.hits, "cache_misses": cache.misses}
+
+
+def bind_socket(reuse_port: bool = False, kind: int = SOCK_DGRAM) -> socket:
+    """The UDP socket of the server, or its TCP listener on the same port"""
+    sock = socket(AF_INET, kind)
+    if reuse_port:
+        sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+    if kind == SOCK_STREAM:
+        # Must precede bind() to take over a port held by closed connections
+        sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+    sock.bind((HOST, PORT))
+    if kind == SOCK_STREAM:
+        sock.listen(TCP_BACKLOG)
+    return sock
+
+
+def print_stats(stats: dict) -> None:
+    """Print the counters of the server"""
+    print(", ".join(f"{name}: {value}" for name, value in sorted(stats.items())))
+
+
+def run(
+    filename: str,
+    cache_size: int = CACHE_MAX_ENTRIES,
+    reload_interval: float = RELOAD_INTERVAL,
+    top_capacity: int = TOP_CAPACITY,
+    stats_file: str | None = None,
+    rrl_rate: float = RRL_RATE,
+    rrl_slip: int = RRL_SLIP,
+) -> None:
+    """Main server loop"""
+    loader = ZoneLoader(filename, reload_interval).start()
+    signal(SIGHUP, loader.request_reload)
+    cache = AnswerCache(cache_size) if cache_size > 0 else None
+    query_stats = QueryStats(top_capacity) if top_capacity > 0 else None
+    limiter = RateLimiter(rrl_rate, rrl_slip) if rrl_rate > 0 else None
+    stats: Counter = Counter()
+    with bind_socket() as server_sckt, bind_socket(kind=SOCK_STREAM) as listener:
+        print("Listening on %s:%d" % (HOST, PORT))
+        try:
+            serve(
+                server_sckt,
+                loader.origin,
+                loader.zone,
+                cache,
+                stats,
+                loader=loader,
+                listener=listener,
+                query_stats=query_stats,
+                stats_file=stats_file,
+                limiter=limiter,
+            )
+        except KeyboardInterrupt:
+            print("Quitting")
+        finally:
+            loader.stop()
+    print_stats(snapshot(stats, cache))
+
+
+def interrupt_once(signum, frame) -> None:
+    """Raise KeyboardInterrupt and ignore further interrupts during the shutdown"""
+    signal(SIGINT, SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def worker_loop(
+    filename: str,
+    cache_size: int,
+    reload_interval: float,
+    top_capacity: int,
+    stats_file: str | None,
+    rrl_rate: float,
+    rrl_slip: int,
+    conn: Connection,
+) -> None:
+    """
+    Serve on SO_REUSEPORT sockets in a worker process until interrupted
+    Send the stats to the supervisor through `conn`
+    """
+    signal(SIGINT, interrupt_once)
+    signal(SIGTERM, SIG_DFL)  # Left to the supervisor to stop a stuck worker
+    pthread_sigmask(SIG_UNBLOCK, STOP_SIGNALS)
+    loader = ZoneLoader(filename, reload_interval).start()
+    signal(SIGHUP, loader.request_reload)
+    pthread_sigmask(SIG_UNBLOCK, {SIGHUP})  # Held by the supervisor until now
+    cache = AnswerCache(cache_size) if cache_size > 0 else None
+    query_stats = QueryStats(top_capacity) if top_capacity > 0 else None
+    limiter = RateLimiter(rrl_rate, rrl_slip) if rrl_rate > 0 else None
+    stats: Counter = Counter()
+    try:
+        with bind_socket(reuse_port=True) as sock, bind_socket(
+            reuse_port=True, kind=SOCK_STREAM
+        ) as listener:
+            serve(
+                sock,
+                loader.origin,
+                loader.zone,
+                cache,
+                stats,
+                conn.send,
+                loader,
+                listener,
+                query_stats=query_stats,
+                stats_file=stats_file,
+                limiter=limiter,
+            )
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loader.stop()
+        conn.send(snapshot(stats, cache))
+        conn.close()
+
+
+def supervise(
+    n_workers: int,
+    filename: str,
+    cache_size: int,
+    reload_interval: float,
+    totals: Counter,
+    top_capacity: int = TOP_CAPACITY,
+    stats_file: str | None = None,
+    rrl_rate: float = RRL_RATE,
+    rrl_slip: int = RRL_SLIP,
+) -> None:
+    """
+    Run `n_workers` processes, each receiving on its own SO_REUSEPORT sockets
+    Restart workers that exit and stop all of them on KeyboardInterrupt or SIGTERM
+    Pass SIGHUP on to the workers so that they reload the zone
+    Add the stats of every worker to `totals` once it has stopped
+    Worker n writes its query stats to `stats_file` suffixed with `.n`
+    Every worker limits responses on its own, so a client prefix spread over
+    several workers by the kernel may get up to `n_workers` times `rrl_rate`
+    """
+
+    def start(n: int) -> None:
+        reader, writer = multiprocessing.Pipe(duplex=False)
+        worker_file = f"{stats_file}.{n}" if stats_file else None
+        worker = multiprocessing.Process(
+            target=worker_loop,
+            args=(
+                filename,
+                cache_size,
+                reload_interval,
+                top_capacity,
+                worker_file,
+                rrl_rate,
+                rrl_slip,
+                writer,
+            ),
+            name=f"worker-{n}",
+        )
+        # Held until the worker is recorded: an interrupt raised in the fork handlers
+        # is lost, and one raised before the worker is recorded leaves it running
+        # SIGHUP stays held in the worker until it has a loader to reload
+        held = {*STOP_SIGNALS, SIGHUP}
+        pthread_sigmask(SIG_BLOCK, held)
+        try:
+            worker.start()
+            workers[n] = worker
+            started[n] = monotonic()
+            readers[n] = reader
+        finally:
+            writer.close()
+            pthread_sigmask(SIG_UNBLOCK, held)
+
+    def collect(n: int) -> None:
+        try:
+            while readers[n].poll():
+                latest[n] = readers[n].recv()
+        except (EOFError, OSError):
+            pass
+
+    def reload_workers(signum, frame) -> None:
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, SIGHUP)
+
+    def retire(n: int) -> None:
+        collect(n)
+        totals.update(latest.pop(n, {}))
+        readers.pop(n).close()
+
+    started: dict[int, float] = {}
+    readers: dict[int, Connection] = {}
+    latest: dict[int, dict] = {}
+    workers: dict[int, multiprocessing.Process] = {}
+    signal(SIGTERM, interrupt_once)
+    signal(SIGHUP, reload_workers)
+    try:
+        for n in range(n_workers):
+            start(n)
+        while True:
+            wait([*readers.values(), *(worker.sentinel for worker in workers.values())])
+            for n, worker in list(workers.items()):
+                collect(n)
+                if worker.is_alive():
+                    continue
+                logging.warning(
+                    f"{worker.name} (pid {worker.pid}) exited with code {worker.exitcode}, restarting"
+                )
+                del workers[n]
+                retire(n)
+                if monotonic() - started[n] < RESTART_DELAY:
+                    sleep(RESTART_DELAY)
+                start(n)
+    finally:
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, SIGINT)
+        for n, worker in workers.items():
+            worker.join(SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
+            retire(n)
 
 
 def main():
     """Main function"""
     arg_parser = argparse.ArgumentParser(description="Parse arguments")
     arg_parser.add_argument("zone_file", type=str, help="Zone file")
+    arg_parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Questions kept by the answer cache (0 disables it)",
+        default=CACHE_MAX_ENTRIES,
+    )
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes sharing the port (0 serves in this process)",
+        default=0,
+    )
+    arg_parser.add_argument(
+        "--reload-interval",
+        type=float,
+        help="Seconds between checks of the zone file for changes (0 reloads on SIGHUP only)",
+        default=RELOAD_INTERVAL,
+    )
+    arg_parser.add_argument(
+        "--top-capacity",
+        type=int,
+        help="Questions tracked by the query stats (0 disables them)",
+        default=TOP_CAPACITY,
+    )
+    arg_parser.add_argument(
+        "--stats-file",
+        type=str,
+        help=f"Write the query stats to this file every {STATS_DUMP_INTERVAL:g} seconds",
+    )
+    arg_parser.add_argument(
+        "--rrl-rate",
+        type=float,
+        help="UDP responses per second to each client /24 or /56 (0 disables the limit)",
+        default=RRL_RATE,
+    )
+    arg_parser.add_argument(
+        "--rrl-slip",
+        type=int,
+        help="Send every n-th limited response truncated instead of dropping it (0 drops all)",
+        default=RRL_SLIP,
+    )
     arg_parser.add_argument(
         "-d", "--debug", action="store_true", help="Enable logging.DEBUG mode"
     )
@@ -130,7 +1627,34 @@ def main():
         logger.setLevel(logging.WARNING)
     logging.basicConfig(format="%(levelname)s: %(message)s", level=logger.level)
 
-    run(args.zone_file)
+    if args.workers > 0:
+        stats: Counter = Counter()
+        print("Listening on %s:%d with %d workers" % (HOST, PORT, args.workers))
+        try:
+            supervise(
+                args.workers,
+                args.zone_file,
+                args.cache_size,
+                args.reload_interval,
+                stats,
+                args.top_capacity,
+                args.stats_file,
+                args.rrl_rate,
+                args.rrl_slip,
+            )
+        except KeyboardInterrupt:
+            print("Quitting")
+        print_stats(stats)
+    else:
+        run(
+            args.zone_file,
+            args.cache_size,
+            args.reload_interval,
+            args.top_capacity,
+            args.stats_file,
+            args.rrl_rate,
+            args.rrl_slip,
+        )
 
 
 if __name__ == "__main__":
@@ -0,0 +1,440 @@
+#!/usr/bin/env python3
+"""
+Load generator for the web server
+
+@authors:
+@version:
+"""
+
+import argparse
+import errno
+import json
+import logging
+import random
+import selectors
+import socket
+from collections import Counter, deque
+from time import perf_counter
+
+SRVR_ADDR = "127.0.0.2"
+SRVR_PORT = 43080
+
+# The paths exercised by the web server tests, one for each status code
+DEFAULT_MIX = (
+    "GET:/alice30.txt=6,GET:/test.txt=2,GET:/test404.txt=1,"
+    "POST:/test405.txt=1,HEAD:/test501.txt=1"
+)
+RECV_SIZE = 64 * 1024
+TIMEOUT_CHECK_INTERVAL = 0.1
+
+
+def parse_mix(mix: str) -> list[tuple[str, str, float]]:
+    """
+    Parse a request mix such as `GET:/alice30.txt=6,POST:/test405.txt=1`
+    Return a list of (method, path, weight)
+    """
+    targets = []
+    for item in mix.split(","):
+        target, _, weight = item.strip().partition("=")
+        method, sep, path = target.partition(":")
+        if not sep or not path.startswith("/"):
+            raise ValueError(f"Invalid mix item: {item!r}")
+        targets.append((method.upper(), path, float(weight or 1)))
+    return targets
+
+
+def format_request(method: str, path: str, host: str, keep_alive: bool) -> bytes:
+    """Format a request without a body"""
+    connection = "keep-alive" if keep_alive else "close"
+    return (
+        f"{method} {path} HTTP/1.1\r\nHost: {host}\r\n"
+        f"User-Agent: cs430-loadgen\r\nConnection: {connection}\r\n\r\n"
+    ).encode()
+
+
+def percentile(ordered: list[float], pct: float) -> float:
+    """Nearest-rank percentile of already sorted values"""
+    if not ordered:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(ordered) + 0.5 - 1e-9))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+class ResponseReader:
+    """
+    Incremental reader of one response
+    Tells when the response is complete, whether it is framed by Content-Length,
+    chunked encoding, or the end of the connection
+    """
+
+    __slots__ = ("buffer", "status", "head_only", "body_left", "chunked", "keep_alive")
+
+    def __init__(self, head_only: bool = False):
+        self.buffer = bytearray()
+        self.status = 0
+        self.head_only = head_only
+        self.body_left: int | None = None
+        self.chunked = False
+        self.keep_alive = True
+
+    def feed(self, data: bytes) -> bool:
+        """
+        Add received data; return True once the response is complete
+        Raise `ValueError` if the response is malformed
+        """
+        self.buffer += data
+        if not self.status:
+            end = self.buffer.find(b"\r\n\r\n")
+            if end == -1:
+                return False
+            self.parse_head(bytes(self.buffer[:end]))
+            del self.buffer[: end + 4]
+        if self.chunked:
+            return self.skip_chunks()
+        if self.body_left is None:
+            return False
+        self.body_left -= len(self.buffer)
+        self.buffer.clear()
+        return self.body_left <= 0
+
+    def parse_head(self, head: bytes) -> None:
+        """Read the status code and the framing of the body"""
+        lines = head.split(b"\r\n")
+        parts = lines[0].split(b" ", 2)
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/"):
+            raise ValueError(f"Malformed status line: {lines[0]!r}")
+        self.status = int(parts[1])
+        if parts[0] == b"HTTP/1.0":
+            self.keep_alive = False
+        fields = {}
+        for line in lines[1:]:
+            field, _, value = line.partition(b":")
+            fields[field.strip().lower()] = value.strip().lower()
+        if fields.get(b"connection") == b"close":
+            self.keep_alive = False
+        if self.head_only or self.status in (204, 304) or self.status < 200:
+            self.body_left = 0
+        elif fields.get(b"transfer-encoding", b"").endswith(b"chunked"):
+            self.chunked = True
+        elif b"content-length" in fields:
+            self.body_left = int(fields[b"content-length"])
+        else:
+            self.keep_alive = False
+
+    def skip_chunks(self) -> bool:
+        """Consume complete chunks; True after the last chunk and trailer"""
+        while True:
+            if self.body_left:
+                skipped = min(self.body_left, len(self.buffer))
+                del self.buffer[:skipped]
+                self.body_left -= skipped
+                if self.body_left:
+                    return False
+            line_end = self.buffer.find(b"\r\n")
+            if line_end == -1:
+                return False
+            if self.body_left == 0:
+                # CRLF that ends the previous chunk's data
+                del self.buffer[:2]
+                self.body_left = None
+                continue
+            size = int(bytes(self.buffer[:line_end]).split(b";")[0], 16)
+            if size == 0:
+                if self.buffer.find(b"\r\n\r\n", line_end) == -1:
+                    return False
+                self.buffer.clear()
+                return True
+            del self.buffer[: line_end + 2]
+            self.body_left = size
+
+    def finish(self) -> bool:
+        """Return True if the end of the connection completes the response"""
+        return bool(self.status) and self.body_left is None and not self.chunked
+
+
+class Client:
+    """A connection of the load generator and the request it is waiting on"""
+
+    __slots__ = ("sock", "reader", "outbuf", "started", "received")
+
+    def __init__(self, addr: tuple[str, int]):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setblocking(False)
+        err = self.sock.connect_ex(addr)
+        if err not in (0, errno.EINPROGRESS):
+            self.sock.close()
+            raise ConnectionRefusedError(err, errno.errorcode.get(err, str(err)))
+        self.reader: ResponseReader | None = None
+        self.outbuf = memoryview(b"")
+        self.started = 0.0
+        self.received = 0
+
+    def begin(self, request: bytes, head_only: bool, started: float) -> None:
+        """Start a request; `started` is when it was due"""
+        self.reader = ResponseReader(head_only)
+        self.outbuf = memoryview(request)
+        self.started = started
+        self.received = 0
+
+
+def run_load(
+    addr: tuple[str, int],
+    targets: list[tuple[str, str, float]],
+    concurrency: int = 10,
+    duration: float = 10.0,
+    total: int = 0,
+    rate: float = 0.0,
+    keep_alive: bool = True,
+    timeout: float = 5.0,
+    seed: int | None = None,
+) -> dict:
+    """
+    Drive the server and return the report
+    With `rate` 0 each of `concurrency` connections sends its next request as
+    soon as the previous one is answered, and a connection that fails is
+    replaced by a new one (closed loop); otherwise requests are
+    due at a fixed rate on up to `concurrency` connections (open loop) and
+    latency is measured from when a request was due, so queueing is included
+    """
+    rng = random.Random(seed)
+    requests = [
+        (format_request(method, path, addr[0], keep_alive), method == "HEAD")
+        for method, path, _ in targets
+    ]
+    weights = [weight for _, _, weight in targets]
+    sel = selectors.DefaultSelector()
+    recv_buf = bytearray(RECV_SIZE)
+    latencies: list[float] = []
+    statuses: Counter[int] = Counter()
+    errors: Counter[str] = Counter()
+    active: set[Client] = set()
+    idle: list[Client] = []
+    due: deque[float] = deque()
+    issued = 0
+    received = 0
+
+    start = perf_counter()
+    stop_issuing = start + duration if duration else float("inf")
+    next_due = start
+    next_timeout_check = start + TIMEOUT_CHECK_INTERVAL
+
+    def may_issue(now: float) -> bool:
+        return (not total or issued < total) and now < stop_issuing
+
+    def issue(client: Client | None, started: float) -> None:
+        nonlocal issued
+        request, head_only = rng.choices(requests, weights)[0]
+        if client is None:
+            try:
+                client = Client(addr)
+            except OSError as os_err:
+                errors[type(os_err).__name__] += 1
+                return
+            sel.register(client.sock, selectors.EVENT_WRITE, client)
+        else:
+            sel.modify(client.sock, selectors.EVENT_WRITE, client)
+        client.begin(request, head_only, started)
+        active.add(client)
+        issued += 1
+
+    def drop(client: Client, error: str | None = None) -> None:
+        waiting = client in active
+        sel.unregister(client.sock)
+        client.sock.close()
+        active.discard(client)
+        if client in idle:
+            idle.remove(client)
+        if error:
+            errors[error] += 1
+            now = perf_counter()
+            if waiting and not rate and may_issue(now):
+                # Keep the offered concurrency while the server is failing
+                issue(None, now)
+
+    def complete(client: Client, now: float) -> None:
+        nonlocal received
+        latencies.append(now - client.started)
+        statuses[client.reader.status] += 1
+        received += client.received
+        active.discard(client)
+        if not (keep_alive and client.reader.keep_alive):
+            drop(client)
+            client = None
+        if rate and due:
+            issue(client, due.popleft())
+        elif not rate and may_issue(now):
+            issue(client, now)
+        elif client is not None:
+            client.reader = None
+            sel.modify(client.sock, selectors.EVENT_READ, client)
+            if rate:
+                idle.append(client)
+
+    if not rate:
+        for _ in range(concurrency):
+            issue(None, start)
+
+    try:
+        while True:
+            now = perf_counter()
+            if rate:
+                while next_due <= now and may_issue(next_due):
+                    if idle:
+                        issue(idle.pop(), next_due)
+                    elif len(active) < concurrency:
+                        issue(None, next_due)
+                    else:
+                        due.append(next_due)
+                    next_due += 1 / rate
+            if not active and not due and not (rate and may_issue(next_due)):
+                break
+            if now >= next_timeout_check:
+                for client in [c for c in active if now - c.started > timeout]:
+                    drop(client, "Timeout")
+                next_timeout_check = now + TIMEOUT_CHECK_INTERVAL
+            wait = TIMEOUT_CHECK_INTERVAL
+            if rate and may_issue(next_due):
+                wait = min(wait, max(0.0, next_due - now))
+            for key, mask in sel.select(wait):
+                client = key.data
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        sent = client.sock.send(client.outbuf)
+                        client.outbuf = client.outbuf[sent:]
+                        if not client.outbuf:
+                            sel.modify(client.sock, selectors.EVENT_READ, client)
+                        continue
+                    n_bytes = client.sock.recv_into(recv_buf)
+                except BlockingIOError:
+                    continue
+                except OSError as os_err:
+                    drop(client, type(os_err).__name__)
+                    continue
+                if client.reader is None:
+                    # The server closed an idle connection
+                    drop(client)
+                    continue
+                if n_bytes == 0:
+                    if client.reader.finish():
+                        client.reader.keep_alive = False
+                        complete(client, perf_counter())
+                    else:
+                        drop(client, "ConnectionClosed")
+                    continue
+                client.received += n_bytes
+                try:
+                    done = client.reader.feed(recv_buf[:n_bytes])
+                except ValueError:
+                    drop(client, "MalformedResponse")
+                    continue
+                if done:
+                    complete(client, perf_counter())
+    finally:
+        for key in list(sel.get_map().values()):
+            key.fileobj.close()
+        sel.close()
+
+    elapsed = perf_counter() - start
+    latencies.sort()
+    return {
+        "mode": "open" if rate else "closed",
+        "concurrency": concurrency,
+        "rate": rate,
+        "keep_alive": keep_alive,
+        "requests": len(latencies),
+        "errors": dict(errors),
+        "status": {str(code): count for code, count in sorted(statuses.items())},
+        "duration": round(elapsed, 3),
+        "throughput": round(len(latencies) / elapsed, 1) if elapsed else 0.0,
+        "bytes_received": received,
+        "latency_ms": {
+            name: round(value * 1000, 3)
+            for name, value in (
+                ("p50", percentile(latencies, 50)),
+                ("p90", percentile(latencies, 90)),
+                ("p99", percentile(latencies, 99)),
+                ("max", latencies[-1] if latencies else 0.0),
+            )
+        },
+    }
+
+
+def print_report(report: dict) -> None:
+    """Print the report in a human-readable form"""
+    print(f"{'Mode:':14s}{report['mode']} loop, {report['concurrency']} connections")
+    print(f"{'Requests:':14s}{report['requests']} in {report['duration']} s")
+    print(f"{'Throughput:':14s}{report['throughput']} req/s")
+    print(f"{'Status:':14s}{report['status']}")
+    print(f"{'Errors:':14s}{report['errors']}")
+    latency = report["latency_ms"]
+    print(
+        f"{'Latency (ms):':14s}p50 {latency['p50']}  p90 {latency['p90']}  "
+        f"p99 {latency['p99']}  max {latency['max']}"
+    )
+
+
+def main():
+    """Set up arguments and run the load"""
+    arg_parser = argparse.ArgumentParser(description="Load the web server")
+    arg_parser.add_argument(
+        "--host", type=str, default=SRVR_ADDR, help="Server address"
+    )
+    arg_parser.add_argument("--port", type=int, default=SRVR_PORT, help="Server port")
+    arg_parser.add_argument(
+        "-c", "--concurrency", type=int, default=10, help="Number of connections"
+    )
+    arg_parser.add_argument(
+        "-t", "--duration", type=float, default=10.0, help="Seconds to run"
+    )
+    arg_parser.add_argument(
+        "-n", "--requests", type=int, default=0, help="Stop after this many requests"
+    )
+    arg_parser.add_argument(
+        "-r",
+        "--rate",
+        type=float,
+        default=0.0,
+        help="Requests per second (open loop); 0 runs a closed loop",
+    )
+    arg_parser.add_argument(
+        "--no-keep-alive", action="store_true", help="Use a connection per request"
+    )
+    arg_parser.add_argument(
+        "-m", "--mix", type=str, default=DEFAULT_MIX, help="Weighted METHOD:path list"
+    )
+    arg_parser.add_argument(
+        "--timeout", type=float, default=5.0, help="Seconds to wait for a response"
+    )
+    arg_parser.add_argument("--seed", type=int, help="Seed of the request mix")
+    arg_parser.add_argument("-j", "--json", type=str, help="Write the report to a file")
+    arg_parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable logging.DEBUG mode"
+    )
+    args = arg_parser.parse_args()
+
+    logger = logging.getLogger("root")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.WARNING)
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logger.level)
+
+    report = run_load(
+        (args.host, args.port),
+        parse_mix(args.mix),
+        concurrency=args.concurrency,
+        duration=args.duration,
+        total=args.requests,
+        rate=args.rate,
+        keep_alive=not args.no_keep_alive,
+        timeout=args.timeout,
+        seed=args.seed,
+    )
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
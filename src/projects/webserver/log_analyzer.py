@@ -0,0 +1,396 @@
+#!/usr/bin/env python3
+"""
+Constant-memory analyzer of the web server log
+
+@authors:
+@version:
+"""
+
+import argparse
+import gzip
+import heapq
+import json
+import logging
+import math
+import os
+from collections import deque
+from datetime import datetime, timedelta
+from hashlib import blake2b
+from pathlib import Path
+from time import monotonic, sleep
+from typing import Iterator
+
+LOG_FILE = "src/projects/webserver/webserver.log"
+TOP_CAPACITY = 1000  # Keys tracked by each heavy-hitter sketch
+AGENT_CAPACITY = 100
+HLL_PRECISION = 14  # 2**14 registers, about 0.8% standard error
+RECENT_WINDOW = 60  # Seconds covered by the current request rate
+POLL_INTERVAL = 0.5  # Seconds between checks of a followed file
+REPORT_INTERVAL = 10.0
+
+# Checked in order against the lowercase User-Agent; browsers mention the
+# engines they are compatible with, so the more specific tokens come first
+AGENT_FAMILIES = (
+    ("bot", "Bot"),
+    ("spider", "Bot"),
+    ("crawl", "Bot"),
+    ("curl/", "curl"),
+    ("wget/", "Wget"),
+    ("python-requests/", "python-requests"),
+    ("python-urllib/", "Python-urllib"),
+    ("cs430-loadgen", "loadgen"),
+    ("edg/", "Edge"),
+    ("opr/", "Opera"),
+    ("firefox/", "Firefox"),
+    ("chrome/", "Chrome"),
+    ("safari/", "Safari"),
+)
+
+
+def parse_line(line: str) -> tuple[str, str, str, str] | None:
+    """
+    Split a log record into (timestamp, path, client IP, user agent)
+    Return None if the line is not a record, including one whose timestamp
+    cannot be read back
+    """
+    fields = line.rstrip("\r\n").split(" | ", 3)
+    if len(fields) != 4 or len(fields[0]) < 19:
+        return None
+    try:
+        datetime.fromisoformat(fields[0])
+    except ValueError:
+        return None
+    return fields[0], fields[1], fields[2], fields[3]
+
+
+def agent_family(user_agent: str) -> str:
+    """Reduce a User-Agent to the client family that sent it"""
+    agent = user_agent.lower()
+    for token, family in AGENT_FAMILIES:
+        if token in agent:
+            return family
+    product = user_agent.split("/", 1)[0].strip()
+    return product.split()[0] if product else "unknown"
+
+
+class SpaceSaving:
+    """
+    Heavy-hitter counter that tracks at most `capacity` keys
+    A new key replaces the least counted one and inherits its count as the
+    possible overestimate, so every key seen more than N/capacity times is kept
+    """
+
+    __slots__ = ("capacity", "counts", "heap")
+
+    def __init__(self, capacity: int = TOP_CAPACITY):
+        self.capacity = capacity
+        self.counts: dict[str, list[int]] = {}  # key -> [count, error]
+        self.heap: list[tuple[int, str]] = []  # One entry per key, possibly stale
+
+    def add(self, key: str, weight: int = 1) -> None:
+        """Count an occurrence of the key"""
+        counter = self.counts.get(key)
+        if counter is not None:
+            counter[0] += weight
+            return
+        error = 0
+        if len(self.counts) >= self.capacity:
+            error = self.evict()
+        self.counts[key] = [error + weight, error]
+        heapq.heappush(self.heap, (error + weight, key))
+
+    def evict(self) -> int:
+        """Drop the least counted key and return its count"""
+        while True:
+            count, key = heapq.heappop(self.heap)
+            current = self.counts[key][0]
+            if current == count:
+                del self.counts[key]
+                return count
+            heapq.heappush(self.heap, (current, key))
+
+    def top(self, n: int) -> list[tuple[str, int, int]]:
+        """The `n` most frequent keys as (key, count, maximum overestimate)"""
+        ranked = heapq.nlargest(n, self.counts.items(), key=lambda item: item[1][0])
+        return [(key, count, error) for key, (count, error) in ranked]
+
+
+class HyperLogLog:
+    """Estimate of the number of distinct keys in 2**`precision` bytes"""
+
+    __slots__ = ("precision", "registers")
+
+    def __init__(self, precision: int = HLL_PRECISION):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key: str) -> None:
+        """Record a key"""
+        digest = blake2b(key.encode(), digest_size=8).digest()
+        value = int.from_bytes(digest, "big")
+        bits = 64 - self.precision
+        rest = value & ((1 << bits) - 1)
+        rank = bits - rest.bit_length() + 1
+        index = value >> bits
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self) -> int:
+        """Estimated number of distinct keys recorded"""
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0**-rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            estimate = m * math.log(m / zeros)  # Linear counting for small sets
+        return round(estimate)
+
+
+class LogStats:
+    """Summary of a stream of log records kept in bounded memory"""
+
+    def __init__(
+        self,
+        capacity: int = TOP_CAPACITY,
+        precision: int = HLL_PRECISION,
+        window: int = RECENT_WINDOW,
+    ):
+        self.requests = 0
+        self.skipped = 0
+        self.first: str | None = None
+        self.last: str | None = None
+        self.second: str | None = None
+        self.second_count = 0
+        self.peak_second: str | None = None
+        self.peak_count = 0
+        self.recent: deque[tuple[str, int]] = deque(maxlen=window)
+        self.paths = SpaceSaving(capacity)
+        self.clients = SpaceSaving(capacity)
+        self.agents = SpaceSaving(AGENT_CAPACITY)
+        self.distinct_paths = HyperLogLog(precision)
+        self.distinct_clients = HyperLogLog(precision)
+
+    def add(self, line: str) -> None:
+        """Account for a line of the log"""
+        record = parse_line(line)
+        if record is None:
+            self.skipped += 1
+            return
+        timestamp, path, client_ip, user_agent = record
+        self.requests += 1
+        if self.first is None:
+            self.first = timestamp
+        self.last = timestamp
+        second = timestamp[:19]
+        if second != self.second:
+            self.end_second()
+            self.second = second
+        self.second_count += 1
+        self.paths.add(path)
+        self.clients.add(client_ip)
+        self.agents.add(agent_family(user_agent))
+        self.distinct_paths.add(path)
+        self.distinct_clients.add(client_ip)
+
+    def end_second(self) -> None:
+        """Close the per-second count of the current second"""
+        if self.second is None:
+            return
+        if self.second_count > self.peak_count:
+            self.peak_second, self.peak_count = self.second, self.second_count
+        self.recent.append((self.second, self.second_count))
+        self.second_count = 0
+
+    def rates(self) -> dict:
+        """Overall, peak and recent requests per second"""
+        seconds = list(self.recent)
+        peak_second, peak_count = self.peak_second, self.peak_count
+        if self.second is not None:
+            seconds.append((self.second, self.second_count))
+            if self.second_count > peak_count:
+                peak_second, peak_count = self.second, self.second_count
+        duration = 0.0
+        if self.first is not None and self.last is not None:
+            duration = (
+                datetime.fromisoformat(self.last) - datetime.fromisoformat(self.first)
+            ).total_seconds()
+        recent_rate = 0.0
+        if seconds:
+            window = self.recent.maxlen
+            last = datetime.fromisoformat(seconds[-1][0])
+            cutoff = str(last - timedelta(seconds=window - 1))
+            recent = sum(count for second, count in seconds if second >= cutoff)
+            recent_rate = recent / window
+        return {
+            "duration": round(duration, 3),
+            "mean_rate": round(self.requests / max(duration, 1.0), 1),
+            "peak_rate": peak_count,
+            "peak_second": peak_second,
+            "recent_rate": round(recent_rate, 1),
+        }
+
+    def report(self, n: int = 10) -> dict:
+        """The summary as a dictionary"""
+        return {
+            "requests": self.requests,
+            "skipped": self.skipped,
+            "first": self.first,
+            "last": self.last,
+            **self.rates(),
+            "distinct_paths": self.distinct_paths.count(),
+            "distinct_clients": self.distinct_clients.count(),
+            "top_paths": self.paths.top(n),
+            "top_clients": self.clients.top(n),
+            "user_agents": self.agents.top(n),
+        }
+
+
+def open_log(path: Path):
+    """Open a log file as text, decompressing a gzipped rotated one"""
+    with open(path, "rb") as file:
+        compressed = file.read(2) == b"\x1f\x8b"
+    if compressed:
+        return gzip.open(path, "rt", encoding="utf-8", errors="replace")
+    return open(path, "r", encoding="utf-8", errors="replace")
+
+
+def read_lines(paths: list[Path]) -> Iterator[str]:
+    """Lines of the files in the given order"""
+    for path in paths:
+        with open_log(path) as file:
+            yield from file
+
+
+def follow(path: Path, poll_interval: float = POLL_INTERVAL) -> Iterator[str]:
+    """
+    Lines appended to a live log file, starting with the ones already there
+    Reopen the file when it is rotated or truncated
+    Yield an empty string whenever no new line has arrived for a while
+    """
+    file = open(path, "r", encoding="utf-8", errors="replace")
+    partial = ""
+    try:
+        while True:
+            line = file.readline()
+            if line.endswith("\n"):
+                yield partial + line
+                partial = ""
+                continue
+            partial += line
+            try:
+                stat = os.stat(path)
+            except FileNotFoundError:
+                stat = None
+            if stat is not None and (
+                stat.st_ino != os.fstat(file.fileno()).st_ino
+                or stat.st_size < file.tell()
+            ):
+                file.close()
+                file = open(path, "r", encoding="utf-8", errors="replace")
+                partial = ""
+                continue
+            yield ""
+            sleep(poll_interval)
+    finally:
+        file.close()
+
+
+def print_report(report: dict) -> None:
+    """Print the report in a human-readable form"""
+    print(f"{'Requests:':14s}{report['requests']} ({report['skipped']} skipped)")
+    print(f"{'Period:':14s}{report['first']} .. {report['last']}")
+    print(
+        f"{'Rate (req/s):':14s}mean {report['mean_rate']}  "
+        f"peak {report['peak_rate']} at {report['peak_second']}  "
+        f"last {RECENT_WINDOW} s {report['recent_rate']}"
+    )
+    print(
+        f"{'Distinct:':14s}~{report['distinct_paths']} paths, "
+        f"~{report['distinct_clients']} clients"
+    )
+    for title, key in (
+        ("Top paths", "top_paths"),
+        ("Top clients", "top_clients"),
+        ("User agents", "user_agents"),
+    ):
+        print(f"{title}:")
+        for name, count, error in report[key]:
+            bound = f" (+/-{error})" if error else ""
+            print(f"  {count:>10d}{bound}  {name}")
+
+
+def main():
+    """Set up arguments and analyze the log"""
+    arg_parser = argparse.ArgumentParser(description="Summarize the web server log")
+    arg_parser.add_argument(
+        "logfiles",
+        type=Path,
+        nargs="*",
+        default=[Path(LOG_FILE)],
+        help="Log files in chronological order, plain or gzipped",
+    )
+    arg_parser.add_argument(
+        "-n", "--top", type=int, default=10, help="Number of top entries to show"
+    )
+    arg_parser.add_argument(
+        "-k",
+        "--capacity",
+        type=int,
+        default=TOP_CAPACITY,
+        help="Keys tracked by each heavy-hitter counter",
+    )
+    arg_parser.add_argument(
+        "-f",
+        "--follow",
+        action="store_true",
+        help="Keep reading the last file as it grows",
+    )
+    arg_parser.add_argument(
+        "-i",
+        "--interval",
+        type=float,
+        default=REPORT_INTERVAL,
+        help="Seconds between reports while following",
+    )
+    arg_parser.add_argument(
+        "-j", "--json", type=str, help="Write the final report to a file"
+    )
+    arg_parser.add_argument(
+        "-d", "--debug", action="store_true", help="Enable logging.DEBUG mode"
+    )
+    args = arg_parser.parse_args()
+
+    logger = logging.getLogger("root")
+    if args.debug:
+        logger.setLevel(logging.DEBUG)
+    else:
+        logger.setLevel(logging.WARNING)
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=logger.level)
+
+    stats = LogStats(args.capacity)
+    try:
+        if args.follow:
+            for line in read_lines(args.logfiles[:-1]):
+                stats.add(line)
+            next_report = monotonic() + args.interval
+            for line in follow(args.logfiles[-1]):
+                if line:
+                    stats.add(line)
+                if monotonic() >= next_report:
+                    print_report(stats.report(args.top))
+                    print()
+                    next_report = monotonic() + args.interval
+        else:
+            for line in read_lines(args.logfiles):
+                stats.add(line)
+    except KeyboardInterrupt:
+        pass
+    report = stats.report(args.top)
+    print_report(report)
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as json_file:
+            json.dump(report, json_file, indent=2)
+
+
+if __name__ == "__main__":
+    main()
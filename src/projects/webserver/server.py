@@ -7,35 +7,1472 @@ Python Web server implementation
 """
 
 import argparse
+import gzip
 import logging
+import multiprocessing
+import os
+import queue
+import selectors
+import threading
+import zlib
+from collections import Counter, OrderedDict, deque
+from collections.abc import Iterable
 from datetime import datetime
+from email.utils import parsedate_to_datetime
+from errno import EINVAL, EMFILE, ENFILE, ENOBUFS, ENOMEM, ENOSYS, ENOTSOCK, EOPNOTSUPP
 from pathlib import Path
 from random import randint
-from socket import AF_INET, SOCK_STREAM, socket
-from time import sleep
+from resource import RLIM_INFINITY, RLIMIT_NOFILE, getrlimit
+from secrets import token_hex
+from multiprocessing.connection import wait
+from select import select
+from signal import (
+    SIG_BLOCK,
+    SIG_DFL,
+    SIG_IGN,
+    SIG_UNBLOCK,
+    SIGINT,
+    SIGTERM,
+    pthread_sigmask,
+    signal,
+)
+from socket import (
+    AF_INET,
+    IPPROTO_TCP,
+    SO_REUSEADDR,
+    SO_REUSEPORT,
+    SOCK_STREAM,
+    SOL_SOCKET,
+    TCP_NODELAY,
+    socket,
+)
+from time import monotonic, sleep, time
 
 SRVR_ADDR = "127.0.0.2"  # Local client is going to be 127.0.0.1
 SRVR_PORT = 43080  # Open http://127.0.0.2:43080 in a browser
-SRVR_NAME = ""
+SRVR_NAME = "CS430/2024"
+
+WEB_ROOT = Path("data/projects/webserver")
+LISTEN_BACKLOG = 512
+RECV_SIZE = 64 * 1024
+SEND_CHUNK = 256 * 1024  # Largest piece sent by one sendfile() or send() call
+MAX_GATHER = 64  # Most buffers passed to one sendmsg() call
+SENDFILE_UNSUPPORTED = {EINVAL, ENOSYS, ENOTSOCK, EOPNOTSUPP}  # Errors to fall back on
+MAX_RANGES = 16  # Requests for more byte ranges get the whole file
+MAX_HEADER_SIZE = 16 * 1024  # Longest request head accepted
+MAX_CONNECTIONS = 1024  # Open connections per process; more are turned away with 503
+FD_HEADROOM = 64  # Descriptors kept for the listener, the log and everything else
+HEADER_TIMEOUT = 10.0  # Seconds a client has to send a complete request
+IDLE_TIMEOUT = 15.0  # Seconds a connection may go without any progress
+SWEEP_INTERVAL = 0.5  # Seconds between checks for expired connections
+RETRY_AFTER = 1  # Seconds an overloaded server asks the client to wait
+CACHE_MAX_BYTES = 64 * 1024 * 1024  # Memory budget of the response cache
+CACHE_MAX_ENTRY = 1024 * 1024  # Larger files are always sent from disk
+CONTENT_CODINGS = ("gzip", "deflate")  # In the order of preference
+COMPRESS_LEVEL = 6
+COMPRESS_MIN_SIZE = 256  # Smaller bodies are not worth compressing
+LOG_MAX_QUEUE = 100_000  # Records waiting to be written before new ones are dropped
+LOG_FLUSH_BYTES = 64 * 1024
+LOG_FLUSH_INTERVAL = 1.0  # Seconds a record may wait in the batch
+LOG_MAX_BYTES = 100 * 1024 * 1024  # Size at which the log file is rotated
+LOG_BACKUPS = 5
+RESTART_DELAY = 1.0  # Pause before restarting a worker that died right after starting
+SHUTDOWN_TIMEOUT = 5.0
+STOP_SIGNALS = {SIGINT, SIGTERM}
+
+HTTP_STATUS = {
+    200: "OK",
+    206: "Partial Content",
+    304: "Not Modified",
+    400: "Bad Request",
+    404: "Not Found",
+    405: "Method Not Allowed",
+    408: "Request Timeout",
+    416: "Range Not Satisfiable",
+    431: "Request Header Fields Too Large",
+    500: "Internal Server Error",
+    501: "Not Implemented",
+    503: "Service Unavailable",
+}
+
+
+class Request:
+    """
+    A request head as received from the client
+    The request line is decoded right away, header fields only when first used
+    """
+
+    __slots__ = ("method", "url", "version", "head", "fields")
+
+    def __init__(self, head: bytes):
+        line_end = head.find(b"\r\n")
+        line = head if line_end == -1 else head[:line_end]
+        parts = line.split(b" ")
+        if len(parts) != 3 or not parts[2].startswith(b"HTTP/"):
+            raise ValueError(f"Malformed request line: {bytes(line)!r}")
+        self.method, self.url, self.version = (p.decode("iso-8859-1") for p in parts)
+        self.head = head
+        self.fields: dict[bytes, bytes] | None = None
+
+    def field(self, name: bytes, default: bytes = b"") -> bytes:
+        """Value of a header field; `name` must be lowercase"""
+        if self.fields is None:
+            self.fields = {
+                field.strip().lower(): value.strip() for field, value in self.items()
+            }
+        return self.fields.get(name, default)
+
+    def items(self):
+        """Header fields as (name, value) byte pairs in the order received"""
+        for line in self.head.split(b"\r\n")[1:]:
+            field, sep, value = line.partition(b":")
+            if sep:
+                yield field, value
+
+    def as_dict(self) -> dict:
+        """The request line and the header fields as a dictionary of strings"""
+        request = {"method": self.method, "url": self.url, "version": self.version}
+        for field, value in self.items():
+            request[field.strip().decode("iso-8859-1")] = value.strip().decode(
+                "iso-8859-1"
+            )
+        return request
+
+
+class HeadTooLarge(ValueError):
+    """The request head exceeds the size the server accepts"""
+
+
+class RequestParser:
+    """
+    Incremental parser of the byte stream of a connection
+    Accepts data in arbitrary pieces and returns every request completed so far,
+    so pipelined requests are all picked up; request bodies are skipped
+    """
+
+    __slots__ = ("buffer", "scan_from", "body_left", "max_head")
+
+    def __init__(self, max_head: int = MAX_HEADER_SIZE):
+        self.buffer = bytearray()
+        self.scan_from = 0
+        self.body_left = 0
+        self.max_head = max_head
+
+    @property
+    def pending(self) -> bool:
+        """Whether a request has been partly received"""
+        return bool(self.buffer) or self.body_left > 0
+
+    def feed(self, data: bytes) -> list[Request]:
+        """
+        Add received data and return the requests it completes
+        Raise `ValueError` if the stream is not valid HTTP and `HeadTooLarge`
+        if a request head grows beyond `max_head` bytes
+        """
+        buffer = self.buffer
+        buffer += data
+        requests = []
+        start = 0
+        while True:
+            if self.body_left:
+                skipped = min(self.body_left, len(buffer) - start)
+                self.body_left -= skipped
+                start += skipped
+                if self.body_left:
+                    break
+            while buffer.startswith(b"\r\n", start):  # Ignored before a request
+                start += 2
+            end = buffer.find(b"\r\n\r\n", max(start, self.scan_from))
+            if (end == -1 and len(buffer) - start > self.max_head) or (
+                end - start > self.max_head
+            ):
+                raise HeadTooLarge(f"Request head exceeds {self.max_head} bytes")
+            if end == -1:
+                self.scan_from = max(start, len(buffer) - 3)
+                break
+            request = Request(bytes(buffer[start:end]))
+            if request.field(b"transfer-encoding"):
+                raise ValueError("Chunked request bodies are not supported")
+            length = request.field(b"content-length", b"0")
+            if not length.isdigit():  # int() would take a sign, spaces and "_"
+                raise ValueError("Malformed Content-Length")
+            self.body_left = int(length)
+            requests.append(request)
+            start = end + 4
+        del buffer[:start]
+        self.scan_from -= start
+        return requests
 
 
 def parse_request(data: bytes) -> dict:
     """Parse the incoming request"""
-    ...
+    head, _, _ = data.partition(b"\r\n\r\n")
+    return Request(head).as_dict()
+
+
+class DateLine:
+    """The Date header line, formatted at most once per second"""
+
+    __slots__ = ("second", "line")
+
+    def __init__(self):
+        self.second = -1
+        self.line = b""
+
+    def get(self) -> bytes:
+        """The line for the current second"""
+        second = int(time())
+        if second != self.second:
+            self.second = second
+            self.line = f"Date: {datetime.now():%Y-%m-%d %H:%M:%S}\r\n".encode()
+        return self.line
+
+
+STATUS_LINES = {
+    status_code: f"HTTP/1.1 {status_code} {phrase}\r\n".encode()
+    for status_code, phrase in HTTP_STATUS.items()
+}
+SERVER_LINE = f"Server: {SRVR_NAME}\r\n".encode()
+DATE_LINE = DateLine()
+CONNECTION_CLOSE = b"Connection: close\r\n"
+CONNECTION_KEEP_ALIVE = b"Connection: keep-alive\r\n"
+VARY_LINE = b"Vary: Accept-Encoding\r\n"
+
+
+def format_header(
+    http_version: str, status_code: int, header: dict = {}, *fields: bytes
+) -> bytes:
+    """
+    Format the status line and the header fields, without a body
+    `fields` are already encoded header lines placed after the ones in `header`
+    """
+    if http_version == "HTTP/1.1":
+        status_line = STATUS_LINES[status_code]
+    else:
+        status_line = f"{http_version} {status_code} {HTTP_STATUS[status_code]}\r\n"
+        status_line = status_line.encode()
+    return b"".join(
+        (
+            status_line,
+            DATE_LINE.get(),
+            SERVER_LINE,
+            *(f"{field}: {value}\r\n".encode() for field, value in header.items()),
+            *fields,
+            b"\r\n",
+        )
+    )
 
 
 def format_response(
     http_version: str, status_code: int, header: dict = {}, data: str = ""
 ) -> bytes:
     """Format the response"""
-    ...
+    body = data.encode() if status_code != 304 else b""  # 304 is header-only
+    header = header or {}
+    if body and "Content-Length" not in header:
+        header = {**header, "Content-Length": len(body)}
+    return format_header(http_version, status_code, header) + body
+
+
+class FileRegion:
+    """
+    A byte range of an open file that is sent to the socket straight from disk
+    Uses `os.sendfile` and falls back to chunked reads where it is not supported
+    for the file or the socket; other errors, such as a client that went away,
+    are raised
+    """
+
+    __slots__ = ("file", "offset", "count", "use_sendfile")
+
+    def __init__(self, file, offset: int, count: int):
+        self.file = file
+        self.offset = offset
+        self.count = count
+        self.use_sendfile = hasattr(os, "sendfile")
+
+    def send(self, sock: socket) -> int:
+        """
+        Send the next piece of the region
+        Raise `BlockingIOError` if a non-blocking socket is not ready
+        """
+        size = min(self.count, SEND_CHUNK)
+        if self.use_sendfile:
+            try:
+                sent = os.sendfile(sock.fileno(), self.file.fileno(), self.offset, size)
+            except OSError as os_err:
+                if os_err.errno not in SENDFILE_UNSUPPORTED:
+                    raise
+                logging.debug(f"sendfile() is not available: {os_err}")
+                self.use_sendfile = False
+                return self.send(sock)
+        else:
+            sent = sock.send(os.pread(self.file.fileno(), size, self.offset))
+        if sent == 0 and size:
+            raise OSError(f"{self.file.name} was truncated while being sent")
+        self.offset += sent
+        self.count -= sent
+        return sent
+
+    @property
+    def done(self) -> bool:
+        """Whether the whole region has been sent"""
+        return not self.count
+
+    def close(self) -> None:
+        """Release the file"""
+        self.file.close()
+
+
+class ChunkStream:
+    """
+    A body of unknown size produced piece by piece while it is being sent
+    The source is an iterable of byte chunks or a binary file object, which is
+    read `SEND_CHUNK` bytes at a time, so only one chunk is held in memory
+    With `chunked` every chunk is framed for `Transfer-Encoding: chunked`
+    """
+
+    __slots__ = ("source", "chunks", "chunked", "pending", "exhausted")
+
+    def __init__(self, source: Iterable[bytes], chunked: bool = True):
+        self.source = source
+        if hasattr(source, "read"):
+            self.chunks = iter(lambda: source.read(SEND_CHUNK), b"")
+        else:
+            self.chunks = iter(source)
+        self.chunked = chunked
+        self.pending: deque[bytes | memoryview] = deque()
+        self.exhausted = False
+
+    def fill(self) -> None:
+        """
+        Take the next non-empty chunk from the source
+        Raise `OSError` if the source fails, as the response cannot be completed
+        """
+        chunk = b""
+        try:
+            while not chunk and not self.exhausted:
+                chunk = next(self.chunks, None)
+                self.exhausted = chunk is None
+        except Exception as err:
+            raise OSError(f"Response body failed: {err!r}") from err
+        if self.exhausted:
+            if self.chunked:
+                self.pending.append(b"0\r\n\r\n")
+        elif self.chunked:
+            self.pending.extend((b"%x\r\n" % len(chunk), chunk, b"\r\n"))
+        else:
+            self.pending.append(chunk)
+
+    def send(self, sock: socket) -> None:
+        """
+        Send the rest of the current chunk, producing the next one if needed
+        Raise `BlockingIOError` if a non-blocking socket is not ready
+        """
+        if not self.pending and not self.exhausted:
+            self.fill()
+        if self.pending:
+            send_buffers(sock, self.pending)
+
+    @property
+    def done(self) -> bool:
+        """Whether the source is exhausted and everything has been sent"""
+        return self.exhausted and not self.pending
+
+    def close(self) -> None:
+        """Release the source"""
+        self.pending.clear()
+        if hasattr(self.source, "close"):
+            self.source.close()
+
+
+BodyStream = FileRegion | ChunkStream
+
+
+def format_stream_response(
+    http_version: str,
+    status_code: int,
+    header: dict = {},
+    body: Iterable[bytes] = (),
+    length: int | None = None,
+) -> list:
+    """
+    Format a response whose body is streamed from an iterable of byte chunks
+    or a binary file object
+    Return the header and a `ChunkStream`; a body of unknown `length` is sent
+    chunked to HTTP/1.1 clients and delimited by closing the connection otherwise
+    """
+    header = dict(header or {})
+    if status_code == 304:  # 304 is header-only
+        if hasattr(body, "close"):
+            body.close()
+        return [format_header(http_version, status_code, header)]
+    chunked = length is None and http_version == "HTTP/1.1"
+    if length is not None:
+        header["Content-Length"] = length
+    elif chunked:
+        header["Transfer-Encoding"] = "chunked"
+    else:
+        header["Connection"] = "close"
+    return [
+        format_header(http_version, status_code, header),
+        ChunkStream(body, chunked),
+    ]
+
+
+def content_fields(
+    mtime: float, size: int | None, etag: str, coding: str | None = None
+) -> bytes:
+    """
+    Encoded header lines describing a file's content
+    Content-Length is left out if the `size` is not known in advance
+    """
+    fields = (
+        "Content-Type: text/plain; charset=utf-8\r\n"
+        f"Last-Modified: {datetime.fromtimestamp(mtime)}\r\n"
+    )
+    if size is not None:
+        fields += f"Content-Length: {size}\r\n"
+    fields += "Accept-Ranges: bytes\r\n"
+    if coding:
+        fields += f"Content-Encoding: {coding}\r\n"
+    return (fields + f"ETag: {etag}\r\n").encode() + VARY_LINE
+
+
+def parse_http_date(value: bytes) -> datetime | None:
+    """
+    Parse a date sent back by a client as a naive local datetime
+    Accept both the `Last-Modified` format of this server and the RFC 7231 one
+    """
+    text = value.decode("iso-8859-1").strip()
+    try:
+        date = datetime.fromisoformat(text)
+    except ValueError:
+        try:
+            date = parsedate_to_datetime(text)
+        except (TypeError, ValueError):
+            return None
+    return date.astimezone().replace(tzinfo=None) if date.tzinfo else date
+
+
+def is_not_modified(request: Request, etag: str, mtime: float) -> bool:
+    """
+    Evaluate If-None-Match or, without it, If-Modified-Since
+    Return True if the client's copy is current
+    """
+    if_none_match = request.field(b"if-none-match")
+    if if_none_match:
+        if if_none_match.strip() == b"*":
+            return True
+        tags = (tag.strip().removeprefix(b"W/") for tag in if_none_match.split(b","))
+        return etag.encode() in tags
+    if_modified_since = request.field(b"if-modified-since")
+    if if_modified_since:
+        since = parse_http_date(if_modified_since)
+        if since is None:
+            return False
+        modified = datetime.fromtimestamp(mtime)
+        if not since.microsecond:
+            modified = modified.replace(microsecond=0)
+        return modified <= since
+    return False
+
+
+def negotiate_encoding(accept_encoding: bytes) -> str | None:
+    """
+    Pick the content coding preferred by the client from `CONTENT_CODINGS`
+    Return None if the body should be sent as is
+    """
+    weights = {}
+    for item in accept_encoding.lower().split(b","):
+        coding, _, params = item.partition(b";")
+        weight = 1.0
+        for param in params.split(b";"):
+            name, _, value = param.partition(b"=")
+            if name.strip() == b"q":
+                try:
+                    weight = float(value)
+                except ValueError:
+                    weight = 0.0
+        weights[coding.strip().decode("iso-8859-1")] = weight
+    best, best_weight = None, 0.0
+    for coding in CONTENT_CODINGS:
+        weight = weights.get(coding, weights.get("*", 0.0))
+        if weight > best_weight:
+            best, best_weight = coding, weight
+    return best
+
+
+def compressed_sibling(path: Path, mtime_ns: int) -> Path | None:
+    """The precompressed `.gz` copy of the file, if it is at least as new"""
+    sibling = path.with_name(path.name + ".gz")
+    try:
+        if sibling.stat().st_mtime_ns >= mtime_ns:
+            return sibling
+    except FileNotFoundError:
+        pass
+    return None
+
+
+def parse_range(value: bytes, size: int) -> list[tuple[int, int]] | None:
+    """
+    Parse a Range header into sorted, merged (start, stop) byte ranges of a body
+    of `size` bytes, with `stop` exclusive
+    Return None if the header must be ignored and an empty list if none of the
+    ranges is satisfiable
+    """
+    unit, sep, specs = value.partition(b"=")
+    items = specs.split(b",")
+    if not sep or unit.strip().lower() != b"bytes" or len(items) > MAX_RANGES:
+        return None
+    ranges = []
+    for item in items:
+        first, dash, last = item.strip().partition(b"-")
+        if not dash or not (first or last):
+            return None
+        if (first and not first.isdigit()) or (last and not last.isdigit()):
+            return None
+        if not first:
+            start, stop = max(0, size - int(last)), size
+        else:
+            start = int(first)
+            stop = int(last) + 1 if last else size
+            if last and stop <= start:
+                return None
+        stop = min(stop, size)
+        if start < stop:
+            ranges.append((start, stop))
+    ranges.sort()
+    merged = ranges[:1]
+    for start, stop in ranges[1:]:
+        if start <= merged[-1][1]:
+            merged[-1] = (merged[-1][0], max(stop, merged[-1][1]))
+        else:
+            merged.append((start, stop))
+    return merged
+
+
+def range_applies(request: Request, etag: str, mtime: float) -> bool:
+    """
+    Evaluate If-Range
+    Return True if the client's copy is current, so a partial response is usable
+    """
+    if_range = request.field(b"if-range").strip()
+    if not if_range:
+        return True
+    if if_range.startswith((b'"', b"W/")):
+        return if_range == etag.encode()
+    return parse_http_date(if_range) == datetime.fromtimestamp(mtime)
+
+
+class CacheEntry:
+    """
+    A version of a file with its encoded header fields and, if small, its body
+    Compressed variants are added on first request and kept for the version
+    """
+
+    __slots__ = ("mtime", "mtime_ns", "size", "tag", "fields", "body", "variants")
+
+    def __init__(self, path: Path, keep_body: bool = True):
+        with open(path, "rb") as file:
+            stat = os.fstat(file.fileno())
+            self.tag = f"{stat.st_ino:x}-{stat.st_size:x}-{stat.st_mtime_ns:x}"
+            self.mtime = stat.st_mtime
+            self.mtime_ns = stat.st_mtime_ns
+            self.size = stat.st_size
+            self.body = (
+                file.read() if keep_body and stat.st_size <= CACHE_MAX_ENTRY else None
+            )
+        if self.body is not None:
+            self.size = len(self.body)
+        self.fields = content_fields(self.mtime, self.size, self.etag())
+        self.variants: dict[str, tuple[bytes, bytes] | None] = {}
+
+    def etag(self, coding: str | None = None) -> str:
+        """Strong entity tag of this version in the given content coding"""
+        return f'"{self.tag}-{coding}"' if coding else f'"{self.tag}"'
+
+    @property
+    def footprint(self) -> int:
+        """Bytes charged against the cache budget"""
+        size = len(self.fields) + (len(self.body) if self.body is not None else 0)
+        for variant in self.variants.values():
+            if variant is not None:
+                size += len(variant[0]) + len(variant[1])
+        return size
+
+    def add_variant(self, path: Path, coding: str) -> tuple[bytes, bytes] | None:
+        """
+        Produce the `coding` variant from a fresh `.gz` sibling or by compressing
+        the body; None if neither is available or compression does not pay off
+        """
+        body = None
+        sibling = compressed_sibling(path, self.mtime_ns) if coding == "gzip" else None
+        if sibling is not None and sibling.stat().st_size <= CACHE_MAX_ENTRY:
+            body = sibling.read_bytes()
+        elif self.body is not None and self.size >= COMPRESS_MIN_SIZE:
+            if coding == "gzip":
+                body = gzip.compress(self.body, COMPRESS_LEVEL, mtime=0)
+            else:
+                body = zlib.compress(self.body, COMPRESS_LEVEL)
+        if body is None or len(body) >= self.size:
+            variant = None
+        else:
+            fields = content_fields(self.mtime, len(body), self.etag(coding), coding)
+            variant = (fields, body)
+        self.variants[coding] = variant
+        return variant
+
+
+class FileCache:
+    """
+    LRU cache of file responses keyed by resolved path
+    An entry is reloaded when the file's mtime or size changes
+    Least recently used entries are evicted to stay within `max_bytes`
+    """
+
+    def __init__(self, max_bytes: int = CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Path, CacheEntry] = OrderedDict()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, path: Path) -> CacheEntry:
+        """Return a current entry for the file, loading it if needed"""
+        stat = os.stat(path)
+        entry = self.entries.get(path)
+        if (
+            entry is not None
+            and entry.mtime_ns == stat.st_mtime_ns
+            and entry.size == stat.st_size
+        ):
+            self.hits += 1
+            self.entries.move_to_end(path)
+            return entry
+        self.misses += 1
+        self.discard(path)
+        entry = CacheEntry(path)
+        if entry.footprint <= self.max_bytes:
+            self.entries[path] = entry
+            self.total_bytes += entry.footprint
+            self.evict()
+        return entry
+
+    def variant(
+        self, path: Path, entry: CacheEntry, coding: str
+    ) -> tuple[bytes, bytes] | None:
+        """Return the (fields, body) of the `coding` variant, producing it once"""
+        if coding in entry.variants:
+            return entry.variants[coding]
+        footprint = entry.footprint
+        variant = entry.add_variant(path, coding)
+        if self.entries.get(path) is entry:
+            self.total_bytes += entry.footprint - footprint
+            self.evict()
+        return variant
+
+    def evict(self) -> None:
+        """Drop least recently used entries until the cache is within budget"""
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= evicted.footprint
+
+    def discard(self, path: Path) -> None:
+        """Drop the entry for the file, if any"""
+        entry = self.entries.pop(path, None)
+        if entry is not None:
+            self.total_bytes -= entry.footprint
+
+
+def send_buffers(sock: socket, parts: deque) -> None:
+    """
+    Send the in-memory parts at the front of `parts` with a single sendmsg() call
+    and remove what has been sent
+    """
+    buffers = []
+    for part in parts:
+        if isinstance(part, BodyStream) or len(buffers) == MAX_GATHER:
+            break
+        buffers.append(part)
+    sent = sock.sendmsg(buffers)
+    while parts and not isinstance(parts[0], BodyStream):
+        size = len(parts[0])
+        if size > sent:
+            parts[0] = memoryview(parts[0])[sent:]
+            break
+        sent -= size
+        parts.popleft()
+
+
+def flush_parts(sock: socket, parts: deque) -> bool:
+    """
+    Send as much of the response parts as the socket accepts
+    Return True once all of them have been sent
+    """
+    while parts:
+        part = parts[0]
+        try:
+            if isinstance(part, BodyStream):
+                part.send(sock)
+                if part.done:
+                    part.close()
+                    parts.popleft()
+            else:
+                send_buffers(sock, parts)
+        except BlockingIOError:
+            return False
+    return True
+
+
+def send_parts(sock: socket, parts: list) -> None:
+    """
+    Send the response parts over a blocking socket
+    Raise `TimeoutError` if a socket with a timeout stops accepting data
+    """
+    pending = deque(parts)
+    try:
+        while not flush_parts(sock, pending):  # sendfile() ignores socket timeouts
+            if not select([], [sock], [], sock.gettimeout())[1]:
+                raise TimeoutError("The client stopped receiving")
+    finally:
+        for part in pending:
+            if isinstance(part, BodyStream):
+                part.close()
 
 
-def server_loop(logfilename: Path):
+def resolve_path(url: str) -> Path | None:
+    """
+    Map the request URL to a file under `WEB_ROOT`
+    Return None if there is no such file, the URL escapes the root or it is not
+    a valid path (such as one with a NUL byte)
+    """
+    root = WEB_ROOT.resolve()
+    try:
+        path = (root / url.split("?", 1)[0].lstrip("/")).resolve()
+        if path.is_relative_to(root) and path.is_file():
+            return path
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+def wants_keep_alive(request: Request) -> bool:
+    """Decide whether the connection stays open after this request"""
+    connection = request.field(b"connection").lower()
+    if request.version == "HTTP/1.1":
+        return connection != b"close"
+    return connection == b"keep-alive"
+
+
+def connection_fields(request: Request, keep_alive: bool) -> bytes:
+    """Encoded header line announcing whether the connection persists"""
+    if not keep_alive:
+        return CONNECTION_CLOSE
+    if request.version != "HTTP/1.1":
+        return CONNECTION_KEEP_ALIVE
+    return b""
+
+
+def serve_file(
+    request: Request, path: Path, connection: bytes, cache: FileCache | None
+) -> list:
+    """
+    Respond to a GET of an existing file with the negotiated representation
+    or with 304 Not Modified if the client's copy is still current
+    """
+    entry = cache.get(path) if cache else CacheEntry(path, keep_body=False)
+    range_value = request.field(b"range")
+    coding = None
+    if not range_value:
+        coding = negotiate_encoding(request.field(b"accept-encoding"))
+    fields, body, source, served = entry.fields, entry.body, path, None
+    if coding and cache and (variant := cache.variant(path, entry, coding)):
+        (fields, body), served = variant, coding
+    elif coding == "gzip" and entry.body is None:
+        sibling = compressed_sibling(path, entry.mtime_ns)
+        if sibling is not None:
+            source, served = sibling, coding
+    etag = entry.etag(served)
+    if is_not_modified(request, etag, entry.mtime):
+        return [format_header("HTTP/1.1", 304, {"ETag": etag}, VARY_LINE, connection)]
+    if range_value and range_applies(request, etag, entry.mtime):
+        ranges = parse_range(range_value, entry.size)
+        if ranges is not None:
+            return serve_ranges(path, entry, ranges, connection)
+    head = format_header("HTTP/1.1", 200, {}, fields, connection)
+    if body is not None:
+        return [head, body]
+    file = open(source, "rb")
+    size = entry.size
+    if source != path:
+        size = os.fstat(file.fileno()).st_size
+        head = format_header(
+            "HTTP/1.1",
+            200,
+            {},
+            content_fields(entry.mtime, size, etag, served),
+            connection,
+        )
+    return [head, FileRegion(file, 0, size)]
+
+
+def serve_ranges(
+    path: Path, entry: CacheEntry, ranges: list[tuple[int, int]], connection: bytes
+) -> list:
+    """
+    Respond with the requested byte ranges of the file: 206 Partial Content with
+    a single part or multipart/byteranges, or 416 if no range is satisfiable
+    Slices come from the cached body or straight from the file
+    """
+    if not ranges:
+        header = {"Content-Range": f"bytes */{entry.size}", "Content-Length": 0}
+        return [format_header("HTTP/1.1", 416, header, connection)]
+
+    def piece(start: int, stop: int) -> memoryview | FileRegion:
+        if entry.body is not None:
+            return memoryview(entry.body)[start:stop]
+        return FileRegion(open(path, "rb"), start, stop - start)
+
+    header = {
+        "Content-Type": "text/plain; charset=utf-8",
+        "Last-Modified": datetime.fromtimestamp(entry.mtime),
+        "ETag": entry.etag(),
+    }
+    if len(ranges) == 1:
+        start, stop = ranges[0]
+        header["Content-Range"] = f"bytes {start}-{stop - 1}/{entry.size}"
+        header["Content-Length"] = stop - start
+        return [format_header("HTTP/1.1", 206, header, connection), piece(start, stop)]
+    boundary = token_hex(16)
+    parts = []
+    for start, stop in ranges:
+        parts.append(
+            (
+                f"\r\n--{boundary}\r\nContent-Type: text/plain; charset=utf-8\r\n"
+                f"Content-Range: bytes {start}-{stop - 1}/{entry.size}\r\n\r\n"
+            ).encode()
+        )
+        parts.append(piece(start, stop))
+    parts.append(f"\r\n--{boundary}--\r\n".encode())
+    header["Content-Type"] = f"multipart/byteranges; boundary={boundary}"
+    header["Content-Length"] = sum(len(part) for part in parts[::2]) + sum(
+        stop - start for start, stop in ranges
+    )
+    return [format_header("HTTP/1.1", 206, header, connection), *parts]
+
+
+def handle_request(
+    request: Request, keep_alive: bool = False, cache: FileCache | None = None
+) -> list:
+    """
+    Build the response to a parsed request
+    Return a list of parts: bytes to send as-is, a `FileRegion` to stream from disk
+    or a `ChunkStream` producing the body while it is sent
+    Without a `cache` every file is sent from disk
+    """
+    data = ""
+    connection = connection_fields(request, keep_alive)
+    if request.method == "GET":
+        path = resolve_path(request.url)
+        if path is None:
+            status_code = 404
+            data = f"<html><head></head><body><h1>File {request.url} not found on our server</h1></body></html>"
+        else:
+            return serve_file(request, path, connection, cache)
+    elif request.method == "POST":
+        status_code = 405
+        data = "<html><head></head><body><h1>Use GET to retrieve resources from this server</h1></body></html>"
+    else:
+        status_code = 501
+    body = data.encode()
+    length = b"Content-Length: %d\r\n" % len(body)
+    return [format_header("HTTP/1.1", status_code, {}, length, connection), body]
+
+
+class LogWriter:
+    """
+    Log file written by a background thread
+    Records are queued without blocking the server and written in batches once
+    `flush_bytes` are pending or the oldest one is `flush_interval` seconds old
+    The file is rotated to `.1`, `.2`, ... when it grows past `max_bytes`
+    The file is opened right away, so a bad path fails the caller; a batch that
+    cannot be written later is counted as failed and the thread keeps going
+    """
+
+    def __init__(
+        self,
+        filename: Path,
+        max_queue: int = LOG_MAX_QUEUE,
+        flush_bytes: int = LOG_FLUSH_BYTES,
+        flush_interval: float = LOG_FLUSH_INTERVAL,
+        max_bytes: int = LOG_MAX_BYTES,
+        backups: int = LOG_BACKUPS,
+    ):
+        self.filename = Path(filename)
+        self.flush_bytes = flush_bytes
+        self.flush_interval = flush_interval
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.records: queue.Queue[str | None] = queue.Queue(max_queue)
+        self.queued = 0
+        self.written = 0
+        self.dropped = 0
+        self.failed = 0
+        self.rotations = 0
+        self.fd = self.open()
+        self.thread = threading.Thread(target=self.run, name="log-writer", daemon=True)
+        self.thread.start()
+
+    def write(self, record: str) -> None:
+        """Queue a record, dropping it if the writer has fallen too far behind"""
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+        else:
+            self.queued += 1
+
+    def stats(self) -> dict[str, int]:
+        """Counters of the records handled so far"""
+        return {
+            "queued": self.queued,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+            "pending": self.records.qsize(),
+            "rotations": self.rotations,
+        }
+
+    def close(self) -> None:
+        """
+        Write out everything queued and stop the thread
+        Give up after `SHUTDOWN_TIMEOUT` seconds rather than hang the shutdown
+        """
+        try:
+            if self.thread.is_alive():
+                self.records.put(None, timeout=SHUTDOWN_TIMEOUT)
+        except queue.Full:
+            pass
+        self.thread.join(SHUTDOWN_TIMEOUT)
+        if self.thread.is_alive():
+            logging.warning(f"Log writer did not stop: {self.stats()}")
+        else:
+            logging.info(f"Log writer: {self.stats()}")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self) -> None:
+        """Collect records into batches and write them out"""
+        batch: list[str] = []
+        batch_size = 0
+        deadline = 0.0
+        try:
+            while True:
+                timeout = max(0.0, deadline - monotonic()) if batch else None
+                try:
+                    record = self.records.get(timeout=timeout)
+                except queue.Empty:
+                    record = ""
+                if record is None:
+                    break
+                if record:
+                    if not batch:
+                        deadline = monotonic() + self.flush_interval
+                    batch.append(record)
+                    batch_size += len(record)
+                if batch and (
+                    batch_size >= self.flush_bytes or monotonic() >= deadline
+                ):
+                    self.flush(batch)
+                    batch.clear()
+                    batch_size = 0
+            if batch:
+                self.flush(batch)
+        finally:
+            if self.fd >= 0:
+                os.close(self.fd)
+                self.fd = -1
+
+    def open(self) -> int:
+        """Open the log file for appending"""
+        return os.open(self.filename, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+    def flush(self, batch: list[str]) -> None:
+        """Write a batch, or count it as failed if the file cannot be written"""
+        try:
+            self.append("".join(batch).encode())
+        except OSError as os_err:
+            self.failed += len(batch)
+            logging.warning(f"Cannot write the log {self.filename}: {os_err}")
+        else:
+            self.written += len(batch)
+
+    def append(self, data: bytes) -> None:
+        """
+        Write the data, rotating the file first if it would grow too large
+        Each batch is a single append, so workers sharing the file do not interleave
+        The file is reopened after another worker rotated it or a write failed
+        """
+        if self.fd >= 0:
+            stat = os.fstat(self.fd)
+            try:
+                current = os.stat(self.filename)
+            except FileNotFoundError:
+                current = None
+            if current is None or current.st_ino != stat.st_ino:
+                # Another worker has rotated the file
+                os.close(self.fd)
+                self.fd = -1
+            elif stat.st_size and stat.st_size + len(data) > self.max_bytes:
+                os.close(self.fd)
+                self.fd = -1
+                self.rotate()
+        if self.fd < 0:
+            self.fd = self.open()
+        os.write(self.fd, data)
+
+    def rotate(self) -> None:
+        """Shift the backups by one and move the current file to `.1`"""
+        for n in range(self.backups - 1, 0, -1):
+            backup = self.filename.with_name(f"{self.filename.name}.{n}")
+            if backup.exists():
+                backup.replace(self.filename.with_name(f"{self.filename.name}.{n + 1}"))
+        if self.backups:
+            self.filename.replace(self.filename.with_name(f"{self.filename.name}.1"))
+        else:
+            self.filename.unlink()
+        self.rotations += 1
+
+
+def log_request(log: LogWriter, request: Request, client_ip: str) -> None:
+    """Record the request details in the log"""
+    user_agent = request.field(b"user-agent").decode("iso-8859-1")
+    log.write(f"{datetime.now()} | {request.url} | {client_ip} | {user_agent}\n")
+
+
+def overload_response() -> bytes:
+    """The response turning a connection away when the server is at capacity"""
+    header = {"Retry-After": RETRY_AFTER, "Content-Length": 0}
+    return format_header("HTTP/1.1", 503, header, CONNECTION_CLOSE)
+
+
+def connection_limit(max_connections: int) -> int:
+    """
+    The connections a process can keep open within its descriptor limit
+    Every connection may hold a file being sent besides its socket
+    """
+    soft, _ = getrlimit(RLIMIT_NOFILE)
+    if soft == RLIM_INFINITY:
+        return max_connections
+    return max(1, min(max_connections, (soft - FD_HEADROOM) // 2))
+
+
+def rejection_response(err: ValueError) -> bytes:
+    """The response to a request that cannot be parsed"""
+    status_code = 431 if isinstance(err, HeadTooLarge) else 400
+    return format_response("HTTP/1.1", status_code, {"Connection": "close"})
+
+
+def failure_response(err: Exception) -> bytes:
+    """
+    The response to a parsed request that could not be handled, such as one for
+    a file removed while the response was being built
+    """
+    if isinstance(err, FileNotFoundError):
+        status_code = 404
+    elif isinstance(err, ValueError):
+        status_code = 400
+    else:
+        status_code = 500
+    return format_response("HTTP/1.1", status_code, {"Connection": "close"})
+
+
+class Connection:
+    """
+    State of a client connection served by the event loop
+    The connection must make progress before its `deadline`: a request has
+    `header_timeout` seconds to arrive in full and a connection waiting for the
+    next request or for the client to take the response `idle_timeout` seconds
+    Pipelined requests, and the error that ended them if the stream turned out
+    not to be HTTP, wait in `waiting` while a body is streamed from a file
+    """
+
+    __slots__ = (
+        "sock",
+        "addr",
+        "parser",
+        "waiting",
+        "outbuf",
+        "keep_alive",
+        "deadline",
+    )
+
+    def __init__(self, sock: socket, addr: tuple, deadline: float = float("inf")):
+        self.sock = sock
+        self.addr = addr
+        self.parser = RequestParser()
+        self.waiting: deque[Request | ValueError] = deque()
+        self.outbuf: deque[bytes | memoryview | BodyStream] = deque()
+        self.keep_alive = True
+        self.deadline = deadline
+
+    @property
+    def streaming(self) -> bool:
+        """Whether the output holds a body that keeps a file open"""
+        return any(isinstance(part, BodyStream) for part in self.outbuf)
+
+    def receive(self, recv_view: memoryview) -> list[Request] | None:
+        """
+        Read whatever is available and return the requests it completes
+        Return None if the peer has closed the connection
+        Raise `ValueError` if the client does not speak HTTP
+        """
+        try:
+            n_bytes = self.sock.recv_into(recv_view)
+        except BlockingIOError:
+            return []
+        except OSError:
+            return None
+        if n_bytes == 0:
+            return None
+        return self.parser.feed(recv_view[:n_bytes])
+
+    def flush(self) -> bool:
+        """
+        Send as much pending output as the socket accepts
+        Return True once the output buffer is empty
+        """
+        return flush_parts(self.sock, self.outbuf)
+
+    def progress(
+        self, now: float, started: bool, header_timeout: float, idle_timeout: float
+    ) -> None:
+        """
+        Move the deadline after the connection made progress
+        A request that was `started` earlier keeps its deadline, so a client
+        trickling a request cannot extend it
+        """
+        if self.parser.pending:
+            if not started:
+                self.deadline = now + header_timeout
+        else:
+            self.deadline = now + idle_timeout
+
+    def close(self) -> None:
+        """Close the socket and any files still waiting to be sent"""
+        for part in self.outbuf:
+            if isinstance(part, BodyStream):
+                part.close()
+        self.outbuf.clear()
+        self.waiting.clear()
+        self.sock.close()
+
+
+def serve_serial(
+    sock: socket,
+    log: LogWriter,
+    cache: FileCache | None,
+    shed: Counter | None = None,
+    header_timeout: float = HEADER_TIMEOUT,
+    idle_timeout: float = IDLE_TIMEOUT,
+) -> None:
+    """
+    Accept and answer one request at a time
+    A client gets `header_timeout` seconds to send its request and
+    `idle_timeout` seconds for every piece of the response it receives
+    """
+    shed = Counter() if shed is None else shed
+    while True:
+        try:
+            conn, (client_ip, _) = sock.accept()
+        except OSError as os_err:
+            logging.debug(f"Accept failed: {os_err}")
+            shed["accept_failed"] += 1
+            sleep(SWEEP_INTERVAL)
+            continue
+        conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+        with conn:
+            parser = RequestParser()
+            requests = []
+            deadline = monotonic() + header_timeout
+            try:
+                while not requests:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        raise TimeoutError("The request was not received in time")
+                    conn.settimeout(remaining)
+                    chunk = conn.recv(RECV_SIZE)
+                    if not chunk:
+                        break
+                    requests = parser.feed(chunk)
+                if requests:
+                    conn.settimeout(idle_timeout)
+                    log_request(log, requests[0], client_ip)
+                    send_parts(conn, handle_request(requests[0], cache=cache))
+            except ValueError as v_err:
+                logging.debug(v_err)
+                shed["rejected"] += 1
+                try:
+                    conn.sendall(rejection_response(v_err))
+                except OSError:
+                    pass
+            except TimeoutError as t_err:
+                logging.debug(f"{client_ip}: {t_err}")
+                shed["header_timeout" if not requests else "idle_timeout"] += 1
+            except OSError as os_err:
+                logging.debug(f"{client_ip}: {os_err}")
+
+
+def serve_concurrent(
+    sock: socket,
+    log: LogWriter,
+    cache: FileCache | None,
+    shed: Counter | None = None,
+    max_connections: int = MAX_CONNECTIONS,
+    header_timeout: float = HEADER_TIMEOUT,
+    idle_timeout: float = IDLE_TIMEOUT,
+) -> None:
+    """
+    Multiplex many keep-alive connections with a selector
+    Connections that miss their deadline are closed and connections beyond
+    `max_connections`, lowered to fit the descriptor limit, are answered with
+    503 right away; `shed` counts both
+    When the process runs out of descriptors anyway, the listener is left
+    alone until the next sweep and the backlog waits in the kernel
+    Pipelined requests are answered one streamed body at a time, so that a
+    connection holds at most one open file
+    """
+    shed = Counter() if shed is None else shed
+    max_connections = connection_limit(max_connections)
+    accepting = True
+    sel = selectors.DefaultSelector()
+    sock.setblocking(False)
+    sel.register(sock, selectors.EVENT_READ)
+    recv_view = memoryview(bytearray(RECV_SIZE))
+    connections: set[Connection] = set()
+    sweep_interval = min(SWEEP_INTERVAL, header_timeout / 4, idle_timeout / 4)
+    next_sweep = monotonic() + sweep_interval
+
+    def close(conn: Connection) -> None:
+        sel.unregister(conn.sock)
+        connections.discard(conn)
+        conn.close()
+
+    def turn_away(client_sock: socket) -> None:
+        shed["overloaded"] += 1
+        try:
+            client_sock.send(overload_response())
+        except OSError:
+            pass
+        client_sock.close()
+
+    def sweep(now: float) -> None:
+        for conn in [conn for conn in connections if conn.deadline <= now]:
+            if conn.parser.pending and not conn.outbuf:
+                shed["header_timeout"] += 1
+                try:
+                    conn.sock.send(
+                        format_response("HTTP/1.1", 408, {"Connection": "close"})
+                    )
+                except OSError:
+                    pass
+            else:
+                shed["idle_timeout"] += 1
+            close(conn)
+
+    def answer(conn: Connection) -> None:
+        while conn.waiting and conn.keep_alive and not conn.streaming:
+            request = conn.waiting.popleft()
+            if isinstance(request, ValueError):
+                logging.debug(request)
+                shed["rejected"] += 1
+                conn.keep_alive = False
+                conn.outbuf.append(rejection_response(request))
+                break
+            conn.keep_alive = wants_keep_alive(request)
+            log_request(log, request, conn.addr[0])
+            try:
+                parts = handle_request(request, conn.keep_alive, cache)
+            except (OSError, ValueError) as err:
+                logging.debug(f"{conn.addr[0]}: {err!r}")
+                shed["failed"] += 1
+                conn.keep_alive = False
+                parts = [failure_response(err)]
+            conn.outbuf.extend(parts)
+        if not conn.keep_alive:
+            conn.waiting.clear()
+
+    try:
+        while True:
+            events = sel.select(sweep_interval)
+            now = monotonic()
+            for key, mask in events:
+                if key.data is None:
+                    while True:
+                        try:
+                            client_sock, client_addr = sock.accept()
+                        except BlockingIOError:
+                            break
+                        except OSError as os_err:
+                            logging.debug(f"Accept failed: {os_err}")
+                            if os_err.errno in (EMFILE, ENFILE, ENOBUFS, ENOMEM):
+                                shed["overloaded"] += 1
+                                sel.unregister(sock)
+                                accepting = False
+                            else:
+                                shed["accept_failed"] += 1
+                            break
+                        client_sock.setblocking(False)
+                        if len(connections) >= max_connections:
+                            turn_away(client_sock)
+                            continue
+                        client_sock.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
+                        conn = Connection(
+                            client_sock, client_addr, now + header_timeout
+                        )
+                        connections.add(conn)
+                        sel.register(client_sock, selectors.EVENT_READ, conn)
+                    continue
+                conn = key.data
+                started = conn.parser.pending
+                if mask & selectors.EVENT_READ and conn.keep_alive and not conn.waiting:
+                    try:
+                        requests = conn.receive(recv_view)
+                    except ValueError as v_err:
+                        requests = [v_err]
+                    if requests is None:
+                        close(conn)
+                        continue
+                    conn.waiting.extend(requests)
+                try:
+                    answer(conn)
+                    while (flushed := conn.flush()) and conn.waiting:
+                        answer(conn)
+                except OSError:
+                    close(conn)
+                    continue
+                conn.progress(now, started, header_timeout, idle_timeout)
+                if flushed and not conn.keep_alive:
+                    close(conn)
+                elif flushed:
+                    sel.modify(conn.sock, selectors.EVENT_READ, conn)
+                else:
+                    sel.modify(conn.sock, selectors.EVENT_WRITE, conn)
+            if now >= next_sweep:
+                sweep(now)
+                if not accepting:
+                    sel.register(sock, selectors.EVENT_READ)
+                    accepting = True
+                next_sweep = now + sweep_interval
+    finally:
+        for key in list(sel.get_map().values()):
+            if key.data is not None:
+                key.data.close()
+        sel.close()
+
+
+def server_loop(
+    logfilename: Path,
+    concurrent: bool = False,
+    cache_size: int = CACHE_MAX_BYTES,
+    log_max_bytes: int = LOG_MAX_BYTES,
+    reuse_port: bool = False,
+    max_connections: int = MAX_CONNECTIONS,
+    header_timeout: float = HEADER_TIMEOUT,
+    idle_timeout: float = IDLE_TIMEOUT,
+):
     """Main server loop"""
     print("The server has started")
-    with socket(AF_INET, SOCK_STREAM) as sock:
-        ...
+    cache = FileCache(cache_size) if cache_size > 0 else None
+    shed: Counter[str] = Counter()
+    timeouts = {"header_timeout": header_timeout, "idle_timeout": idle_timeout}
+    try:
+        with (
+            LogWriter(logfilename, max_bytes=log_max_bytes) as log,
+            socket(AF_INET, SOCK_STREAM) as sock,
+        ):
+            sock.setsockopt(SOL_SOCKET, SO_REUSEADDR, 1)
+            if reuse_port:
+                sock.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
+            sock.bind((SRVR_ADDR, SRVR_PORT))
+            sock.listen(LISTEN_BACKLOG)
+            if concurrent:
+                serve_concurrent(sock, log, cache, shed, max_connections, **timeouts)
+            else:
+                serve_serial(sock, log, cache, shed, **timeouts)
+    finally:
+        if shed:
+            print(f"Connections shed by process {os.getpid()}: {dict(shed)}")
+
+
+def interrupt_once(signum, frame) -> None:
+    """Raise KeyboardInterrupt and ignore further interrupts during the shutdown"""
+    signal(SIGINT, SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def worker_loop(**loop_args) -> None:
+    """Run the server loop in a worker process until interrupted"""
+    signal(SIGINT, interrupt_once)
+    signal(SIGTERM, SIG_DFL)  # Left to the supervisor to stop a stuck worker
+    pthread_sigmask(SIG_UNBLOCK, STOP_SIGNALS)
+    try:
+        server_loop(**loop_args, reuse_port=True)
+    except KeyboardInterrupt:
+        pass
+
+
+def supervise(n_workers: int, **loop_args) -> None:
+    """
+    Run `n_workers` processes, each accepting on its own SO_REUSEPORT socket
+    Restart workers that exit and stop all of them on KeyboardInterrupt or SIGTERM
+    """
+
+    def start(n: int) -> None:
+        worker = multiprocessing.Process(
+            target=worker_loop, kwargs=loop_args, name=f"worker-{n}"
+        )
+        # Held until the worker is recorded: an interrupt raised in the fork handlers
+        # is lost, and one raised before the worker is recorded leaves it running
+        pthread_sigmask(SIG_BLOCK, STOP_SIGNALS)
+        try:
+            worker.start()
+            workers[n] = worker
+            started[n] = monotonic()
+        finally:
+            pthread_sigmask(SIG_UNBLOCK, STOP_SIGNALS)
+
+    signal(SIGTERM, interrupt_once)
+    started: dict[int, float] = {}
+    workers: dict[int, multiprocessing.Process] = {}
+    try:
+        for n in range(n_workers):
+            start(n)
+        while True:
+            wait([worker.sentinel for worker in workers.values()])
+            for n, worker in list(workers.items()):
+                if worker.is_alive():
+                    continue
+                logging.warning(
+                    f"{worker.name} (pid {worker.pid}) exited with code {worker.exitcode}, restarting"
+                )
+                del workers[n]
+                if monotonic() - started[n] < RESTART_DELAY:
+                    sleep(RESTART_DELAY)
+                start(n)
+    finally:
+        for worker in workers.values():
+            if worker.is_alive():
+                os.kill(worker.pid, SIGINT)
+        for worker in workers.values():
+            worker.join(SHUTDOWN_TIMEOUT)
+            if worker.is_alive():
+                worker.terminate()
+                worker.join()
 
 
 def main():
@@ -48,6 +1485,50 @@ def main():
         help="Log file name",
         default="src/projects/webserver/webserver.log",
     )
+    arg_parser.add_argument(
+        "-c",
+        "--concurrent",
+        action="store_true",
+        help="Serve many keep-alive connections at once using an event loop",
+    )
+    arg_parser.add_argument(
+        "-w",
+        "--workers",
+        type=int,
+        help="Number of worker processes sharing the port (0 serves in this process)",
+        default=0,
+    )
+    arg_parser.add_argument(
+        "--cache-size",
+        type=int,
+        help="Memory budget of the response cache in bytes (0 disables it)",
+        default=CACHE_MAX_BYTES,
+    )
+    arg_parser.add_argument(
+        "--log-max-bytes",
+        type=int,
+        help="Size at which the log file is rotated",
+        default=LOG_MAX_BYTES,
+    )
+    arg_parser.add_argument(
+        "--max-connections",
+        type=int,
+        help="Open connections per process before new ones get 503, "
+        "lowered to fit the open file limit",
+        default=MAX_CONNECTIONS,
+    )
+    arg_parser.add_argument(
+        "--header-timeout",
+        type=float,
+        help="Seconds a client has to send a complete request",
+        default=HEADER_TIMEOUT,
+    )
+    arg_parser.add_argument(
+        "--idle-timeout",
+        type=float,
+        help="Seconds a connection may stay idle or stalled",
+        default=IDLE_TIMEOUT,
+    )
     arg_parser.add_argument(
         "-d", "--debug", action="store_true", help="Enable logging.DEBUG mode"
     )
@@ -60,8 +1541,20 @@ def main():
         logger.setLevel(logging.WARNING)
     logging.basicConfig(format="%(levelname)s: %(message)s", level=logger.level)
 
+    loop_args = {
+        "logfilename": Path(args.logfile),
+        "concurrent": args.concurrent,
+        "cache_size": args.cache_size,
+        "log_max_bytes": args.log_max_bytes,
+        "max_connections": args.max_connections,
+        "header_timeout": args.header_timeout,
+        "idle_timeout": args.idle_timeout,
+    }
     try:
-        server_loop(Path(args.logfile))
+        if args.workers > 0:
+            supervise(args.workers, **loop_args)
+        else:
+            server_loop(**loop_args)
     except KeyboardInterrupt:
         print("\nThe server has stopped")
 
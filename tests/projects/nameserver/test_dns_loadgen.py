@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+"""
+`nameserver` load generator testing
+
+@author:
+@version:
+"""
+
+import importlib
+import pathlib
+import socket
+import sys
+import threading
+from collections import Counter
+
+import pytest
+
+try:
+    importlib.util.find_spec(".".join(pathlib.Path(__file__).parts[-3:-1]), "src")
+except ModuleNotFoundError:
+    sys.path.append(f"{pathlib.Path(__file__).parents[3]}/")
+finally:
+    from src.projects.nameserver.loadgen import (
+        encode_query,
+        percentile,
+        read_queries,
+        run_load,
+        zipf_weights,
+        zone_queries,
+    )
+    from src.projects.nameserver.nameserver import (
+        AnswerCache,
+        load_zone,
+        parse_request,
+        serve,
+    )
+
+
+@pytest.mark.parametrize(
+    "name, qry_type",
+    [
+        ("ant.cs430.luther.edu", 1),
+        ("Ant.CS430.luther.edu.", 28),
+        ("mail.cs430.luther.edu", 15),
+    ],
+)
+def test_encode_query(name, qry_type):
+    """Queries are understood by the nameserver"""
+    trans_id, domain, parsed_type, _ = parse_request(
+        "cs430.luther.edu", encode_query(0x36C3, name, qry_type)
+    )
+    assert (trans_id, domain, parsed_type) == (0x36C3, name.split(".")[0], qry_type)
+
+
+def test_read_queries(tmp_path):
+    """Read a dnsperf query list"""
+    query_file = tmp_path / "queries.txt"
+    query_file.write_text(
+        "# Zoo\nant.cs430.luther.edu A\n\nant.cs430.luther.edu. aaaa ; v6\n"
+    )
+    assert read_queries(str(query_file)) == [
+        ("ant.cs430.luther.edu", 1),
+        ("ant.cs430.luther.edu", 28),
+    ]
+    query_file.write_text("ant.cs430.luther.edu TXT\n")
+    with pytest.raises(ValueError):
+        read_queries(str(query_file))
+
+
+def test_zone_queries():
+    """Ask for every name and type in the zone"""
+    queries = zone_queries("data/projects/nameserver/zoo.zone")
+    assert queries[:2] == [("ant.cs430.luther.edu", 1), ("ant.cs430.luther.edu", 28)]
+    assert len(set(queries)) == len(queries)
+    _, zone = load_zone("data/projects/nameserver/zoo.zone")
+    assert {name.split(".")[0] for name, _ in queries} == set(zone)
+
+
+def test_zipf_weights():
+    """Rank k is drawn in proportion to 1 / k**s"""
+    weights = zipf_weights(4, 1.0)
+    assert weights == pytest.approx([1, 1.5, 1.5 + 1 / 3, 1.5 + 1 / 3 + 0.25])
+    assert zipf_weights(3, 0.0) == [1, 2, 3]
+
+
+@pytest.mark.parametrize(
+    "pct, value", [(0, 1), (50, 50), (99, 99), (99.9, 100), (100, 100)]
+)
+def test_percentile(pct, value):
+    """Nearest-rank percentiles"""
+    assert percentile(list(range(1, 101)), pct) == value
+
+
+def test_run_load():
+    """Drive a nameserver and account for every query"""
+    origin, zone = load_zone("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    stats = Counter()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, origin, zone, AnswerCache(), stats),
+        daemon=True,
+    ).start()
+    queries = zone_queries("data/projects/nameserver/zoo.zone")
+    queries.append(("okapi.cs430.luther.edu", 1))
+    report = run_load(
+        server_sock.getsockname(),
+        queries,
+        window=8,
+        duration=0,
+        total=500,
+        exponent=0.0,
+        seed=430,
+    )
+    assert (report["sent"], report["answered"], report["lost"]) == (500, 500, 0)
+    assert report["rcodes"]["NOERROR"] + report["rcodes"]["NXDOMAIN"] == 500
+    assert report["errors"] == {}
+    assert 0 < report["latency_ms"]["p50"] <= report["latency_ms"]["max"]
+
+
+class RefusingSocket(socket.socket):
+    """A client socket whose first sends fail"""
+
+    failures = 3
+
+    def send(self, data, *args):
+        if RefusingSocket.failures:
+            RefusingSocket.failures -= 1
+            raise ConnectionRefusedError
+        return super().send(data, *args)
+
+
+def test_run_load_send_error(monkeypatch):
+    """Count a failed send as an error, not as a lost query"""
+    origin, zone = load_zone("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    threading.Thread(
+        target=serve,
+        args=(server_sock, origin, zone, None, Counter()),
+        daemon=True,
+    ).start()
+    monkeypatch.setattr("src.projects.nameserver.loadgen.socket.socket", RefusingSocket)
+    report = run_load(
+        server_sock.getsockname(),
+        [("ant.cs430.luther.edu", 1)],
+        window=1,
+        duration=0,
+        total=20,
+        timeout=0.5,
+    )
+    assert report["errors"] == {"ConnectionRefusedError": 3}
+    assert (report["sent"], report["answered"], report["lost"]) == (20, 17, 0)
+
+
+def test_run_load_lost():
+    """Count queries without an answer as lost"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as silent:
+        silent.bind(("127.0.0.1", 0))
+        report = run_load(
+            silent.getsockname(),
+            [("ant.cs430.luther.edu", 1)],
+            window=4,
+            duration=0.2,
+            rate=50,
+            timeout=0.1,
+        )
+    assert report["sent"] == 10
+    assert report["lost"] == 10
+    assert report["loss_pct"] == 100.0
+    assert report["answered"] == 0
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
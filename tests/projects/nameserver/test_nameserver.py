@@ -6,10 +6,18 @@
 @version: 2024.12
 """
 
+from collections import Counter
+import json
 from random import seed
 import importlib
+import multiprocessing
+import os
 import pathlib
+import signal
+import socket
 import sys
+import threading
+import time
 
 import mock
 import pytest
@@ -20,11 +28,28 @@ except ModuleNotFoundError:
     sys.path.append(f"{pathlib.Path(__file__).parents[3]}/")
 finally:
     from src.projects.nameserver.nameserver import (
+        NO_DATA,
+        NXDOMAIN,
+        AnswerCache,
+        LatencyHistogram,
+        QueryStats,
+        RateLimiter,
+        ZoneLoader,
+        ZoneParser,
+        bind_socket,
+        load_zone,
+        answer_query,
+        serve,
+        slip_response,
+        stats_response,
+        supervise,
+        truncate,
         val_to_n_bytes,
         bytes_to_val,
         get_left_n_bits,
         get_right_n_bits,
         get_origin,
+        parse_ttl,
         read_zone_file,
         parse_request,
         format_response,
@@ -96,6 +121,188 @@ def test_read_zone_file(filename, records):
     assert len(zone) == records
 
 
+@pytest.mark.parametrize(
+    "value, seconds",
+    [("300", 300), ("1h", 3600), ("2H", 7200), ("30m", 1800), ("1w", 604800)],
+)
+def test_parse_ttl(value, seconds):
+    """Read a TTL with or without a unit"""
+    assert parse_ttl(value) == seconds
+
+
+@pytest.mark.parametrize("value", ["", "h", "2x", "-5", "1.5h", "1h30m", "²"])
+def test_parse_ttl_error(value):
+    """Reject a TTL that is not a number with an optional unit"""
+    with pytest.raises(ValueError):
+        parse_ttl(value)
+
+
+@pytest.mark.parametrize(
+    "lines, records",
+    [
+        (
+            ["$ORIGIN cs430.luther.edu.", "ant IN A 185.84.224.89 ; comment"],
+            [("ant", (604800, 1, bytes((185, 84, 224, 89))))],
+        ),
+        (
+            ["$ORIGIN cs430.luther.edu.", "$TTL 1h", "", "BEE 1d IN AAAA ::1"],
+            [("bee", (86400, 28, bytes(15) + b"\x01"))],
+        ),
+        (
+            [
+                "$ORIGIN cs430.luther.edu.",
+                "$TTL 300",
+                "mail IN MX 10 ant",
+                "     IN MX 20 mx.example.com.",
+                "     IN TXT hello",
+            ],
+            [
+                ("mail", (300, 15, (10, "ant.cs430.luther.edu"))),
+                ("mail", (300, 15, (20, "mx.example.com"))),
+                ("mail", None),
+            ],
+        ),
+        (
+            [
+                "$ORIGIN cs430.luther.edu.",
+                "@ 1d IN SOA ns1 admin.cs430.luther.edu. (",
+                "      2024010101 ; serial",
+                "      3600       ; refresh",
+                "      600 86400 3600 )",
+                "  IN NS ns1",
+                "  IN A 10.0.0.1",
+            ],
+            [
+                ("", None),
+                ("", (604800, 2, "ns1.cs430.luther.edu")),
+                ("", (604800, 1, bytes((10, 0, 0, 1)))),
+            ],
+        ),
+        (
+            [
+                "$ORIGIN cs430.luther.edu.",
+                "mail A 10.0.0.3",
+                "     60 aaaa ::1",
+                "www IN 60 CNAME (mail)",
+            ],
+            [
+                ("mail", (604800, 1, bytes((10, 0, 0, 3)))),
+                ("mail", (60, 28, bytes(15) + b"\x01")),
+                ("www", (60, 5, "mail.cs430.luther.edu")),
+            ],
+        ),
+        (
+            [
+                "$ORIGIN cs430.luther.edu.",
+                "$TTL 30m",
+                "ant 2h IN A 10.0.0.1",
+                "  A 10.0.0.2",
+            ],
+            [
+                ("ant", (7200, 1, bytes((10, 0, 0, 1)))),
+                ("ant", (1800, 1, bytes((10, 0, 0, 2)))),
+            ],
+        ),
+    ],
+)
+def test_zone_parser(lines, records):
+    """Parse zone lines into compact records"""
+    parser = ZoneParser()
+    parsed = [parser.parse(f"{line}\n") for line in lines]
+    assert [record for record in parsed if record is not None] == records
+    assert parser.origin == "cs430.luther.edu"
+
+
+@pytest.mark.parametrize(
+    "lines",
+    [
+        ["ant IN A 185.84.224.89"],
+        ["$ORIGIN cs430.luther.edu.", " IN A 185.84.224.89"],
+        ["$ORIGIN cs430.luther.edu.", "ant IN A 185.84.224.999"],
+        ["$ORIGIN cs430.luther.edu.", "ant CH A 185.84.224.89"],
+        ["$ORIGIN cs430.luther.edu.", "mail IN MX 10"],
+        ["$ORIGIN cs430.luther.edu.", "mail IN MX ten mail"],
+        ["$ORIGIN cs430.luther.edu.", "mail 60 IN"],
+        ["$ORIGIN cs430.luther.edu.", "ant 2x IN A 185.84.224.89"],
+        ["$ORIGIN cs430.luther.edu.", "$TTL 30x"],
+        ["$ORIGIN cs430.luther.edu.", "$TTL"],
+        ["$ORIGIN"],
+    ],
+)
+def test_zone_parser_error(lines):
+    """Reject records without a name or origin and malformed records"""
+    parser = ZoneParser()
+    with pytest.raises(ValueError):
+        for line in lines:
+            parser.parse(f"{line}\n")
+
+
+def test_load_zone_rfc1035(tmp_path):
+    """Load a zone written the way RFC 1035 allows"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\n"
+        "@ IN SOA ns1 admin (\n  2024010101 ; serial\n  3600 600 86400 3600 )\n"
+        "  IN NS ns1\n"
+        "ns1 A 10.0.0.53\n"
+        "    AAAA ::53\n"
+    )
+    origin, zone = load_zone(str(zone_file))
+    assert origin == "cs430.luther.edu"
+    assert sorted(zone[""]) == [2]
+    assert sorted(zone["ns1"]) == [1, 28]
+    zone_file.write_text("$ORIGIN cs430.luther.edu.\n@ IN SOA ns1 admin ( 1\n")
+    with pytest.raises(ValueError, match="Unclosed parenthesis"):
+        load_zone(str(zone_file))
+
+
+def test_load_zone_origins(tmp_path):
+    """Keep names relative to the zone origin across later $ORIGIN directives"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\n"
+        "ant IN A 185.84.224.89\n"
+        "$ORIGIN sub.cs430.luther.edu.\n"
+        "bee IN A 10.0.0.2\n"
+        "$ORIGIN deep\n"
+        "cat IN CNAME @\n"
+    )
+    origin, zone = load_zone(str(zone_file))
+    assert origin == "cs430.luther.edu"
+    assert get_origin(str(zone_file)) == origin
+    assert sorted(zone) == ["ant", "bee.sub", "cat.deep.sub"]
+    qry = b"\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    assert format_response(zone, 1, "ant", 1, qry).endswith(bytes((185, 84, 224, 89)))
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$ORIGIN example.com.\nant IN A 10.0.0.1\n"
+    )
+    with pytest.raises(ValueError, match="outside the zone"):
+        load_zone(str(zone_file))
+
+
+def test_load_zone(tmp_path):
+    """Share names, TTLs and empty answers across the zone"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\n"
+        + "".join(f"h{i} IN MX 10 mail\n" for i in range(3))
+        + "www IN CNAME h0\n"
+    )
+    origin, zone = load_zone(str(zone_file))
+    assert origin == "cs430.luther.edu"
+    assert list(zone["h0"]) == [15]
+    assert len(zone["www"]) == 6
+    assert zone["h1"][15][0] is zone["h2"][15][0]
+    qry = b"\x02h1\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    assert format_response(zone, 1, "h1", 1, qry) == (b"\x00\x01" + NO_DATA[0] + qry)
+    parser = ZoneParser()
+    parser.parse("$ORIGIN cs430.luther.edu.\n")
+    first = parser.parse("a IN MX 10 mail\n")[1]
+    second = parser.parse("b 3600 IN MX 10 mail\n")[1]
+    assert first[2][1] is second[2][1]
+    assert parser.parse("c 3600 IN A 1.2.3.4\n")[1][0] is second[0]
+
+
 @pytest.mark.parametrize(
     "origin, request_bytes, request_params",
     [
@@ -208,7 +415,12 @@ def test_format_response(zone, trans_id, qry_name, qry_type, qry_bytes, response
             "Unknown class",
         ),
         (
-            "luther.edu",
+            "cs430.luther.com",
+            b"6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01",
+            "Unknown origin",
+        ),
+        (
+            "ant.cs430.luther.edu.org",
             b"6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01",
             "Unknown origin",
         ),
@@ -275,6 +487,793 @@ def test_run(mock_request: bytes, exp_response: bytes) -> None:
     assert response == exp_response
 
 
+def test_read_zone_file_compiled(zone):
+    """Records are compiled into answer sections per name and type"""
+    header, answers = zone["ant"][1]
+    assert header == b"\x81\x00\x00\x01\x00\x02\x00\x00\x00\x00"
+    assert answers == (
+        b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x0e\x10\x00\x04\xb9T\xe0Y"
+        b"\xc0\x0c\x00\x01\x00\x01\x00\x00\x0e\x10\x00\x04\xc7SC\x9e"
+    )
+
+
+def test_format_response_no_data(tmp_path):
+    """A name without records of the type gets an empty answer"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\n; Only IPv4\nant IN A 185.84.224.89\n"
+    )
+    zone = read_zone_file(str(zone_file))
+    qry = b"\x03ANT\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01"
+    assert format_response(zone, 430, "ANT", 28, qry) == (
+        b"\x01\xae\x81\x00\x00\x01\x00\x00\x00\x00\x00\x00" + qry
+    )
+
+
+@pytest.mark.parametrize(
+    "request_bytes",
+    [
+        b"6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430",
+        b"6\xc3\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x00\x00\x01\x00\x01",
+    ],
+)
+def test_parse_request_malformed(request_bytes):
+    """Truncated or empty question"""
+    with pytest.raises(ValueError):
+        parse_request("cs430.luther.edu", request_bytes)
+
+
+@pytest.mark.parametrize(
+    "domain, qry_type, answers",
+    [
+        (
+            "www",
+            1,
+            b"\xc0\x0c\x00\x05\x00\x01\x00\x00\x0e\x10\x00\x06\x03ant\xc0\x10"
+            b"\xc0\x32\x00\x01\x00\x01\x00\x00\x0e\x10\x00\x04\xb9T\xe0Y",
+        ),
+        (
+            "mail",
+            15,
+            b"\xc0\x0c\x00\x0f\x00\x01\x00\x00\x0e\x10\x00\x08\x00\x0a\x03ant\xc0\x11"
+            b"\xc0\x0c\x00\x0f\x00\x01\x00\x00\x0e\x10\x00\x12\x00\x14"
+            b"\x02mx\x07example\x03com\x00",
+        ),
+    ],
+)
+def test_name_compression(tmp_path, domain, qry_type, answers):
+    """Names in the answers point to the question and to earlier names"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\n"
+        "ant   IN A     185.84.224.89\n"
+        "www   IN CNAME ant\n"
+        "mail  IN MX    10 ant\n"
+        "      IN MX    20 mx.example.com.\n"
+    )
+    zone = read_zone_file(str(zone_file))
+    header, section = zone[domain][qry_type]
+    assert header[4:6] == bytes((0, 2))
+    assert section == answers
+
+
+def test_answer_cache(zone):
+    """Answer repeated questions from the cache, echoing the question as sent"""
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    cache = AnswerCache()
+    first = b"\x12\xaf\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    again = b"\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03aNt\x05CS430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    response = answer_query(origin, zone, cache, first)
+    assert response == format_response(zone, *parse_request(origin, first))
+    assert (cache.hits, cache.misses) == (0, 1)
+    assert (
+        answer_query(origin, zone, cache, again)
+        == b"\xab\xcd" + response[2:12] + again[12:] + response[len(first) :]
+    )
+    assert (cache.hits, cache.misses) == (1, 1)
+    with pytest.raises(ValueError):
+        answer_query("luther.edu", zone, cache, first[:-1] + b"\x03")
+
+
+def test_answer_cache_eviction():
+    """Keep the most recently used questions"""
+    cache = AnswerCache(max_entries=2)
+    cache.put(b"a", b"", b"")
+    cache.put(b"b", b"", b"")
+    assert cache.get(b"a") is not None
+    cache.put(b"c", b"", b"")
+    assert cache.get(b"b") is None
+    assert list(cache.entries) == [b"a", b"c"]
+    cache.clear()
+    assert cache.get(b"a") is None
+
+
+def test_serve(zone):
+    """Answer a burst of datagrams and count them"""
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    stats = Counter()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, origin, zone, AnswerCache(), stats),
+        daemon=True,
+    ).start()
+    query = b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03cat\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        for trans_id in range(50):
+            client.sendto(
+                trans_id.to_bytes(2, "big") + query, server_sock.getsockname()
+            )
+        client.sendto(b"\x00\x00garbage", server_sock.getsockname())
+        responses = sorted(client.recv(4096) for _ in range(50))
+    expected = format_response(zone, *parse_request(origin, b"\x00\x00" + query))
+    assert responses == [
+        trans_id.to_bytes(2, "big") + expected[2:] for trans_id in range(50)
+    ]
+    for _ in range(100):
+        if stats["queries"] == 51:
+            break
+        time.sleep(0.01)
+    assert (stats["answered"], stats["ignored"]) == (50, 1)
+
+
+def test_zone_loader(tmp_path):
+    """Pick up a changed zone file and keep the old zone if the new one is broken"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text("$ORIGIN cs430.luther.edu.\n$TTL 1h\nant IN A 185.84.224.89\n")
+    loader = ZoneLoader(str(zone_file), interval=0)
+    assert list(loader.zone) == ["ant"]
+    assert not loader.check()
+    assert loader.take() is None
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\nant IN A 185.84.224.89\nbee IN A 1.2.3.4\n"
+    )
+    assert loader.check()
+    origin, zone = loader.take()
+    assert origin == "cs430.luther.edu"
+    assert list(zone) == ["ant", "bee"]
+    assert loader.take() is None
+    zone_file.write_text("$ORIGIN cs430.luther.edu.\nant IN A 185.84.224.999\n")
+    assert not loader.check()
+    assert loader.failures == 1
+    assert list(loader.zone) == ["ant", "bee"]
+    assert loader.check(forced=True) is False
+    assert (loader.reloads, loader.failures) == (1, 2)
+
+
+def test_serve_reload(tmp_path):
+    """Answer from the reloaded zone and drop the answers cached for the old one"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text("$ORIGIN cs430.luther.edu.\nant IN A 185.84.224.89\n")
+    loader = ZoneLoader(str(zone_file), interval=0)
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    cache = AnswerCache()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, loader.origin, loader.zone, cache, Counter()),
+        kwargs={"loader": loader},
+        daemon=True,
+    ).start()
+    query = b"\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        client.sendto(query, server_sock.getsockname())
+        assert client.recv(4096).endswith(bytes((185, 84, 224, 89)))
+        zone_file.write_text("$ORIGIN cs430.luther.edu.\nant IN A 10.0.0.1\n")
+        assert loader.check()
+        client.sendto(query, server_sock.getsockname())
+        assert client.recv(4096).endswith(bytes((10, 0, 0, 1)))
+    assert cache.misses == 2
+
+
+def big_zone(tmp_path) -> ZoneLoader:
+    """A zone with an RRset too large for a datagram"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\nant IN A 185.84.224.89\n"
+        + "".join(f"big IN A 10.0.0.{i}\n" for i in range(50))
+    )
+    return ZoneLoader(str(zone_file), interval=0)
+
+
+def test_truncate(tmp_path):
+    """Cut a response too long for a datagram down to its question"""
+    loader = big_zone(tmp_path)
+    query = b"\x00\x07\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03big\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    response = answer_query(loader.origin, loader.zone, None, query)
+    assert len(response) == len(query) + 50 * 16
+    truncated = truncate(response)
+    assert truncated[:4] == b"\x00\x07\x83\x00"
+    assert truncated[4:12] == b"\x00\x01\x00\x00\x00\x00\x00\x00"
+    assert truncated[12:] == query[12:]
+    short = answer_query(
+        loader.origin, loader.zone, None, query[:13] + b"ant" + query[16:]
+    )
+    assert truncate(short) == short
+
+
+def test_serve_tcp(tmp_path):
+    """Answer pipelined queries over TCP in full and truncate them over UDP"""
+    loader = big_zone(tmp_path)
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(server_sock.getsockname())
+    listener.listen()
+    stats = Counter()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, loader.origin, loader.zone, AnswerCache(), stats),
+        kwargs={"listener": listener, "idle_timeout": 0.5},
+        daemon=True,
+    ).start()
+    question = b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03big\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    expected = answer_query(loader.origin, loader.zone, None, b"\x00\x00" + question)
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        client.sendto(b"\x00\x01" + question, server_sock.getsockname())
+        assert client.recv(4096) == truncate(b"\x00\x01" + expected[2:])
+    queries = b"".join(
+        (2 + len(question)).to_bytes(2, "big") + trans_id.to_bytes(2, "big") + question
+        for trans_id in range(20)
+    )
+    with socket.create_connection(listener.getsockname(), timeout=5) as client:
+        client.sendall(queries[:5])
+        time.sleep(0.05)
+        client.sendall(queries[5:])
+        received = b""
+        while len(received) < 20 * (2 + len(expected)):
+            chunk = client.recv(65536)
+            assert chunk
+            received += chunk
+        responses, pos = [], 0
+        while pos < len(received):
+            size = int.from_bytes(received[pos : pos + 2], "big")
+            responses.append(received[pos + 2 : pos + 2 + size])
+            pos += 2 + size
+        assert responses == [
+            trans_id.to_bytes(2, "big") + expected[2:] for trans_id in range(20)
+        ]
+        assert client.recv(1) == b""
+    assert stats["truncated"] == 1
+    assert stats["tcp_answered"] == 20
+    assert stats["tcp_timeouts"] == 1
+
+
+def test_serve_tcp_oversized(tmp_path):
+    """Truncate a response too long for TCP and keep serving the connection"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(
+        "$ORIGIN cs430.luther.edu.\n$TTL 1h\nant IN A 185.84.224.89\n"
+        + "".join(f"huge IN A 10.0.{i // 256}.{i % 256}\n" for i in range(5000))
+    )
+    loader = ZoneLoader(str(zone_file), interval=0)
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(server_sock.getsockname())
+    listener.listen()
+    stats = Counter()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, loader.origin, loader.zone, None, stats),
+        kwargs={"listener": listener},
+        daemon=True,
+    ).start()
+    huge = b"\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x04huge\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    ant = b"\x00\x02\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    assert len(answer_query(loader.origin, loader.zone, None, huge)) > 65535
+    with socket.create_connection(listener.getsockname(), timeout=5) as client:
+        client.sendall(b"".join(len(q).to_bytes(2, "big") + q for q in (huge, ant)))
+        received = b""
+        while len(received) < 2 + len(huge) + 2:
+            chunk = client.recv(65536)
+            assert chunk
+            received += chunk
+        size = int.from_bytes(received[:2], "big")
+        assert received[2:6] == b"\x00\x01\x83\x00"
+        assert received[6:14] == b"\x00\x01\x00\x00\x00\x00\x00\x00"
+        assert received[14 : 2 + size] == huge[12:]
+        size_2 = int.from_bytes(received[2 + size : 4 + size], "big")
+        while len(received) < 4 + size + size_2:
+            received += client.recv(65536)
+        assert received[4 + size :].endswith(bytes((185, 84, 224, 89)))
+    assert stats["truncated"] == 1
+    assert stats["tcp_answered"] == 2
+
+
+def test_bind_socket_restart(zone, monkeypatch):
+    """Bind the TCP port again while connections closed by the server linger"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        port = probe.getsockname()[1]
+    monkeypatch.setattr("src.projects.nameserver.nameserver.HOST", "127.0.0.1")
+    monkeypatch.setattr("src.projects.nameserver.nameserver.PORT", port)
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    server_sock, listener = bind_socket(), bind_socket(kind=socket.SOCK_STREAM)
+    done = threading.Event()
+
+    def stop(report):
+        if done.is_set():
+            raise KeyboardInterrupt
+
+    def run_server():
+        with server_sock, listener, pytest.raises(KeyboardInterrupt):
+            serve(
+                server_sock,
+                origin,
+                zone,
+                None,
+                Counter(),
+                stop,
+                listener=listener,
+                idle_timeout=0.1,
+            )
+
+    server = threading.Thread(target=run_server, daemon=True)
+    server.start()
+    question = b"\x00\x07\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.create_connection(("127.0.0.1", port), timeout=5) as client:
+        client.sendall(len(question).to_bytes(2, "big") + question)
+        assert client.recv(4096)[2:4] == b"\x00\x07"
+        while client.recv(4096):
+            pass
+    done.set()
+    server.join(5)
+    assert not server.is_alive()
+    with bind_socket(kind=socket.SOCK_STREAM) as restarted:
+        assert restarted.getsockname() == ("127.0.0.1", port)
+
+
+TRIE_ZONE = """$ORIGIN cs430.luther.edu.
+$TTL 1h
+@                          IN A     10.0.0.1
+ant                        IN A     10.0.0.2
+a.b.c                      IN A     10.0.0.3
+*                          IN A     10.0.0.4
+                           IN MX    10 mail
+dev                        IN AAAA  ::1
+*.dev                      IN A     10.0.0.5
+www.ant.cs430.luther.edu.  IN CNAME ant
+"""
+
+
+def a_answer(owner: bytes, address: int) -> bytes:
+    """An A record with a one-hour TTL"""
+    return (
+        owner + b"\x00\x01\x00\x01\x00\x00\x0e\x10\x00\x04" + bytes((10, 0, 0, address))
+    )
+
+
+@pytest.mark.parametrize(
+    "name, qry_type, an_count, section",
+    [
+        ("", 1, 1, a_answer(b"\xc0\x0c", 1)),
+        ("ANT", 1, 1, a_answer(b"\xc0\x0c", 2)),
+        ("ant", 28, 0, b""),
+        ("a.b.c", 1, 1, a_answer(b"\xc0\x0c", 3)),
+        ("b.c", 1, 0, b""),
+        ("C", 1, 0, b""),
+        ("x.b.c", 1, None, b""),
+        ("zebra", 1, 1, a_answer(b"\xc0\x0c", 4)),
+        ("deep.Zebra", 1, 1, a_answer(b"\xc0\x0c", 4)),
+        ("zebra", 28, 0, b""),
+        (
+            "zebra",
+            15,
+            1,
+            b"\xc0\x0c\x00\x0f\x00\x01\x00\x00\x0e\x10\x00\x19\x00\x0a"
+            b"\x04mail\x05cs430\x06luther\x03edu\x00",
+        ),
+        ("dev", 1, 0, b""),
+        ("x.dev", 1, 1, a_answer(b"\xc0\x0c", 5)),
+        (
+            "www.ant",
+            1,
+            2,
+            b"\xc0\x0c\x00\x05\x00\x01\x00\x00\x0e\x10\x00\x02\xc0\x10"
+            + a_answer(b"\xc0\x10", 2),
+        ),
+    ],
+)
+def test_zone_lookup(tmp_path, name, qry_type, an_count, section):
+    """Tell names, empty non-terminals, wildcards and missing names apart"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(TRIE_ZONE)
+    _, zone = load_zone(str(zone_file))
+    header, answers = zone.lookup(name, qry_type)
+    if an_count is None:
+        assert (header, answers) == NXDOMAIN
+    else:
+        assert header[:2] == b"\x81\x00"
+        assert bytes_to_val(header[4:6]) == an_count
+        assert answers == section
+
+
+def test_zone_mapping(tmp_path):
+    """The zone reads as a mapping of the names with records"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(TRIE_ZONE)
+    _, zone = load_zone(str(zone_file))
+    assert len(zone) == 7
+    assert sorted(zone) == ["", "*", "*.dev", "a.b.c", "ant", "dev", "www.ant"]
+    assert "b.c" not in zone and "ANT" in zone
+    assert list(zone["*"]) == [1, 15]
+    with pytest.raises(KeyError):
+        zone["c"]
+
+
+def test_answer_query_wildcard(tmp_path):
+    """Synthesize wildcard answers for questions of any length and case"""
+    zone_file = tmp_path / "test.zone"
+    zone_file.write_text(TRIE_ZONE)
+    origin, zone = load_zone(str(zone_file))
+    cache = AnswerCache()
+    for name in (b"\x01x", b"\x0ea-longer-label", b"\x01X\x03DEV"):
+        question = name + b"\x05cs430\x06luther\x03edu\x00\x00\x0f\x00\x01"
+        msg = b"\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + question
+        for _ in range(2):
+            response = answer_query(origin, zone, cache, msg)
+            assert response[12 : 12 + len(question)] == question
+            if name.endswith(b"DEV"):
+                assert response[6:8] == b"\x00\x00"
+            else:
+                assert response[6:8] == b"\x00\x01"
+                assert response[len(msg) : len(msg) + 2] == b"\xc0\x0c"
+                assert response.endswith(b"\x04mail\x05cs430\x06luther\x03edu\x00")
+
+
+@pytest.mark.parametrize(
+    "durations, pct, bound",
+    [
+        ([500, 1500, 2500, 3500], 50, 2),
+        ([500, 1500, 2500, 3500], 100, 4),
+        ([10**12], 99, 1 << 23),
+        ([], 50, 0),
+    ],
+)
+def test_latency_histogram(durations, pct, bound):
+    """Percentiles are the upper bounds of power-of-two microsecond buckets"""
+    histogram = LatencyHistogram()
+    for nanoseconds in durations:
+        histogram.add(nanoseconds)
+    assert histogram.percentile(pct) == bound
+
+
+def test_query_stats(zone):
+    """Count questions case-insensitively, with and without the cache"""
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    header = b"\x00\x01\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00"
+    ant = b"\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    gnu = b"\x03GNU\x05cs430\x06luther\x03edu\x00\x00\x1c\x00\x01"
+    for cache in (None, AnswerCache()):
+        query_stats = QueryStats(capacity=10)
+        for question in (ant, ant.replace(b"ant", b"ANT"), ant, gnu):
+            response = answer_query(origin, zone, cache, header + question, query_stats)
+            assert response == answer_query(origin, zone, None, header + question)
+        report = query_stats.report()
+        assert report["queries"] == 4
+        assert report["rcodes"] == {"NOERROR": 3, "NXDOMAIN": 1}
+        assert report["top"] == [
+            ("ant.cs430.luther.edu. A", 3, 0),
+            ("gnu.cs430.luther.edu. AAAA", 1, 0),
+        ]
+        assert sum(report["parse_histogram"]) == 4
+
+
+def test_stats_response():
+    """Answer `stats.bind.` in the CHAOS class with a TXT record per line"""
+    query_stats = QueryStats()
+    query_stats.add(
+        b"\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01", 0, 900, 2000
+    )
+    question = b"\x05Stats\x04BIND\x00\x00\x10\x00\x03"
+    response = stats_response(
+        b"\xab\xcd\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00" + question, query_stats
+    )
+    assert response[:12] == b"\xab\xcd\x81\x00\x00\x01\x00\x04\x00\x00\x00\x00"
+    assert response[12 : 12 + len(question)] == question
+    lines, pos = [], 12 + len(question)
+    while pos < len(response):
+        assert response[pos : pos + 10] == b"\xc0\x0c\x00\x10\x00\x03\x00\x00\x00\x00"
+        size = bytes_to_val(response[pos + 10 : pos + 12])
+        assert response[pos + 12] == size - 1
+        lines.append(response[pos + 13 : pos + 12 + size].decode())
+        pos += 12 + size
+    assert lines == [
+        "queries=1 NOERROR=1 ignored=0",
+        "parse_us p50=1 p90=1 p99=1",
+        "lookup_us p50=4 p90=4 p99=4",
+        "top ant.cs430.luther.edu. A 1",
+    ]
+    in_class = b"\x05stats\x04bind\x00\x00\x10\x00\x01"
+    assert (
+        stats_response(b"\x00\x01\x01\x00\x00\x01" + bytes(6) + in_class, query_stats)
+        is None
+    )
+
+
+def test_serve_stats(zone, tmp_path):
+    """Answer the stats query while serving and write the stats file on exit"""
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    query_stats = QueryStats()
+    stats_file = tmp_path / "stats.json"
+    done = threading.Event()
+
+    def stop(report):
+        if done.is_set():
+            raise KeyboardInterrupt
+
+    def run_server():
+        with pytest.raises(KeyboardInterrupt):
+            serve(
+                server_sock,
+                origin,
+                zone,
+                None,
+                Counter(),
+                stop,
+                query_stats=query_stats,
+                stats_file=str(stats_file),
+            )
+
+    server = threading.Thread(target=run_server, daemon=True)
+    server.start()
+    query = b"\x00\x07\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    stats_query = b"\x00\x08\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x05stats\x04bind\x00\x00\x10\x00\x03"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        client.sendto(query, server_sock.getsockname())
+        client.recv(4096)
+        client.sendto(stats_query, server_sock.getsockname())
+        response = client.recv(4096)
+    assert response[:2] == b"\x00\x08"
+    assert b"top ant.cs430.luther.edu. A 1" in response
+    done.set()
+    server.join(5)
+    report = json.loads(stats_file.read_text())
+    assert report["queries"] == 1
+    assert report["top"] == [["ant.cs430.luther.edu. A", 1, 0]]
+
+
+def test_serve_stats_dump_error(zone, tmp_path, monkeypatch):
+    """Keep serving when the stats file cannot be written"""
+    monkeypatch.setattr("src.projects.nameserver.nameserver.STATS_DUMP_INTERVAL", 0)
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    stats = Counter()
+    done = threading.Event()
+    stopped = []
+
+    def stop(report):
+        if done.is_set():
+            raise KeyboardInterrupt
+
+    def run_server():
+        try:
+            serve(
+                server_sock,
+                origin,
+                zone,
+                None,
+                stats,
+                stop,
+                query_stats=QueryStats(),
+                stats_file=str(tmp_path / "missing" / "stats.json"),
+            )
+        except BaseException as err:
+            stopped.append(err)
+
+    server = threading.Thread(target=run_server, daemon=True)
+    server.start()
+    for _ in range(50):
+        if stats["stats_dump_errors"]:
+            break
+        time.sleep(0.1)
+    query = b"\x00\x07\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        client.sendto(query, server_sock.getsockname())
+        assert client.recv(4096)[:2] == b"\x00\x07"
+    done.set()
+    server.join(5)
+    assert [type(err) for err in stopped] == [KeyboardInterrupt]
+    assert stats["stats_dump_errors"] >= 2
+
+
+@pytest.mark.parametrize(
+    "client_a, client_b, shared",
+    [
+        (("192.0.2.1", 5300), ("192.0.2.200", 5301), True),
+        (("192.0.2.1", 5300), ("192.0.3.1", 5300), False),
+        (("2001:db8:0:ff::1", 5300, 0, 0), ("2001:db8:0:1::2", 5300, 0, 0), True),
+        (("2001:db8:0:100::1", 5300, 0, 0), ("2001:db8::1", 5300, 0, 0), False),
+    ],
+)
+def test_rate_limiter_prefix(client_a, client_b, shared):
+    """Clients in the same /24 or /56 share a bucket"""
+    assert (RateLimiter.prefix(client_a) == RateLimiter.prefix(client_b)) == shared
+
+
+def test_rate_limiter():
+    """Refill the buckets at the rate, slip every other limited response"""
+    limiter = RateLimiter(2, slip=2, max_entries=2)
+    verdicts = [limiter.check(("10.0.0.1", 5300 + i), 0.0) for i in range(5)]
+    assert verdicts == ["answer", "answer", "drop", "slip", "drop"]
+    assert limiter.check(("10.0.0.9", 5300), 0.5) == "answer"
+    assert limiter.check(("10.0.0.9", 5300), 0.5) == "slip"
+    assert limiter.check(("10.0.1.1", 5300), 0.6) == "answer"
+    assert limiter.check(("::1", 5300, 0, 0), 0.7) == "answer"
+    assert len(limiter.buckets) == 2
+    assert limiter.check(("10.0.0.1", 5300), 0.7) == "answer"
+    limiter.expire(1.5)
+    assert len(limiter.buckets) == 2
+    limiter.expire(1.7)
+    assert len(limiter.buckets) == 0
+    assert RateLimiter(0.5, slip=0).check(("10.0.0.1", 5300), 0.0) == "answer"
+    with pytest.raises(ValueError):
+        RateLimiter(0)
+
+
+def test_slip_response():
+    """An empty truncated answer echoing the question"""
+    query = b"\x00\x09\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    assert (
+        slip_response(query)
+        == b"\x00\x09\x83\x00\x00\x01\x00\x00\x00\x00\x00\x00" + query[12:]
+    )
+    assert slip_response(query[:14]) is None
+
+
+def test_serve_rate_limit(zone):
+    """Drop or slip the responses to a client over its rate"""
+    origin = get_origin("data/projects/nameserver/zoo.zone")
+    server_sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    server_sock.bind(("127.0.0.1", 0))
+    stats = Counter()
+    threading.Thread(
+        target=serve,
+        args=(server_sock, origin, zone, None, stats),
+        kwargs={"limiter": RateLimiter(0.01, slip=2)},
+        daemon=True,
+    ).start()
+    query = b"\x00\x0a\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(5)
+        client.sendto(query, server_sock.getsockname())
+        answer = client.recv(4096)
+        for _ in range(4):
+            client.sendto(query, server_sock.getsockname())
+        slipped = [client.recv(4096), client.recv(4096)]
+        client.settimeout(0.2)
+        with pytest.raises(socket.timeout):
+            client.recv(4096)
+    assert bytes_to_val(answer[6:8]) == 2
+    assert slipped == [slip_response(query)] * 2
+    assert (stats["queries"], stats["rrl_dropped"], stats["rrl_slipped"]) == (5, 2, 2)
+
+
+def child_pids(pid: int) -> set[int]:
+    """Processes started by a process"""
+    return {
+        int(child) for child in open(f"/proc/{pid}/task/{pid}/children").read().split()
+    }
+
+
+def wait_until(predicate, timeout: float = 10.0) -> None:
+    """Poll until the predicate holds"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+def ask(addr: tuple, trans_id: int) -> bytes:
+    """The response to an A query for ant, or b"" if none arrives soon"""
+    query = b"\x01\x00\x00\x01\x00\x00\x00\x00\x00\x00\x03ant\x05cs430\x06luther\x03edu\x00\x00\x01\x00\x01"
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as client:
+        client.settimeout(0.5)
+        client.sendto(trans_id.to_bytes(2, "big") + query, addr)
+        try:
+            return client.recv(4096)
+        except OSError:
+            return b""
+
+
+def run_supervisor(n_workers: int, filename: str) -> None:
+    """Supervise the workers until interrupted, as the server's main() does"""
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        supervise(n_workers, filename, 100, 0, Counter(), top_capacity=0)
+    except KeyboardInterrupt:
+        pass
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="Needs /proc")
+@pytest.mark.parametrize("stop_signal", [signal.SIGINT, signal.SIGTERM])
+def test_supervise(monkeypatch, stop_signal):
+    """Answer from worker processes, restart a dead one and stop them all"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        addr = probe.getsockname()
+    monkeypatch.setattr("src.projects.nameserver.nameserver.HOST", addr[0])
+    monkeypatch.setattr("src.projects.nameserver.nameserver.PORT", addr[1])
+    supervisor = multiprocessing.Process(
+        target=run_supervisor, args=(2, "data/projects/nameserver/zoo.zone")
+    )
+    supervisor.start()
+    try:
+        wait_until(lambda: len(child_pids(supervisor.pid)) == 2)
+        wait_until(lambda: ask(addr, 1)[:2] == b"\x00\x01")
+        workers = child_pids(supervisor.pid)
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        wait_until(
+            lambda: len(children := child_pids(supervisor.pid)) == 2
+            and killed not in children
+        )
+        restarted = child_pids(supervisor.pid)
+        assert workers < restarted
+        for trans_id in range(2, 12):
+            wait_until(lambda: ask(addr, trans_id)[:2] == trans_id.to_bytes(2, "big"))
+        os.kill(supervisor.pid, stop_signal)
+        supervisor.join(10)
+        assert supervisor.exitcode == 0
+        assert not any(os.path.exists(f"/proc/{pid}") for pid in restarted)
+    finally:
+        if supervisor.is_alive():
+            # Stopped first so that it cannot restart the workers killed here
+            os.kill(supervisor.pid, signal.SIGSTOP)
+            for pid in child_pids(supervisor.pid):
+                os.kill(pid, signal.SIGKILL)
+            supervisor.kill()
+            supervisor.join()
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="Needs /proc")
+def test_supervise_reload_while_loading(monkeypatch):
+    """Keep the workers that get SIGHUP while they are still loading the zone"""
+    with socket.socket(socket.AF_INET, socket.SOCK_DGRAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        addr = probe.getsockname()
+    monkeypatch.setattr("src.projects.nameserver.nameserver.HOST", addr[0])
+    monkeypatch.setattr("src.projects.nameserver.nameserver.PORT", addr[1])
+    load = ZoneLoader.__init__
+
+    def slow_load(self, *args, **kwargs):
+        time.sleep(0.5)
+        load(self, *args, **kwargs)
+
+    monkeypatch.setattr(ZoneLoader, "__init__", slow_load)
+    supervisor = multiprocessing.Process(
+        target=run_supervisor, args=(2, "data/projects/nameserver/zoo.zone")
+    )
+    supervisor.start()
+    try:
+        wait_until(lambda: len(child_pids(supervisor.pid)) == 2)
+        workers = child_pids(supervisor.pid)
+        os.kill(supervisor.pid, signal.SIGHUP)
+        for trans_id in range(1, 11):
+            wait_until(lambda: ask(addr, trans_id)[:2] == trans_id.to_bytes(2, "big"))
+        assert child_pids(supervisor.pid) == workers
+        os.kill(supervisor.pid, signal.SIGTERM)
+        supervisor.join(10)
+        assert supervisor.exitcode == 0
+    finally:
+        if supervisor.is_alive():
+            os.kill(supervisor.pid, signal.SIGSTOP)
+            for pid in child_pids(supervisor.pid):
+                os.kill(pid, signal.SIGKILL)
+            supervisor.kill()
+            supervisor.join()
+
+
 @pytest.mark.skip(reason="Work in progress")
 def test_run_mock(mock_request, exp_response) -> None:
     """Test main loop with mock requests"""
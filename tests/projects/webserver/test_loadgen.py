@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+"""
+`web server` load generator testing
+
+@authors:
+@version:
+"""
+
+import importlib
+import pathlib
+import socket
+import sys
+import threading
+
+import pytest
+
+try:
+    importlib.util.find_spec(".".join(pathlib.Path(__file__).parts[-3:-1]), "src")
+except ModuleNotFoundError:
+    sys.path.append(f"{pathlib.Path(__file__).parents[3]}/")
+finally:
+    from src.projects.webserver.loadgen import (
+        ResponseReader,
+        parse_mix,
+        percentile,
+        run_load,
+    )
+
+
+@pytest.mark.parametrize(
+    "mix, targets",
+    [
+        (
+            "GET:/alice30.txt=6,POST:/test405.txt=1",
+            [("GET", "/alice30.txt", 6.0), ("POST", "/test405.txt", 1.0)],
+        ),
+        ("head:/test501.txt", [("HEAD", "/test501.txt", 1.0)]),
+    ],
+)
+def test_parse_mix(mix, targets):
+    """Parse the request mix"""
+    assert parse_mix(mix) == targets
+
+
+@pytest.mark.parametrize("mix", ["GET /alice30.txt=6", "GET:alice30.txt"])
+def test_parse_mix_error(mix):
+    """Reject an invalid request mix"""
+    with pytest.raises(ValueError):
+        parse_mix(mix)
+
+
+@pytest.mark.parametrize(
+    "pct, value", [(0, 1), (50, 50), (90, 90), (99, 99), (100, 100)]
+)
+def test_percentile(pct, value):
+    """Nearest-rank percentiles"""
+    assert percentile(list(range(1, 101)), pct) == value
+
+
+@pytest.mark.parametrize(
+    "chunks, head_only, status, keep_alive",
+    [
+        (
+            [b"HTTP/1.1 200 OK\r\nContent-Length: 6\r\n", b"\r\nHel", b"lo\n"],
+            False,
+            200,
+            True,
+        ),
+        (
+            [
+                b"HTTP/1.1 200 OK\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nHel",
+                b"\r\n3\r\nlo\n\r\n0\r",
+                b"\n\r\n",
+            ],
+            False,
+            200,
+            True,
+        ),
+        ([b'HTTP/1.1 304 Not Modified\r\nETag: "1"\r\n\r\n'], False, 304, True),
+        (
+            [b"HTTP/1.1 501 Not Implemented\r\nContent-Length: 0\r\n\r\n"],
+            True,
+            501,
+            True,
+        ),
+        (
+            [
+                b"HTTP/1.1 404 Not Found\r\nConnection: close\r\nContent-Length: 1\r\n\r\nx"
+            ],
+            False,
+            404,
+            False,
+        ),
+    ],
+)
+def test_response_reader(chunks, head_only, status, keep_alive):
+    """Tell when a response is complete"""
+    reader = ResponseReader(head_only)
+    assert [reader.feed(chunk) for chunk in chunks] == [False] * (len(chunks) - 1) + [
+        True
+    ]
+    assert reader.status == status
+    assert reader.keep_alive == keep_alive
+
+
+def test_response_reader_until_close():
+    """A response without framing ends with the connection"""
+    reader = ResponseReader()
+    assert not reader.feed(b"HTTP/1.1 200 OK\r\n\r\nHello\n")
+    assert reader.finish()
+    assert not reader.keep_alive
+
+
+def test_run_load_replaces_failed_connection():
+    """Keep the closed-loop concurrency after a connection fails"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(("127.0.0.1", 0))
+    listener.listen()
+    lock = threading.Lock()
+    open_conns = set()
+    seen = []  # Open connections when each request arrived
+
+    def handle(conn: socket.socket) -> None:
+        with conn:
+            buffer = b""
+            while data := conn.recv(4096):
+                buffer += data
+                while b"\r\n\r\n" in buffer:
+                    _, _, buffer = buffer.partition(b"\r\n\r\n")
+                    with lock:
+                        seen.append(len(open_conns))
+                        fail = len(seen) == 3
+                        if fail:
+                            open_conns.discard(conn)
+                    if fail:
+                        return
+                    conn.sendall(b"HTTP/1.1 200 OK\r\nContent-Length: 0\r\n\r\n")
+        with lock:
+            open_conns.discard(conn)
+
+    def accept() -> None:
+        while True:
+            conn, _ = listener.accept()
+            with lock:
+                open_conns.add(conn)
+            threading.Thread(target=handle, args=(conn,), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+    report = run_load(
+        listener.getsockname(),
+        [("GET", "/test.txt", 1.0)],
+        concurrency=4,
+        duration=0,
+        total=40,
+        timeout=2,
+    )
+    listener.close()
+    assert report["errors"] == {"ConnectionClosed": 1}
+    assert report["requests"] == 39
+    assert seen[-1] == 4
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+`web server` log analyzer testing
+
+@authors:
+@version:
+"""
+
+import gzip
+import importlib
+import pathlib
+import random
+import sys
+from collections import Counter
+
+import pytest
+
+try:
+    importlib.util.find_spec(".".join(pathlib.Path(__file__).parts[-3:-1]), "src")
+except ModuleNotFoundError:
+    sys.path.append(f"{pathlib.Path(__file__).parents[3]}/")
+finally:
+    from src.projects.webserver.log_analyzer import (
+        HyperLogLog,
+        LogStats,
+        SpaceSaving,
+        agent_family,
+        follow,
+        parse_line,
+        read_lines,
+    )
+
+
+@pytest.mark.parametrize(
+    "line, record",
+    [
+        (
+            "2024-10-20 10:00:00.123456 | /alice30.txt | 127.0.0.1 | curl/8.5.0\n",
+            ("2024-10-20 10:00:00.123456", "/alice30.txt", "127.0.0.1", "curl/8.5.0"),
+        ),
+        (
+            "2024-10-20 10:00:01.000001 | /test.txt | 127.0.0.1 | a | b\n",
+            ("2024-10-20 10:00:01.000001", "/test.txt", "127.0.0.1", "a | b"),
+        ),
+        ("2024-10-20 10:00:01 | /test.txt\n", None),
+        ("this is not a timestamp | /a | 127.0.0.1 | curl/8.5.0\n", None),
+        ("2024-10-20 25:00:01.000001 | /a | 127.0.0.1 | curl/8.5.0\n", None),
+        ("\n", None),
+    ],
+)
+def test_parse_line(line, record):
+    """Split a log record"""
+    assert parse_line(line) == record
+
+
+@pytest.mark.parametrize(
+    "user_agent, family",
+    [
+        ("curl/8.5.0", "curl"),
+        ("cs430-loadgen", "loadgen"),
+        (
+            "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) "
+            "Chrome/120.0.0.0 Safari/537.36",
+            "Chrome",
+        ),
+        (
+            "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, "
+            "like Gecko) Chrome/120.0.0.0 Safari/537.36 Edg/120.0.0.0",
+            "Edge",
+        ),
+        ("Mozilla/5.0 (compatible; Googlebot/2.1)", "Bot"),
+        ("Lynx/2.8.9rel.1 libwww-FM/2.14", "Lynx"),
+        ("", "unknown"),
+    ],
+)
+def test_agent_family(user_agent, family):
+    """Group user agents into families"""
+    assert agent_family(user_agent) == family
+
+
+def test_space_saving():
+    """Keep the heavy hitters of a skewed stream within the capacity"""
+    rnd = random.Random(430)
+    stream = [f"/{int(rnd.paretovariate(1.0))}" for _ in range(20000)]
+    stream += [f"/unique{i}" for i in range(2000)]
+    rnd.shuffle(stream)
+    exact = Counter(stream)
+    sketch = SpaceSaving(50)
+    for key in stream:
+        sketch.add(key)
+    assert len(sketch.counts) == 50
+    for key, count, error in sketch.top(5):
+        assert count - error <= exact[key] <= count
+    assert [key for key, _, _ in sketch.top(3)] == [
+        key for key, _ in exact.most_common(3)
+    ]
+
+
+@pytest.mark.parametrize("n_keys", [0, 10, 1000, 50000])
+def test_hyperloglog(n_keys):
+    """Estimate distinct counts within a few percent"""
+    hll = HyperLogLog(12)
+    for i in range(n_keys):
+        hll.add(f"10.0.{i // 256}.{i % 256}")
+        hll.add(f"10.0.{i // 256}.{i % 256}")
+    assert abs(hll.count() - n_keys) <= max(1, 0.05 * n_keys)
+
+
+def write_log(path: pathlib.Path, lines: list[str]) -> None:
+    """Write log lines, gzipped if the name says so"""
+    opener = gzip.open if path.suffix == ".gz" else open
+    with opener(path, "wt") as file:
+        file.writelines(lines)
+
+
+def test_log_stats(tmp_path):
+    """Summarize plain and gzipped log files"""
+    lines = [
+        f"2024-10-20 10:00:0{i // 4}.{i:06d} | /p{i % 3} | 10.0.0.{i % 2} | curl/8.5.0\n"
+        for i in range(12)
+    ]
+    write_log(tmp_path / "webserver.log.1.gz", lines[:6])
+    write_log(
+        tmp_path / "webserver.log",
+        lines[6:] + ["garbage\n", "this is not a timestamp | /a | 10.0.0.1 | curl\n"],
+    )
+    stats = LogStats(capacity=10)
+    for line in read_lines(
+        [tmp_path / "webserver.log.1.gz", tmp_path / "webserver.log"]
+    ):
+        stats.add(line)
+    report = stats.report(2)
+    assert report["requests"] == 12
+    assert report["skipped"] == 2
+    assert report["first"] == "2024-10-20 10:00:00.000000"
+    assert report["peak_rate"] == 4
+    assert report["distinct_paths"] == 3
+    assert report["distinct_clients"] == 2
+    assert report["top_paths"] == [("/p0", 4, 0), ("/p1", 4, 0)]
+    assert report["user_agents"] == [("curl", 12, 0)]
+
+
+def test_follow(tmp_path):
+    """Pick up appended lines and continue after the file is rotated"""
+    logfile = tmp_path / "webserver.log"
+    logfile.write_text("first\npar")
+    lines = follow(logfile, poll_interval=0)
+    assert next(lines) == "first\n"
+    assert next(lines) == ""
+    with open(logfile, "a") as file:
+        file.write("tial\n")
+    assert next(lines) == "partial\n"
+    logfile.rename(tmp_path / "webserver.log.1")
+    logfile.write_text("rotated\n")
+    assert next(lines) == "rotated\n"
+    lines.close()
+
+
+if __name__ == "__main__":
+    pytest.main(["-v", __file__])
@@ -6,9 +6,19 @@
 @version: 2024.10
 """
 
+import errno
+import gzip
 import importlib
+import multiprocessing
+import os
 import pathlib
+import select
+import signal
+import socket
 import sys
+import threading
+import time
+from collections import Counter
 
 import pytest
 from freezegun import freeze_time
@@ -18,7 +28,27 @@ try:
 except ModuleNotFoundError:
     sys.path.append(f"{pathlib.Path(__file__).parents[3]}/")
 finally:
-    from src.projects.webserver.server import format_response, parse_request
+    from src.projects.webserver.server import (
+        ChunkStream,
+        FileCache,
+        FileRegion,
+        HeadTooLarge,
+        LogWriter,
+        Request,
+        RequestParser,
+        connection_limit,
+        format_response,
+        format_stream_response,
+        handle_request,
+        negotiate_encoding,
+        parse_range,
+        parse_request,
+        resolve_path,
+        send_parts,
+        serve_concurrent,
+        supervise,
+        wants_keep_alive,
+    )
 
 
 @pytest.mark.parametrize(
@@ -117,5 +147,711 @@ def test_format_response(http_version, status_code, header, data, result):
     assert format_response(http_version, status_code, header, data) == result
 
 
+@pytest.mark.parametrize(
+    "head, keep_alive",
+    [
+        (b"GET / HTTP/1.1\r\nHost: 127.0.0.2:43080", True),
+        (b"GET / HTTP/1.1\r\nConnection: close", False),
+        (b"GET / HTTP/1.0\r\nHost: 127.0.0.2:43080", False),
+        (b"GET / HTTP/1.0\r\nConnection: Keep-Alive", True),
+    ],
+)
+def test_wants_keep_alive(head, keep_alive):
+    """Decide on connection persistence"""
+    assert wants_keep_alive(Request(head)) == keep_alive
+
+
+@pytest.mark.parametrize(
+    "chunks, urls, leftover",
+    [
+        (
+            [b"GET /test.txt HTTP/1.1\r\nHost: 127.0.0.2:43080\r\n\r\n"],
+            ["/test.txt"],
+            b"",
+        ),
+        (
+            [b"GET /test.txt HT", b"TP/1.1\r\nHost: 127.0.0.2", b":43080\r\n\r", b"\n"],
+            ["/test.txt"],
+            b"",
+        ),
+        (
+            [
+                b"GET /a.txt HTTP/1.1\r\n\r\nGET /b.txt HTTP/1.1\r\n\r\nGET /c",
+                b".txt HTTP/1.1\r\n\r\n",
+            ],
+            ["/a.txt", "/b.txt", "/c.txt"],
+            b"",
+        ),
+        (
+            [
+                b"POST /a.txt HTTP/1.1\r\nContent-Length: 9\r\n\r\nname=",
+                b"alexGET /b.txt HTTP/1.1\r\n\r\nGET /c.txt",
+            ],
+            ["/a.txt", "/b.txt"],
+            b"GET /c.txt",
+        ),
+        ([b"\r\n\r\nGET /a.txt HTTP/1.1\r\n\r\n"], ["/a.txt"], b""),
+        (
+            [
+                b"GET /a.txt HTTP/1.1\r\n\r\n\r\n",
+                b"\r",
+                b"\nGET /b.txt HTTP/1.1\r\n\r\n",
+            ],
+            ["/a.txt", "/b.txt"],
+            b"",
+        ),
+        ([b"\r\n\r\n\r\n"], [], b""),
+    ],
+)
+def test_request_parser(chunks, urls, leftover):
+    """Parse fragmented and pipelined requests"""
+    parser = RequestParser()
+    requests = [request for chunk in chunks for request in parser.feed(chunk)]
+    assert [request.url for request in requests] == urls
+    assert parser.buffer == leftover
+
+
+@pytest.mark.parametrize(
+    "head",
+    [
+        b"GET /test.txt\r\nHost: 127.0.0.2:43080",
+        b"\x16\x03\x01\x02\x00\x01",
+        b"POST /a HTTP/1.1\r\nContent-Length: -30",
+        b"POST /a HTTP/1.1\r\nContent-Length: +5",
+        b"POST /a HTTP/1.1\r\nContent-Length: 1_000",
+        b"POST /a HTTP/1.1\r\nContent-Length: 5 5",
+        b"POST /a HTTP/1.1\r\nContent-Length: ",
+    ],
+)
+def test_request_parser_error(head):
+    """Reject streams that are not HTTP"""
+    with pytest.raises(ValueError):
+        RequestParser().feed(head + b"\r\n\r\n")
+
+
+def test_request_parser_negative_length():
+    """A negative Content-Length cannot rewind into the data already parsed"""
+    parser = RequestParser()
+    with pytest.raises(ValueError, match="Malformed Content-Length"):
+        parser.feed(
+            b"POST /a HTTP/1.1\r\nContent-Length: -30\r\n\r\nGET /b HTTP/1.1\r\n\r\n"
+        )
+
+
+@pytest.mark.parametrize(
+    "method, url, keep_alive, status_line, connection",
+    [
+        ("GET", "/test.txt", True, b"HTTP/1.1 200 OK\r\n", None),
+        ("GET", "/../../README.md", False, b"HTTP/1.1 404 Not Found\r\n", b"close"),
+        ("POST", "/test.txt", True, b"HTTP/1.1 405 Method Not Allowed\r\n", None),
+        ("HEAD", "/test.txt", False, b"HTTP/1.1 501 Not Implemented\r\n", b"close"),
+    ],
+)
+def test_handle_request(method, url, keep_alive, status_line, connection):
+    """Build a response for a request"""
+    request = Request(f"{method} {url} HTTP/1.1".encode())
+    parts = handle_request(request, keep_alive)
+    head, _, body = parts[0].partition(b"\r\n\r\n")
+    for part in parts[1:]:
+        if isinstance(part, bytes):
+            body += part
+        else:
+            body += os.pread(part.file.fileno(), part.count, part.offset)
+            part.close()
+    assert head.startswith(status_line)
+    assert (b"Connection: close" in head) == (connection == b"close")
+    assert b"Content-Length: %d" % len(body) in head
+
+
+@pytest.mark.parametrize("url", ["/a\x00b.txt", "/test.txt\x00", "/%00"])
+def test_resolve_path_invalid(url):
+    """Treat invalid paths as missing files"""
+    assert resolve_path(url) is None
+
+
+def test_file_cache(tmp_path):
+    """Cache file responses, revalidate them, and stay within the budget"""
+    hot, cold = tmp_path / "hot.txt", tmp_path / "cold.txt"
+    hot.write_bytes(b"Hello\n")
+    cold.write_bytes(b"x" * 100)
+    cache = FileCache(300)
+    assert cache.get(hot).body == b"Hello\n"
+    assert cache.get(hot) is cache.get(hot)
+    assert (cache.hits, cache.misses) == (2, 1)
+    assert b"Content-Length: 6\r\n" in cache.get(hot).fields
+    hot.write_bytes(b"Hello, world\n")
+    assert cache.get(hot).body == b"Hello, world\n"
+    assert cache.misses == 2
+    cache.get(cold)
+    assert hot not in cache.entries
+    assert cache.total_bytes <= cache.max_bytes
+
+
+def test_log_writer(tmp_path):
+    """Write records in batches and rotate the log file by size"""
+    logfile = tmp_path / "webserver.log"
+    records = [
+        f"2024-10-02 18:50:45.{n:06} | /test.txt | 127.0.0.1 | curl/8.5.0\n"
+        for n in range(30)
+    ]
+    with LogWriter(logfile, flush_bytes=200, max_bytes=1000, backups=2) as log:
+        for record in records:
+            log.write(record)
+    assert log.stats()["written"] == len(records)
+    assert log.stats()["dropped"] == 0
+    assert log.rotations >= 2
+    kept = [
+        logfile.with_name("webserver.log.2"),
+        logfile.with_name("webserver.log.1"),
+        logfile,
+    ]
+    text = "".join(path.read_text() for path in kept)
+    assert text == "".join(records)[-len(text) :]
+    assert all(path.stat().st_size <= 1000 for path in kept)
+
+
+def test_log_writer_open_error(tmp_path):
+    """Fail right away when the log file cannot be opened"""
+    with pytest.raises(FileNotFoundError):
+        LogWriter(tmp_path / "missing" / "webserver.log")
+
+
+@pytest.mark.skipif(not os.path.exists("/dev/full"), reason="Needs /dev/full")
+def test_log_writer_write_error():
+    """Count the records that cannot be written and still stop promptly"""
+    log = LogWriter(pathlib.Path("/dev/full"), max_queue=2, flush_bytes=1)
+    for _ in range(20):
+        log.write("x\n")
+    started = time.monotonic()
+    log.close()
+    assert time.monotonic() - started < 1
+    assert not log.thread.is_alive()
+    stats = log.stats()
+    assert stats["written"] == 0
+    assert stats["failed"] == stats["queued"] > 0
+
+
+@pytest.mark.parametrize(
+    "accept_encoding, coding",
+    [
+        (b"gzip, deflate, br", "gzip"),
+        (b"deflate, gzip;q=0.5", "deflate"),
+        (b"gzip;q=0, deflate", "deflate"),
+        (b"br", None),
+        (b"*;q=0.1", "gzip"),
+        (b"identity", None),
+        (b"", None),
+    ],
+)
+def test_negotiate_encoding(accept_encoding, coding):
+    """Choose the content coding"""
+    assert negotiate_encoding(accept_encoding) == coding
+
+
+def test_compressed_response():
+    """Serve a cached gzip variant of a file"""
+    cache = FileCache()
+    request = Request(
+        b"GET /alice30.txt HTTP/1.1\r\nAccept-Encoding: gzip, deflate, br"
+    )
+    head, body = handle_request(request, True, cache)
+    assert b"Content-Encoding: gzip\r\n" in head
+    assert b"Vary: Accept-Encoding\r\n" in head
+    assert b"Content-Length: %d\r\n" % len(body) in head
+    assert gzip.decompress(body) == cache.get(resolve_path("/alice30.txt")).body
+    assert handle_request(request, True, cache)[1] is body
+
+
+@pytest.mark.parametrize(
+    "condition, status_line",
+    [
+        (b"If-None-Match: {etag}", b"HTTP/1.1 304 Not Modified\r\n"),
+        (b'If-None-Match: "0-0-0", W/{etag}', b"HTTP/1.1 304 Not Modified\r\n"),
+        (b"If-None-Match: *", b"HTTP/1.1 304 Not Modified\r\n"),
+        (b'If-None-Match: "0-0-0"', b"HTTP/1.1 200 OK\r\n"),
+        (b"If-Modified-Since: {last_modified}", b"HTTP/1.1 304 Not Modified\r\n"),
+        (
+            b"If-Modified-Since: Sun, 06 Nov 1994 08:49:37 GMT",
+            b"HTTP/1.1 200 OK\r\n",
+        ),
+        (b"If-Modified-Since: yesterday", b"HTTP/1.1 200 OK\r\n"),
+        (
+            b"If-Modified-Since: 2099-01-01T00:00:00+00:00",
+            b"HTTP/1.1 304 Not Modified\r\n",
+        ),
+        (b"If-Modified-Since: 1994-11-06T08:49:37+01:00", b"HTTP/1.1 200 OK\r\n"),
+        (
+            b'If-None-Match: "0-0-0"\r\nIf-Modified-Since: {last_modified}',
+            b"HTTP/1.1 200 OK\r\n",
+        ),
+    ],
+)
+def test_conditional_request(condition, status_line):
+    """Revalidate a cached copy"""
+    cache = FileCache()
+    head = handle_request(Request(b"GET /test.txt HTTP/1.1"), True, cache)[0]
+    fields = dict(line.split(b": ", 1) for line in head.split(b"\r\n")[1:] if line)
+    condition = condition.replace(b"{etag}", fields[b"ETag"]).replace(
+        b"{last_modified}", fields[b"Last-Modified"]
+    )
+    parts = handle_request(
+        Request(b"GET /test.txt HTTP/1.1\r\n" + condition), True, cache
+    )
+    assert parts[0].startswith(status_line)
+    if status_line.startswith(b"HTTP/1.1 304"):
+        assert parts == [parts[0]]
+        assert parts[0].endswith(b"\r\n\r\n")
+        assert b"Content-Length" not in parts[0]
+        assert b"ETag: " + fields[b"ETag"] in parts[0]
+
+
+@pytest.mark.parametrize(
+    "value, ranges",
+    [
+        (b"bytes=0-499", [(0, 500)]),
+        (b"bytes=500-", [(500, 1000)]),
+        (b"bytes=-200", [(800, 1000)]),
+        (b"bytes=-2000", [(0, 1000)]),
+        (b"bytes=900-1999", [(900, 1000)]),
+        (b"bytes=0-9, 20-29", [(0, 10), (20, 30)]),
+        (b"bytes=20-29,0-9,5-14", [(0, 15), (20, 30)]),
+        (b"bytes=1000-", []),
+        (b"bytes=-0", []),
+        (b"bytes=10-5", None),
+        (b"bytes=a-b", None),
+        (b"lines=0-9", None),
+        (b"bytes=" + b",".join([b"0-0"] * 17), None),
+    ],
+)
+def test_parse_range(value, ranges):
+    """Parse the Range header"""
+    assert parse_range(value, 1000) == ranges
+
+
+def read_body(parts: list) -> bytes:
+    """Join the body parts of a response"""
+    body = b""
+    for part in parts[1:]:
+        if isinstance(part, FileRegion):
+            body += os.pread(part.file.fileno(), part.count, part.offset)
+            part.close()
+        else:
+            body += part
+    return body
+
+
+@pytest.mark.parametrize("use_cache", [True, False])
+@pytest.mark.parametrize(
+    "fields, status_line, content",
+    [
+        (b"Range: bytes=0-15", b"HTTP/1.1 206 Partial Content\r\n", slice(0, 16)),
+        (b"Range: bytes=-10", b"HTTP/1.1 206 Partial Content\r\n", slice(-10, None)),
+        (b"Range: bytes=200000-", b"HTTP/1.1 416 Range Not Satisfiable\r\n", None),
+        (
+            b'Range: bytes=0-15\r\nIf-Range: "0-0-0"',
+            b"HTTP/1.1 200 OK\r\n",
+            slice(None),
+        ),
+        (
+            b"Range: bytes=0-15\r\nIf-Range: {etag}",
+            b"HTTP/1.1 206 Partial Content\r\n",
+            slice(0, 16),
+        ),
+        (
+            b"Range: bytes=0-15\r\nIf-Range: {last_modified}",
+            b"HTTP/1.1 206 Partial Content\r\n",
+            slice(0, 16),
+        ),
+    ],
+)
+def test_range_request(fields, status_line, content, use_cache):
+    """Serve parts of a file"""
+    cache = FileCache() if use_cache else None
+    data = resolve_path("/alice30.txt").read_bytes()
+    head = handle_request(Request(b"GET /alice30.txt HTTP/1.1"), True, cache)[0]
+    known = dict(line.split(b": ", 1) for line in head.split(b"\r\n")[1:] if line)
+    fields = fields.replace(b"{etag}", known[b"ETag"]).replace(
+        b"{last_modified}", known[b"Last-Modified"]
+    )
+    parts = handle_request(
+        Request(b"GET /alice30.txt HTTP/1.1\r\n" + fields), True, cache
+    )
+    body = read_body(parts)
+    assert parts[0].startswith(status_line)
+    assert b"Content-Length: %d\r\n" % len(body) in parts[0]
+    if content is not None:
+        assert body == data[content]
+    else:
+        assert b"Content-Range: bytes */%d\r\n" % len(data) in parts[0]
+
+
+def test_multipart_range_request():
+    """Serve several parts of a file at once"""
+    data = resolve_path("/alice30.txt").read_bytes()
+    parts = handle_request(
+        Request(b"GET /alice30.txt HTTP/1.1\r\nRange: bytes=0-9,-10"), True
+    )
+    boundary = parts[0].split(b"boundary=")[1].split(b"\r\n")[0]
+    body = read_body(parts)
+    assert b"Content-Length: %d\r\n" % len(body) in parts[0]
+    pieces = body.split(b"\r\n--" + boundary)
+    assert pieces[0] == b"" and pieces[-1] == b"--\r\n"
+    assert pieces[1].endswith(b"Content-Range: bytes 0-9/148545\r\n\r\n" + data[:10])
+    assert pieces[2].endswith(b"\r\n\r\n" + data[-10:])
+
+
+def transmit(parts: list) -> bytes:
+    """Send the response parts through a socket pair and collect the bytes"""
+    sender, receiver = socket.socketpair()
+    received = []
+
+    def drain():
+        while data := receiver.recv(65536):
+            received.append(data)
+
+    reader = threading.Thread(target=drain)
+    reader.start()
+    with sender:
+        send_parts(sender, parts)
+        sender.shutdown(socket.SHUT_WR)
+    reader.join()
+    receiver.close()
+    return b"".join(received)
+
+
+@pytest.mark.parametrize(
+    "error, falls_back",
+    [(errno.EINVAL, True), (errno.ENOSYS, True), (errno.EPIPE, False)],
+)
+def test_file_region_sendfile_error(monkeypatch, error, falls_back):
+    """Fall back to reads where sendfile() is unsupported and raise other errors"""
+
+    def sendfile(*_):
+        raise OSError(error, os.strerror(error))
+
+    monkeypatch.setattr(os, "sendfile", sendfile)
+    path = resolve_path("/test.txt")
+    region = FileRegion(open(path, "rb"), 0, path.stat().st_size)
+    sender, receiver = socket.socketpair()
+    with sender, receiver, region.file:
+        if not falls_back:
+            with pytest.raises(OSError) as err:
+                region.send(sender)
+            assert err.value.errno == error
+            assert region.use_sendfile
+            return
+        region.send(sender)
+        assert not region.use_sendfile
+        assert region.done
+        assert receiver.recv(65536) == path.read_bytes()
+
+
+def dechunk(data: bytes) -> bytes:
+    """Decode a body sent with chunked transfer coding"""
+    body = b""
+    while True:
+        size, _, data = data.partition(b"\r\n")
+        size = int(size, 16)
+        if size == 0:
+            assert data == b"\r\n"
+            return body
+        body += data[:size]
+        assert data[size : size + 2] == b"\r\n"
+        data = data[size + 2 :]
+
+
+@pytest.mark.parametrize(
+    "source, chunked, wire",
+    [
+        ([b"Hel", b"", b"lo\n"], True, b"3\r\nHel\r\n3\r\nlo\n\r\n0\r\n\r\n"),
+        (iter([b"Hello\n"]), False, b"Hello\n"),
+        ([], True, b"0\r\n\r\n"),
+    ],
+)
+def test_chunk_stream(source, chunked, wire):
+    """Frame the body chunks"""
+    assert transmit([ChunkStream(source, chunked)]) == wire
+
+
+def test_chunk_stream_file():
+    """Read the body from a file object as it is sent"""
+    path = resolve_path("/alice30.txt")
+    stream = ChunkStream(open(path, "rb"))
+    assert dechunk(transmit([stream])) == path.read_bytes()
+    assert stream.source.closed
+
+
+def test_chunk_stream_error():
+    """A failing source aborts the response"""
+
+    def source():
+        yield b"Hello"
+        raise ValueError("Generator failed")
+
+    with pytest.raises(OSError):
+        transmit([ChunkStream(source())])
+
+
+@pytest.mark.parametrize(
+    "http_version, length, field",
+    [
+        ("HTTP/1.1", None, b"Transfer-Encoding: chunked\r\n"),
+        ("HTTP/1.1", 6, b"Content-Length: 6\r\n"),
+        ("HTTP/1.0", None, b"Connection: close\r\n"),
+    ],
+)
+def test_format_stream_response(http_version, length, field):
+    """Frame a streamed body by its length, chunks or the end of the connection"""
+    parts = format_stream_response(http_version, 200, {}, [b"Hello", b"\n"], length)
+    head, body = transmit(parts).split(b"\r\n\r\n", 1)
+    assert head.startswith(f"{http_version} 200 OK".encode())
+    assert field in head + b"\r\n"
+    assert (dechunk(body) if length is None and "1.1" in http_version else body) == (
+        b"Hello\n"
+    )
+
+
+def test_uncached_response_not_compressed():
+    """Send a file without a compressed variant as it is rather than compress it"""
+    request = Request(b"GET /alice30.txt HTTP/1.1\r\nAccept-Encoding: gzip")
+    parts = handle_request(request, True)
+    assert isinstance(parts[1], FileRegion)
+    head, body = transmit(parts).split(b"\r\n\r\n", 1)
+    assert b"Content-Encoding" not in head
+    assert body == resolve_path("/alice30.txt").read_bytes()
+
+
+def test_request_parser_head_too_large():
+    """Refuse a request head that keeps growing"""
+    parser = RequestParser(max_head=64)
+    assert parser.feed(b"GET /test.txt HTTP/1.1\r\n") == []
+    assert parser.pending
+    with pytest.raises(HeadTooLarge):
+        parser.feed(b"X-Padding: " + b"x" * 64)
+
+
+def start_server(tmp_path, **limits) -> tuple[tuple, Counter]:
+    """Run the event loop in a background thread on an ephemeral port"""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    log = LogWriter(tmp_path / "webserver.log")
+    shed = Counter()
+    threading.Thread(
+        target=serve_concurrent,
+        args=(sock, log, None, shed),
+        kwargs=limits,
+        daemon=True,
+    ).start()
+    return sock.getsockname(), shed
+
+
+def receive_all(client: socket.socket) -> bytes:
+    """Read until the server closes the connection"""
+    received = b""
+    while data := client.recv(65536):
+        received += data
+    return received
+
+
+def test_pipelined_files(tmp_path):
+    """Keep one file open per connection however many requests are pipelined"""
+    addr, shed = start_server(tmp_path)
+    path = str(resolve_path("/alice30.txt"))
+
+    def open_copies() -> int:
+        fds = os.listdir("/proc/self/fd")
+        return sum(
+            os.path.realpath(f"/proc/self/fd/{fd}") == path
+            for fd in fds
+            if os.path.exists(f"/proc/self/fd/{fd}")
+        )
+
+    with socket.create_connection(addr, timeout=5) as client:
+        client.sendall(b"GET /alice30.txt HTTP/1.1\r\n\r\n" * 40)
+        time.sleep(0.2)
+        assert open_copies() == 1
+        client.sendall(b"GET /alice30.txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        received = receive_all(client)
+    assert received.count(b"HTTP/1.1 200 OK\r\n") == 41
+    assert len(received) > 41 * os.path.getsize(path)
+    assert not shed
+
+
+def test_connection_limit(tmp_path):
+    """Turn connections away with 503 once the limit is reached"""
+    addr, shed = start_server(tmp_path, max_connections=1)
+    with socket.create_connection(addr, timeout=5) as first:
+        first.sendall(b"GET /test.txt HTTP/1.1\r\n\r\n")
+        assert first.recv(65536).startswith(b"HTTP/1.1 200 OK\r\n")
+        with socket.create_connection(addr, timeout=5) as second:
+            response = receive_all(second)
+        assert response.startswith(b"HTTP/1.1 503 Service Unavailable\r\n")
+        assert b"Retry-After: " in response
+        first.sendall(b"GET /test.txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        assert b"HTTP/1.1 200 OK\r\n" in receive_all(first)
+    assert shed["overloaded"] == 1
+
+
+def test_request_failure(tmp_path, monkeypatch):
+    """Answer a request that fails with an error and keep serving the others"""
+    addr, shed = start_server(tmp_path)
+    with socket.create_connection(addr, timeout=5) as other:
+        other.sendall(b"GET /test.txt HTTP/1.1\r\n\r\n")
+        with socket.create_connection(addr, timeout=5) as client:
+            client.sendall(b"GET /a\x00b HTTP/1.1\r\n\r\n")
+            assert client.recv(65536).startswith(b"HTTP/1.1 404 Not Found\r\n")
+        monkeypatch.setattr(
+            "src.projects.webserver.server.resolve_path",
+            lambda url: tmp_path / "vanished.txt",
+        )
+        with socket.create_connection(addr, timeout=5) as client:
+            client.sendall(b"GET /vanished.txt HTTP/1.1\r\n\r\n")
+            assert receive_all(client).startswith(b"HTTP/1.1 404 Not Found\r\n")
+        monkeypatch.undo()
+        other.sendall(b"GET /test.txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        assert receive_all(other).count(b"HTTP/1.1 200 OK\r\n") == 2
+    assert shed["failed"] == 1
+
+
+@pytest.mark.parametrize(
+    "soft_limit, requested, limit",
+    [(1024, 1024, 480), (65536, 1024, 1024), (100, 1024, 18), (10, 1024, 1)],
+)
+def test_connection_limit_descriptors(monkeypatch, soft_limit, requested, limit):
+    """Keep the connections within the open file limit"""
+    monkeypatch.setattr(
+        "src.projects.webserver.server.getrlimit", lambda _: (soft_limit, 1 << 20)
+    )
+    assert connection_limit(requested) == limit
+
+
+class ExhaustedSocket(socket.socket):
+    """A listener whose first accept() finds no free descriptor"""
+
+    failures = 1
+
+    def accept(self):
+        if self.failures:
+            self.failures -= 1
+            raise OSError(errno.EMFILE, "Too many open files")
+        return super().accept()
+
+
+def test_accept_exhausted(tmp_path):
+    """Shed load while out of descriptors and accept again after the sweep"""
+    sock = ExhaustedSocket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    sock.listen()
+    shed = Counter()
+    threading.Thread(
+        target=serve_concurrent,
+        args=(sock, LogWriter(tmp_path / "webserver.log"), None, shed),
+        daemon=True,
+    ).start()
+    with socket.create_connection(sock.getsockname(), timeout=5) as client:
+        client.sendall(b"GET /test.txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+        assert receive_all(client).startswith(b"HTTP/1.1 200 OK\r\n")
+    assert shed["overloaded"] == 1
+
+
+def test_slow_client(tmp_path):
+    """Close connections that trickle a request or sit idle"""
+    addr, shed = start_server(tmp_path, header_timeout=0.3, idle_timeout=0.3)
+    with (
+        socket.create_connection(addr, timeout=5) as slow,
+        socket.create_connection(addr, timeout=5) as idle,
+    ):
+        idle.sendall(b"GET /test.txt HTTP/1.1\r\n\r\n")
+        started = time.monotonic()
+        slow.sendall(b"GET /test.txt HTTP/1.1\r\n")
+        for _ in range(40):
+            if select.select([slow], [], [], 0.05)[0]:
+                break
+            slow.sendall(b"X")
+        assert time.monotonic() - started < 1.5
+        assert receive_all(slow).startswith(b"HTTP/1.1 408 Request Timeout\r\n")
+        assert receive_all(idle).startswith(b"HTTP/1.1 200 OK\r\n")
+    assert shed["header_timeout"] == 1
+    assert shed["idle_timeout"] == 1
+
+
+def child_pids(pid: int) -> set[int]:
+    """Processes started by a process"""
+    return {
+        int(child) for child in open(f"/proc/{pid}/task/{pid}/children").read().split()
+    }
+
+
+def wait_until(predicate, timeout: float = 10.0) -> None:
+    """Poll until the predicate holds"""
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        assert time.monotonic() < deadline, "Timed out"
+        time.sleep(0.05)
+
+
+def fetch(addr: tuple) -> bytes:
+    """The response to a request for the test file, or b"" if refused"""
+    try:
+        with socket.create_connection(addr, timeout=5) as client:
+            client.sendall(b"GET /test.txt HTTP/1.1\r\nConnection: close\r\n\r\n")
+            return receive_all(client)
+    except ConnectionRefusedError:
+        return b""
+
+
+def run_supervisor(n_workers: int, **loop_args) -> None:
+    """Supervise the workers until interrupted, as the server's main() does"""
+    signal.signal(signal.SIGINT, signal.default_int_handler)
+    try:
+        supervise(n_workers, **loop_args)
+    except KeyboardInterrupt:
+        pass
+
+
+@pytest.mark.skipif(not os.path.exists("/proc/self/task"), reason="Needs /proc")
+@pytest.mark.parametrize("stop_signal", [signal.SIGINT, signal.SIGTERM])
+def test_supervise(tmp_path, monkeypatch, stop_signal):
+    """Serve from worker processes, restart a dead one and stop them all"""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as probe:
+        probe.bind(("127.0.0.1", 0))
+        addr = probe.getsockname()
+    monkeypatch.setattr("src.projects.webserver.server.SRVR_ADDR", addr[0])
+    monkeypatch.setattr("src.projects.webserver.server.SRVR_PORT", addr[1])
+    supervisor = multiprocessing.Process(
+        target=run_supervisor,
+        args=(2,),
+        kwargs={"logfilename": tmp_path / "webserver.log", "concurrent": True},
+    )
+    supervisor.start()
+    try:
+        wait_until(lambda: len(child_pids(supervisor.pid)) == 2)
+        wait_until(lambda: fetch(addr).startswith(b"HTTP/1.1 200 OK\r\n"))
+        workers = child_pids(supervisor.pid)
+        killed = workers.pop()
+        os.kill(killed, signal.SIGKILL)
+        wait_until(
+            lambda: len(children := child_pids(supervisor.pid)) == 2
+            and killed not in children
+        )
+        restarted = child_pids(supervisor.pid)
+        assert workers < restarted
+        for _ in range(10):
+            assert fetch(addr).startswith(b"HTTP/1.1 200 OK\r\n")
+        os.kill(supervisor.pid, stop_signal)
+        supervisor.join(10)
+        assert supervisor.exitcode == 0
+        assert not any(os.path.exists(f"/proc/{pid}") for pid in restarted)
+    finally:
+        if supervisor.is_alive():
+            # Stopped first so that it cannot restart the workers killed here
+            os.kill(supervisor.pid, signal.SIGSTOP)
+            for pid in child_pids(supervisor.pid):
+                os.kill(pid, signal.SIGKILL)
+            supervisor.kill()
+            supervisor.join()
+
+
 if __name__ == "__main__":
     pytest.main(["-v", __file__])